@@ -0,0 +1,121 @@
+"""
+Compares parse counts and wall time of the html post processing
+before (one parse/serialize/write per step) and after (one
+PostProcessor pass, or one StreamRewriter pass for publish) on
+converted html tarballs.
+
+Usage, from ConversionContainer/:
+    python -m benchmarks.bench_postprocess [tarball ...]
+"""
+from typing import Callable, Dict, List
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import time
+from unittest import mock
+
+from bs4 import BeautifulSoup
+from source.convert.postprocess import (
+    PostProcessor,
+    base_tag,
+    base_tag_html,
+    missing_package_warning,
+    license_section,
+    absolute_anchors_for_submission,
+    absolute_anchors_for_doc,
+    doc_href
+)
+from source.convert.rewrite import StreamRewriter
+from source.publish.watermark import watermark_section
+
+DEFAULT_TARBALLS = ['tests/ancillary_files/5393936.tar.gz']
+
+VIEW_SUB_BASE = 'https://services.arxiv.org'
+VIEW_DOC_BASE = 'https://arxiv.org'
+PAPER_IDV = '2402.00001v1'
+
+def _watermark () -> BeautifulSoup:
+    return BeautifulSoup(f'<div id="watermark-tr">arXiv:{PAPER_IDV} [math.OC] 06 Feb 2024</div>', 'html.parser')
+
+def convert_before (fpath: str) -> None:
+    PostProcessor(fpath).register(missing_package_warning, ['foo.sty']).run()
+    PostProcessor(fpath).register(license_section, 'License: CC BY 4.0', ['foo.sty']).run()
+    PostProcessor(fpath).register(absolute_anchors_for_submission, 1, VIEW_SUB_BASE).run()
+
+def convert_after (fpath: str) -> None:
+    PostProcessor(fpath) \
+        .register(missing_package_warning, ['foo.sty']) \
+        .register(license_section, 'License: CC BY 4.0', ['foo.sty']) \
+        .register(absolute_anchors_for_submission, 1, VIEW_SUB_BASE) \
+        .run()
+
+def publish_before (fpath: str) -> None:
+    PostProcessor(fpath).register(base_tag, PAPER_IDV).run()
+    PostProcessor(fpath).register(watermark_section, _watermark()).run()
+    PostProcessor(fpath).register(absolute_anchors_for_doc, PAPER_IDV, VIEW_DOC_BASE).run()
+
+def publish_after (fpath: str) -> None:
+    PostProcessor(fpath) \
+        .register(base_tag, PAPER_IDV) \
+        .register(watermark_section, _watermark()) \
+        .register(absolute_anchors_for_doc, PAPER_IDV, VIEW_DOC_BASE) \
+        .run()
+
+def publish_stream (fpath: str) -> None:
+    StreamRewriter(fpath) \
+        .append_to_head(base_tag_html(PAPER_IDV)) \
+        .append_to_id('target-section', str(_watermark())) \
+        .rewrite_ltx_refs(lambda href: doc_href(href, PAPER_IDV, VIEW_DOC_BASE)) \
+        .run()
+
+def measure (step: Callable[[str], None], src: str, workdir: str) -> Dict[str, float]:
+    """ Runs step on a fresh copy of src counting full document parses and serializations """
+    fpath = os.path.join(workdir, 'bench.html')
+    shutil.copy(src, fpath)
+    size = os.path.getsize(fpath)
+    counts = { 'parses': 0, 'serializations': 0 }
+
+    original_init = BeautifulSoup.__init__
+    original_decode = BeautifulSoup.decode
+
+    def counting_init (self, markup='', *args, **kwargs):
+        if isinstance(markup, str) and len(markup) >= size // 2:
+            counts['parses'] += 1
+        original_init(self, markup, *args, **kwargs)
+
+    def counting_decode (self, *args, **kwargs):
+        counts['serializations'] += 1
+        return original_decode(self, *args, **kwargs)
+
+    with mock.patch.object(BeautifulSoup, '__init__', counting_init), \
+            mock.patch.object(BeautifulSoup, 'decode', counting_decode):
+        start = time.perf_counter()
+        step(fpath)
+        elapsed = time.perf_counter() - start
+    return { **counts, 'seconds': elapsed }
+
+def main (tarballs: List[str]) -> None:
+    with tempfile.TemporaryDirectory() as workdir:
+        for tarball in tarballs:
+            site_dir = os.path.join(workdir, 'site')
+            with tarfile.open(tarball) as tar:
+                tar.extractall(site_dir)
+            for root, _, fnames in os.walk(site_dir):
+                for fname in filter(lambda f: f.endswith('.html'), fnames):
+                    src = os.path.join(root, fname)
+                    print(f'{tarball}: {fname} ({os.path.getsize(src) / 1e6:.1f} MB)')
+                    for name, step in [('convert before', convert_before),
+                                       ('convert after', convert_after),
+                                       ('publish before', publish_before),
+                                       ('publish after', publish_after),
+                                       ('publish stream', publish_stream)]:
+                        result = measure(step, src, workdir)
+                        print(f'  {name:<16}parses={result["parses"]:<4}'
+                              f'serializations={result["serializations"]:<6}'
+                              f'wall={result["seconds"]:.2f}s')
+            shutil.rmtree(site_dir)
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or DEFAULT_TARBALLS)
@@ -0,0 +1,10 @@
+-- GCS generation of the source blob each conversion was made from, which
+-- write_success and write_failure match on (source/models/db.py).
+--
+-- Run against the latexml database BEFORE deploying a ConversionContainer
+-- that maps source_generation: with the column mapped, every ORM query on
+-- these tables fails until it exists. The column is nullable and older
+-- images never read it, so running it ahead of the deploy is safe.
+
+ALTER TABLE arXiv_latexml_doc ADD COLUMN source_generation BIGINT NULL;
+ALTER TABLE arXiv_latexml_sub ADD COLUMN source_generation BIGINT NULL;
@@ -0,0 +1,16 @@
+-- GCS md5 of the converted source blob, and the POSTPROCESS_VERSION its
+-- html was post processed with, which the conversion planner compares
+-- (source/convert/planner.py). write_start writes both on every conversion.
+--
+-- Run against the latexml database after 001_source_generation.sql and
+-- BEFORE deploying a ConversionContainer that maps these columns: with
+-- them mapped, every ORM query on these tables fails until they exist.
+-- Both are nullable and older images never read them, so running this
+-- ahead of the deploy is safe. Existing rows get NULL, which the planner
+-- treats as an unknown source (skipped by batch conversion) and an
+-- outdated post processing.
+
+ALTER TABLE arXiv_latexml_doc ADD COLUMN source_md5 VARCHAR(32) NULL;
+ALTER TABLE arXiv_latexml_doc ADD COLUMN postprocess_version VARCHAR(40) NULL;
+ALTER TABLE arXiv_latexml_sub ADD COLUMN source_md5 VARCHAR(32) NULL;
+ALTER TABLE arXiv_latexml_sub ADD COLUMN postprocess_version VARCHAR(40) NULL;
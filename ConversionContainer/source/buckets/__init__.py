@@ -1,21 +1,83 @@
+from typing import Any, Dict, List, Optional, Tuple
+import json
 import os
 import tarfile
 
-from .util import get_google_storage_client
+from flask import current_app
+from google.cloud.storage import Blob
+
+from . import util
+from .upload import AssetStore, copy_objects, upload_dir, upload_file
+from ..util import GzipChecksum, ChecksumReader, untar_stream, unzip_single_file_stream
+from ..exceptions import GCPBlobError
+
+# Size of the ranged reads when streaming a blob, and so of the read buffer
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
 
 def download_blob (bucket_name: str, blob_name: str, dst_fpath: str): 
-    blob = get_google_storage_client() \
+    blob = util.get_google_storage_client() \
         .bucket(bucket_name).blob(blob_name)
     with open(dst_fpath, 'wb') as read_stream:
         blob.download_to_file(read_stream)
         read_stream.close()
 
+def download_blob_with_checksum (bucket_name: str, blob_name: str, dst_fpath: str) -> Tuple[str, int]:
+    """
+    Downloads the gzipped blob to dst_fpath and returns the md5
+    of its gunzipped contents and the generation downloaded
+    """
+    blob = util.get_google_storage_client() \
+        .bucket(bucket_name).blob(blob_name)
+    with open(dst_fpath, 'wb') as read_stream:
+        checksum = GzipChecksum(read_stream)
+        blob.download_to_file(checksum)
+    # Set from the x-goog-generation header of the download itself
+    return checksum.hexdigest(), blob.generation
+
+def extract_blob (bucket_name: str, blob_name: str, dst_dir: str,
+                  single_file_name: Optional[str] = None) -> Tuple[str, int]:
+    """
+    Streams the gzipped blob straight into dst_dir without writing
+    the archive to disk: a .tar.gz is extracted entry by entry and
+    a single .gz is gunzipped to dst_dir/single_file_name.
+
+    Returns
+    -------
+    Tuple[str, int]
+        The md5 of the gunzipped contents and the generation streamed
+    """
+    bucket = util.get_google_storage_client().bucket(bucket_name)
+    current = bucket.get_blob(blob_name)
+    if current is None:
+        raise GCPBlobError(f'{blob_name} not found in {bucket_name}')
+    # Pinned so a re-upload mid stream can't mix two generations
+    blob = bucket.blob(blob_name, generation=current.generation)
+    with blob.open('rb', chunk_size=STREAM_CHUNK_SIZE) as stream:
+        reader = ChecksumReader(stream)
+        if single_file_name:
+            unzip_single_file_stream(reader, os.path.join(dst_dir, single_file_name))
+        else:
+            untar_stream(reader, dst_dir)
+        tex_checksum = reader.drain()
+    return tex_checksum, current.generation
+
+def blob_metadata (bucket_name: str, blob_name: str) -> Optional[Blob]:
+    """ Metadata only fetch of the blob, None if it doesn't exist """
+    return util.get_google_storage_client() \
+        .bucket(bucket_name).get_blob(blob_name)
+
+def blob_generation (bucket_name: str, blob_name: str) -> Optional[int]:
+    """ Metadata only fetch of the blob's current generation, None if it no longer exists """
+    blob = util.get_google_storage_client() \
+        .bucket(bucket_name).get_blob(blob_name)
+    return blob.generation if blob else None
+
 def delete_blob (bucket_name: str, blob_name: str):
-    get_google_storage_client() \
+    util.get_google_storage_client() \
         .bucket(bucket_name).blob(blob_name).delete()
 
     
-def upload_dir_to_gcs (src_dir: str, bucket_name: str):
+def upload_dir_to_gcs (src_dir: str, bucket_name: str) -> Dict[str, Any]:
     """
     Uploads the directory subtree of the given directory to the 
     given GCS bucket
@@ -27,18 +89,96 @@ def upload_dir_to_gcs (src_dir: str, bucket_name: str):
         in the form of ./extracted/{id}/html/ for conversion
     bucket_name : str
         name of bucket to upload to
+
+    Returns
+    -------
+    Dict[str, Any]
+        The upload manifest, see buckets.upload.upload_dir
+    """
+    return upload_dir(
+        src_dir,
+        bucket_name,
+        current_app.config['UPLOAD_CONCURRENCY'],
+        current_app.config['UPLOAD_CACHE_CONTROL'],
+        _asset_store(bucket_name))
+
+def upload_objects_to_gcs (id: Any, src_dir: str, bucket_name: str) -> Dict[str, Any]:
     """
-    bucket = get_google_storage_client().bucket(bucket_name)
-    for root, _, fnames in os.walk(src_dir):
-        for fname in fnames:
-            abs_fpath = os.path.join(root, fname)
-            bucket.blob(
-                os.path.relpath(
-                    abs_fpath,
-                    src_dir
-                )
-            ) \
-            .upload_from_filename(abs_fpath)
+    Uploads the files of {src_dir}/{id} to bucket_name as objects
+    under {id}/, then lists them in {id}.objects.json. Objects of
+    a previous conversion that aren't in the list are deleted.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The upload manifest, see buckets.upload.upload_dir
+    """
+    manifest = upload_dir(
+        os.path.join(src_dir, str(id)),
+        bucket_name,
+        current_app.config['UPLOAD_CONCURRENCY'],
+        current_app.config['UPLOAD_CACHE_CONTROL'],
+        _asset_store(bucket_name),
+        prefix=f'{id}/')
+    names = [o['name'][len(f'{id}/'):] for o in manifest['objects']]
+    bucket = util.get_google_storage_client().bucket(bucket_name)
+    # Written last, so a listed object always exists
+    bucket.blob(f'{id}.objects.json').upload_from_string(
+        json.dumps({ 'names': names }), content_type='application/json')
+    current = set(o['name'] for o in manifest['objects'])
+    for blob in bucket.list_blobs(prefix=f'{id}/'):
+        if blob.name not in current:
+            blob.delete()
+    return manifest
+
+def stored_object_names (id: Any, bucket_name: str) -> Optional[List[str]]:
+    """ Names under {id}/ of the objects upload_objects_to_gcs stored, None if it never did """
+    blob = util.get_google_storage_client() \
+        .bucket(bucket_name).get_blob(f'{id}.objects.json')
+    return json.loads(blob.download_as_text())['names'] if blob else None
+
+def delete_objects (id: Any, bucket_name: str):
+    """ Deletes what upload_objects_to_gcs stored for id """
+    bucket = util.get_google_storage_client().bucket(bucket_name)
+    for blob in bucket.list_blobs(prefix=f'{id}/'):
+        blob.delete()
+    blob = bucket.get_blob(f'{id}.objects.json')
+    if blob:
+        blob.delete()
+
+def copy_objects_in_gcs (src_bucket_name: str, dst_bucket_name: str, names: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Copies each src name -> dst name server side, with the Cache-Control
+    and concurrency of an upload
+
+    Returns
+    -------
+    Dict[str, Any]
+        The copy manifest, see buckets.upload.copy_objects
+    """
+    client = util.get_google_storage_client()
+    return copy_objects(
+        client.bucket(src_bucket_name),
+        client.bucket(dst_bucket_name),
+        names,
+        current_app.config['UPLOAD_CONCURRENCY'],
+        current_app.config['UPLOAD_CACHE_CONTROL'])
+
+def _asset_store (bucket_name: str) -> Optional[AssetStore]:
+    """ The content addressed store for bucket_name's assets, None unless ASSET_STORE_MODE is 'content' """
+    if current_app.config['ASSET_STORE_MODE'] != 'content':
+        return None
+    return AssetStore(
+        util.get_google_storage_client().bucket(current_app.config['ASSET_STORE_BUCKET'] or bucket_name),
+        current_app.config['ASSET_STORE_PREFIX'],
+        current_app.config['ASSET_STORE_MIN_BYTES'])
+
+def upload_file_to_gcs (fpath: str, bucket_name: str, blob_name: str) -> Dict[str, Any]:
+    """ Uploads one file the way upload_dir_to_gcs uploads each of a directory's """
+    return upload_file(
+        util.get_google_storage_client().bucket(bucket_name),
+        fpath, blob_name,
+        current_app.config['UPLOAD_CACHE_CONTROL'])
 
 def upload_tar_to_gcs (sub_id: int, src_dir: str, bucket_name: str, destination_fname: str) -> None:
     """
@@ -57,7 +197,7 @@ def upload_tar_to_gcs (sub_id: int, src_dir: str, bucket_name: str, destination_
     """
     with tarfile.open(destination_fname, "w:gz") as tar:
         tar.add(f'{src_dir}/{sub_id}', arcname=str(sub_id))
-    bucket = get_google_storage_client().bucket(bucket_name)
+    bucket = util.get_google_storage_client().bucket(bucket_name)
     blob = bucket.blob(f'{sub_id}.tar.gz')
     blob.upload_from_filename(destination_fname)
 
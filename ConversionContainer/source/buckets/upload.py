@@ -0,0 +1,223 @@
+"""Concurrent uploads of converted directories to GCS"""
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import mimetypes
+import os
+import time
+
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud.storage import Blob, Bucket
+
+from . import util
+
+logger = logging.getLogger()
+
+UPLOAD_ATTEMPTS = 3
+UPLOAD_BACKOFF = 0.5
+
+# mimetypes reads the system's tables, which may be missing in the container
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'text/javascript; charset=utf-8',
+    '.svg': 'image/svg+xml',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.txt': 'text/plain; charset=utf-8',
+}
+
+def content_type (fpath: str) -> str:
+    ext = os.path.splitext(fpath)[1].lower()
+    if ext in CONTENT_TYPES:
+        return CONTENT_TYPES[ext]
+    return mimetypes.guess_type(fpath)[0] or 'application/octet-stream'
+
+class AssetStore (NamedTuple):
+    """
+    Where upload_dir keeps one copy of each distinct asset, named
+    by its content under prefix. Files of at least min_bytes are
+    uploaded there once and copied into place server side.
+    """
+    bucket: Bucket
+    prefix: str
+    min_bytes: int
+
+def _with_retries (blob_name: str, fn: Callable[[], Any]) -> int:
+    """ Calls fn, retrying failures with backoff. Returns the attempts taken """
+    for attempt in range(UPLOAD_ATTEMPTS):
+        try:
+            fn()
+            return attempt + 1
+        except Exception:
+            if attempt == UPLOAD_ATTEMPTS - 1:
+                raise
+            logger.warning(f'Upload of {blob_name} failed, retrying', exc_info=1)
+            time.sleep(UPLOAD_BACKOFF * 2 ** attempt)
+
+def upload_file (bucket: Bucket, abs_fpath: str, blob_name: str,
+                 cache_control: Optional[str]) -> Dict[str, Any]:
+    """ Uploads abs_fpath as blob_name, retrying failures with backoff """
+    start = time.perf_counter()
+    def upload ():
+        blob = bucket.blob(blob_name)
+        blob.cache_control = cache_control
+        blob.upload_from_filename(abs_fpath, content_type=content_type(abs_fpath))
+    attempts = _with_retries(blob_name, upload)
+    size = os.path.getsize(abs_fpath)
+    return {
+        'name': blob_name,
+        'bytes': size,
+        'bytes_uploaded': size,
+        'attempts': attempts,
+        'seconds': time.perf_counter() - start
+    }
+
+def rewrite_blob (blob: Blob, source: Blob):
+    """ Server side copy of source to blob, with blob's metadata. Large copies take several calls """
+    token, _, _ = blob.rewrite(source)
+    while token is not None:
+        token, _, _ = blob.rewrite(source, token=token)
+
+def copy_objects (src_bucket: Bucket, dst_bucket: Bucket, names: Dict[str, str],
+                  max_workers: int, cache_control: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Copies each src name -> dst name server side on max_workers
+    threads, retrying failures with backoff
+
+    Returns
+    -------
+    Dict[str, Any]
+        The manifest of the copy, as upload_dir's with nothing uploaded
+    """
+    start = time.perf_counter()
+    def copy (src_name: str, dst_name: str) -> Dict[str, Any]:
+        copy_start = time.perf_counter()
+        def rewrite ():
+            blob = dst_bucket.blob(dst_name)
+            blob.cache_control = cache_control
+            blob.content_type = content_type(dst_name)
+            rewrite_blob(blob, src_bucket.blob(src_name))
+        attempts = _with_retries(dst_name, rewrite)
+        return {
+            'name': dst_name,
+            'source': src_name,
+            'bytes_uploaded': 0,
+            'attempts': attempts,
+            'seconds': time.perf_counter() - copy_start
+        }
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='copy') as executor:
+        futures = [executor.submit(copy, src, dst) for src, dst in names.items()]
+        objects = [future.result() for future in futures]
+    manifest = {
+        'bucket': dst_bucket.name,
+        'objects': objects,
+        'bytes_uploaded': 0,
+        'seconds': time.perf_counter() - start
+    }
+    logger.info(f'Copied {len(objects)} objects from {src_bucket.name} to {dst_bucket.name} '
+                f'in {manifest["seconds"]:.2f}s')
+    return manifest
+
+def asset_name (abs_fpath: str, prefix: str) -> str:
+    """ The asset store name of the file's content, keeping its extension for the content type """
+    sha256 = hashlib.sha256()
+    with open(abs_fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return f'{prefix}{sha256.hexdigest()}{os.path.splitext(abs_fpath)[1].lower()}'
+
+def copy_from_asset_store (bucket: Bucket, abs_fpath: str, blob_name: str,
+                           cache_control: Optional[str], store: AssetStore) -> Dict[str, Any]:
+    """
+    Puts abs_fpath at blob_name by a server side rewrite of its
+    copy in the asset store, uploading that copy first if the
+    store doesn't have the content yet
+    """
+    start = time.perf_counter()
+    name = asset_name(abs_fpath, store.prefix)
+    uploaded = False
+    def upload_asset ():
+        nonlocal uploaded
+        if store.bucket.get_blob(name) is not None:
+            return
+        try:
+            store.bucket.blob(name).upload_from_filename(
+                abs_fpath, content_type=content_type(abs_fpath), if_generation_match=0)
+            uploaded = True
+        except PreconditionFailed:
+            pass # Another upload of the same content got there first
+    def rewrite ():
+        blob = bucket.blob(blob_name)
+        blob.cache_control = cache_control
+        blob.content_type = content_type(abs_fpath)
+        rewrite_blob(blob, store.bucket.blob(name))
+    attempts = max(_with_retries(name, upload_asset), _with_retries(blob_name, rewrite))
+    size = os.path.getsize(abs_fpath)
+    return {
+        'name': blob_name,
+        'bytes': size,
+        'bytes_uploaded': size if uploaded else 0,
+        'asset': name,
+        'attempts': attempts,
+        'seconds': time.perf_counter() - start
+    }
+
+def _is_asset (abs_fpath: str, asset_store: Optional[AssetStore]) -> bool:
+    # The html is rewritten per paper, so never shared
+    return asset_store is not None \
+        and not abs_fpath.endswith('.html') \
+        and os.path.getsize(abs_fpath) >= asset_store.min_bytes
+
+def upload_dir (src_dir: str, bucket_name: str, max_workers: int,
+                cache_control: Optional[str] = None,
+                asset_store: Optional[AssetStore] = None,
+                prefix: str = '') -> Dict[str, Any]:
+    """
+    Uploads the directory subtree of src_dir to the bucket on
+    max_workers threads sharing the process's client, with each object
+    named prefix + its path relative to src_dir. With an asset_store, html
+    and small files are uploaded and the rest copied from the store.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The manifest of the upload: the bucket, every object
+        uploaded with its byte count, the bytes actually sent,
+        the asset it was copied from if any, attempts and time
+        taken, and the totals for the directory
+    """
+    start = time.perf_counter()
+    bucket = util.get_google_storage_client().bucket(bucket_name)
+
+    files: List[str] = [
+        os.path.join(root, fname)
+        for root, _, fnames in os.walk(src_dir)
+        for fname in fnames
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload') as executor:
+        futures = [
+            executor.submit(copy_from_asset_store, bucket, abs_fpath,
+                            prefix + os.path.relpath(abs_fpath, src_dir), cache_control, asset_store)
+            if _is_asset(abs_fpath, asset_store) else
+            executor.submit(upload_file, bucket, abs_fpath,
+                            prefix + os.path.relpath(abs_fpath, src_dir), cache_control)
+            for abs_fpath in files
+        ]
+        # Raises the first failure, leaving the executor to finish the rest
+        objects = [future.result() for future in futures]
+
+    manifest = {
+        'bucket': bucket_name,
+        'objects': objects,
+        'bytes': sum(o['bytes'] for o in objects),
+        'bytes_uploaded': sum(o['bytes_uploaded'] for o in objects),
+        'seconds': time.perf_counter() - start
+    }
+    logger.info(f'Uploaded {len(objects)} objects ({manifest["bytes"]} bytes, '
+                f'{manifest["bytes_uploaded"]} sent) from {src_dir} to {bucket_name} '
+                f'in {manifest["seconds"]:.2f}s')
+    return manifest
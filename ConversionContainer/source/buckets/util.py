@@ -1,9 +1,47 @@
-from typing import Optional
+from typing import Dict, Optional
 import re
+import os
+import threading
+import logging
 from bs4 import BeautifulSoup
 
+from flask import current_app
 from google.cloud import storage
 import google.cloud.logging
+from requests.adapters import HTTPAdapter
 
-def get_google_storage_client ():
-    return storage.Client()
+logger = logging.getLogger()
+
+_client: Optional[storage.Client] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+_client_creations = 0
+
+def _new_google_storage_client () -> storage.Client:
+    pool_size = current_app.config['GCS_HTTP_POOL_SIZE']
+    client = storage.Client()
+    # requests keeps 10 connections per host by default
+    client._http.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    return client
+
+def get_google_storage_client () -> storage.Client:
+    """
+    Returns this process's shared client, creating it on first
+    use. gunicorn forks workers after import and connections
+    can't be shared across a fork, so each pid gets its own.
+    """
+    global _client, _client_pid, _client_creations
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = _new_google_storage_client()
+            _client_pid = os.getpid()
+            _client_creations += 1
+            logger.info(f'Created GCS client {_client_creations} for pid {_client_pid}')
+        return _client
+
+def google_storage_client_stats () -> Dict[str, Optional[int]]:
+    with _client_lock:
+        return {
+            'creations': _client_creations,
+            'pid': _client_pid
+        }
@@ -8,11 +8,18 @@ OUT_BUCKET_ARXIV_ID = os.environ['DOCUMENT_CONVERTED_BUCKET'] # Startup failure
 IN_BUCKET_SUB_ID = os.environ['SUBMISSION_SOURCE_BUCKET'] # Startup failure on miss
 OUT_BUCKET_SUB_ID = os.environ['SUBMISSION_CONVERTED_BUCKET'] # Startup failure on miss
 RAW_LATEXML_SUBMISSION = os.environ['RAW_LATEXML_SUBMISSION']
+# Documents' LaTeXML output before post processing, not kept if unset
+RAW_LATEXML_DOC = os.environ.get('RAW_LATEXML_DOC')
 
 QA_BUCKET_SUB = os.environ['QA_BUCKET_SUB'] # Startup failure on miss
 QA_BUCKET_DOC = os.environ['QA_BUCKET_DOC']
 
 LATEXML_COMMIT = os.environ['LATEXML_COMMIT']
+# Bump when post processing changes so the planner re-post-processes unchanged papers
+POSTPROCESS_VERSION = os.environ.get('POSTPROCESS_VERSION', '1')
+# Seconds the planner skips a source whose conversion failed with the
+# current LATEXML_COMMIT before converting it again, in case it was transient
+FAILED_CONVERSION_RETRY_AFTER = float(os.environ.get('FAILED_CONVERSION_RETRY_AFTER', 24 * 3600))
 
 LATEXML_DB_URI = os.environ['LATEXML_DB_URI']
 LATEXML_URL_BASE = os.environ['LATEXML_URL_BASE']
@@ -22,7 +29,75 @@ VIEW_DOC_BASE = os.environ['VIEW_DOC_BASE']
 SQLALCHEMY_DATABASE_URI = CLASSIC_DATABASE_URI
 SQLALCHEMY_BINDS = { 'latexml': LATEXML_DB_URI }
 
+# Per gunicorn worker: conversions running at once and waiting behind them
+CONVERSION_CONCURRENCY = int(os.environ.get('CONVERSION_CONCURRENCY', 2))
+CONVERSION_QUEUE_SIZE = int(os.environ.get('CONVERSION_QUEUE_SIZE', 2))
+
+# Publishes running at once and waiting behind them, separate from conversions
+PUBLISH_CONCURRENCY = int(os.environ.get('PUBLISH_CONCURRENCY', 2))
+PUBLISH_QUEUE_SIZE = int(os.environ.get('PUBLISH_QUEUE_SIZE', 8))
+# Tries per queued publish, waiting PUBLISH_RETRY_BACKOFF seconds, doubling, between them
+PUBLISH_ATTEMPTS = int(os.environ.get('PUBLISH_ATTEMPTS', 3))
+PUBLISH_RETRY_BACKOFF = float(os.environ.get('PUBLISH_RETRY_BACKOFF', 10))
+
+# HTTP connections the shared GCS client keeps open, at least UPLOAD_CONCURRENCY
+GCS_HTTP_POOL_SIZE = int(os.environ.get('GCS_HTTP_POOL_SIZE', 16))
+
+# Threads uploading one converted directory, and the Cache-Control set on each object
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', 8))
+UPLOAD_CACHE_CONTROL = os.environ.get('UPLOAD_CACHE_CONTROL', 'public, max-age=3600')
+
+# 'content' uploads each distinct asset of at least ASSET_STORE_MIN_BYTES once, under
+# ASSET_STORE_PREFIX in ASSET_STORE_BUCKET (default the destination), and copies it
+# into place server side. 'off' uploads every file.
+ASSET_STORE_MODE = os.environ.get('ASSET_STORE_MODE', 'off')
+ASSET_STORE_BUCKET = os.environ.get('ASSET_STORE_BUCKET')
+ASSET_STORE_PREFIX = os.environ.get('ASSET_STORE_PREFIX', '_assets/')
+ASSET_STORE_MIN_BYTES = int(os.environ.get('ASSET_STORE_MIN_BYTES', 16 * 1024))
+
+# 'download' publishes by downloading and re-uploading the submission tarball.
+# 'copy' also stores each converted submission as objects under {submission_id}/ in
+# OUT_BUCKET_SUB_ID, and publish copies them server side, transferring only the html.
+# That uploads every conversion twice, so it only pays where most submissions publish.
+PUBLISH_MODE = os.environ.get('PUBLISH_MODE', 'download')
+
+# Seconds a published (submission_id, paper_id, version) drops redeliveries before the DB check
+PUBLISH_DEDUP_TTL = float(os.environ.get('PUBLISH_DEDUP_TTL', 3600))
+
+# Warm latexmls daemons per gunicorn worker, 0 runs a cold latexmlc per paper
+LATEXML_POOL_SIZE = int(os.environ.get('LATEXML_POOL_SIZE', 0))
+LATEXML_POOL_MAX_JOBS = int(os.environ.get('LATEXML_POOL_MAX_JOBS', 50))
+LATEXML_POOL_MAX_RSS_MB = int(os.environ.get('LATEXML_POOL_MAX_RSS_MB', 2048))
+LATEXML_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('LATEXML_POOL_CHECKOUT_TIMEOUT', 30))
+
+# 'download' writes the source .tar.gz to disk before extracting it,
+# 'stream' extracts it while it downloads
+INGEST_MODE = os.environ.get('INGEST_MODE', 'download')
+
+# 'soup' parses the html with BeautifulSoup, 'stream' rewrites
+# anchors, the base tag and the watermark in one streaming pass
+HTML_REWRITE_MODE = os.environ.get('HTML_REWRITE_MODE', 'soup')
+
 FASTLY_PURGE_KEY = os.environ.get('FASTLY_PURGE_KEY', 'no-key-dev')
+# Seconds to wait on Fastly for each purge, and tries per purge
+FASTLY_PURGE_TIMEOUT = float(os.environ.get('FASTLY_PURGE_TIMEOUT', 5))
+FASTLY_PURGE_ATTEMPTS = int(os.environ.get('FASTLY_PURGE_ATTEMPTS', 3))
+# With a service id, abs pages are purged by the surrogate key they are tagged with
+FASTLY_SERVICE_ID = os.environ.get('FASTLY_SERVICE_ID')
+FASTLY_ABS_SURROGATE_KEY = os.environ.get('FASTLY_ABS_SURROGATE_KEY', 'abs-{paper_id}')
+FASTLY_API_URL = os.environ.get('FASTLY_API_URL', 'https://api.fastly.com')
+# 'queue' coalesces the purges of publishes over FASTLY_PURGE_WINDOW seconds
+# or FASTLY_PURGE_BATCH_SIZE papers, 'direct' purges within each publish
+FASTLY_PURGE_MODE = os.environ.get('FASTLY_PURGE_MODE', 'queue')
+FASTLY_PURGE_WINDOW = float(os.environ.get('FASTLY_PURGE_WINDOW', 1.5))
+FASTLY_PURGE_BATCH_SIZE = int(os.environ.get('FASTLY_PURGE_BATCH_SIZE', 256))
+# Failed purges are saved here and retried every interval, up to max times
+FASTLY_PURGE_RETRY_DIR = os.environ.get('FASTLY_PURGE_RETRY_DIR', '/arxiv/purge-retry')
+FASTLY_PURGE_RETRY_INTERVAL = float(os.environ.get('FASTLY_PURGE_RETRY_INTERVAL', 30))
+FASTLY_PURGE_RETRY_MAX = int(os.environ.get('FASTLY_PURGE_RETRY_MAX', 10))
+# Seconds after which a retry file claimed by a worker that never finished
+# it, because it crashed or was stopped, is returned for another to retry
+FASTLY_PURGE_CLAIM_TIMEOUT = float(os.environ.get('FASTLY_PURGE_CLAIM_TIMEOUT', 600))
 IS_DEV = os.environ.get('IS_DEV', True)
 
 LOCK_DIR = '/arxiv/locks'
\ No newline at end of file
@@ -12,16 +12,32 @@ from typing import (
 import logging
 import traceback
 import uuid
-from bs4 import BeautifulSoup
 
 from flask import current_app
 
 from .licenses import get_license_for_paper, get_license_for_submission
+from .postprocess import (
+    PostProcessor,
+    base_tag,
+    base_tag_html,
+    missing_package_warning,
+    license_section,
+    page_content_prefix_html,
+    absolute_anchors_for_submission,
+    submission_href
+)
+from .rewrite import StreamRewriter, stream_rewrite_enabled
+from .latexml_pool import get_latexml_pool, flags_to_options, LATEXMLS_FATAL
 from ..util import untar, id_lock, unzip_single_file
-from ..buckets.util import get_google_storage_client
+from ..buckets import util as bucket_util
 from ..buckets import (
-    download_blob,
+    download_blob_with_checksum,
+    extract_blob,
+    blob_generation,
+    blob_metadata,
     upload_dir_to_gcs,
+    upload_file_to_gcs,
+    upload_objects_to_gcs,
     upload_tar_to_gcs
 )
 from ..models.db import db
@@ -29,12 +45,15 @@ from ..exceptions import *
 from .concurrency_control import (
     write_start,
     write_success,
-    write_failure
+    write_failure,
+    write_postprocessed,
+    get_conversion_row
 )
+from .planner import plan_conversion, Plan, SKIP, REPOSTPROCESS
 
 logger = logging.getLogger()
 
-def process(id: str, blob: str, bucket: str, single_file: bool) -> bool:
+def process(id: str, blob: str, bucket: str, single_file: bool, force: bool = False) -> None:
     is_submission = bucket == current_app.config['IN_BUCKET_SUB_ID']
 
     """ File system we will be using """
@@ -43,8 +62,17 @@ def process(id: str, blob: str, bucket: str, single_file: bool) -> bool:
     src_dir = f'extracted/{id}' # the directory we untar the blob to
     bucket_dir_container = f'{src_dir}/html' # the directory we will upload the *contents* of
     outer_bucket_dir = f'{bucket_dir_container}/{id}' # the highest level directory that will appear in the out bucket
+    converting = False # Nothing to clean up until the conversion starts
 
     try:
+        # Nothing is downloaded for sources already converted this way
+        plan = plan_conversion(id, bucket, blob, is_submission, force)
+        if plan.decision == SKIP:
+            return
+        if plan.decision == REPOSTPROCESS and repostprocess(id, is_submission):
+            return
+
+        converting = True
         with id_lock(id, current_app.config['LOCK_DIR']):
 
             try:
@@ -54,28 +82,36 @@ def process(id: str, blob: str, bucket: str, single_file: bool) -> bool:
                 os.makedirs(outer_bucket_dir)
                 # Abort if this fails
 
-            # Check file format and download to ./[{id}.tar.gz]
+            # Check file format and download to ./[{id}.tar.gz],
+            # or in stream mode straight into ./extracted/id/
             try:
-                logger.info(f"{id}: Download")
-                download_blob(bucket, blob, download_file)
+                if stream_ingest_enabled():
+                    logger.info(f"{id}: Download and extract")
+                    tex_checksum, source_generation = extract_blob(
+                        bucket, blob, src_dir, f'{safe_name}.tex' if single_file else None)
+                else:
+                    logger.info(f"{id}: Download")
+                    tex_checksum, source_generation = download_blob_with_checksum(bucket, blob, download_file)
             except:
                 logger.warning(f'{id}: Failed to download', exc_info=1)
                 return
 
             # Write to DB that process has started
             logger.info(f"{id}: Write start process to db")
-            write_start(id, download_file, is_submission)
+            write_start(id, tex_checksum, source_generation, is_submission,
+                        _planned_md5(plan, source_generation))
 
             # Untar file ./[tar] to ./extracted/id/
-            if not single_file:
-                logger.info(f"{id}: Untar")
-                untar (download_file, src_dir)
-            else:
-                logger.info(f"{id}: Ungzip")
-                try:
-                    unzip_single_file(download_file, src_dir)
-                except Exception as e:
-                    logger.warning (f'{id}: Ungzip error', exc_info=1)
+            if not stream_ingest_enabled():
+                if not single_file:
+                    logger.info(f"{id}: Untar")
+                    untar (download_file, src_dir)
+                else:
+                    logger.info(f"{id}: Ungzip")
+                    try:
+                        unzip_single_file(download_file, src_dir)
+                    except Exception as e:
+                        logger.warning (f'{id}: Ungzip error', exc_info=1)
 
             # Remove .ltxml files from [source] (./extracted/id/)
             logger.info(f"{id}: Remove .ltxml")
@@ -92,46 +128,140 @@ def process(id: str, blob: str, bucket: str, single_file: bool) -> bool:
             if is_submission:
                 logger.info(f"{id}: Upload raw LaTeXML output to GCS")
                 upload_tar_to_gcs(id, bucket_dir_container, current_app.config['RAW_LATEXML_SUBMISSION'], f'{bucket_dir_container}/{id}.tar.gz')
+            else:
+                logger.info(f"{id}: Upload raw LaTeXML output to GCS")
+                upload_raw_doc_output(id, bucket_dir_container, f'{src_dir}/{id}.raw.tar.gz')
 
             if missing_packages:
                 logger.info(f"{id}: Missing packages {str(missing_packages)}")
-                insert_missing_package_warning(f'{outer_bucket_dir}/{id}.html', missing_packages)
 
             try:
-                logger.info(f'{id}: Insert license')
-                insert_license(f'{outer_bucket_dir}/{id}.html', id, is_submission, missing_packages)
+                logger.info(f'{id}: Get license')
+                license = get_license(id, is_submission)
             except Exception as e:
-                logger.warning(f'{id}: Insert license failed', exc_info=1)
-                return 
+                logger.warning(f'{id}: Get license failed', exc_info=1)
+                return
 
-            if is_submission: 
-                logger.info(f'{id}: Insert absolute anchor tags')
-                insert_absolute_anchors_for_submission(f'{outer_bucket_dir}/{id}.html', id)
+            logger.info(f'{id}: Post process html')
+            postprocess_html(f'{outer_bucket_dir}/{id}.html', id, is_submission, license, missing_packages)
 
             logger.info(f"{id}: Upload html")
             if is_submission:
                 upload_tar_to_gcs(id, bucket_dir_container, current_app.config['OUT_BUCKET_SUB_ID'], f'{bucket_dir_container}/{id}.tar.gz')
+                if current_app.config['PUBLISH_MODE'] == 'copy':
+                    # For publish to copy server side
+                    upload_objects_to_gcs(id, bucket_dir_container, current_app.config['OUT_BUCKET_SUB_ID'])
             else:
-                insert_base_tag(f'{outer_bucket_dir}/{id}.html', id)
                 upload_dir_to_gcs(bucket_dir_container, current_app.config['OUT_BUCKET_ARXIV_ID'])
 
             # TODO: Maybe remove for batch
-            download_blob(bucket, blob, download_file) # download again to double check for most recent tex source
-            write_success(id, download_file, is_submission)
+            # check the blob's generation again for most recent tex source
+            write_success(id, blob_generation(bucket, blob), is_submission)
     except Exception as e:
+        if not converting:
+            # Planning failed, which says nothing about the conversion
+            logger.warning(f'{id}: Failed to plan conversion', exc_info=1)
+            return
         logger.info(f'{id}: Conversion unsuccessful', exc_info=1)
         try:
-            download_blob(bucket, blob, download_file)
-            write_failure(id, download_file, is_submission)
+            write_failure(id, blob_generation(bucket, blob), is_submission)
         except Exception as e:
             logger.warning(f'{id}: Failed to write failure', exc_info=1)
     finally:
-        try:
-            with id_lock(id, current_app.config['LOCK_DIR'], 1):
-                _clean_up(download_file, id)
-        except Exception as e:
-            logger.warning(f"{id}: Failed to clean up lock and dir", exc_info=1)
+        if converting:
+            try:
+                with id_lock(id, current_app.config['LOCK_DIR'], 1):
+                    _clean_up(download_file, id)
+            except Exception as e:
+                logger.warning(f"{id}: Failed to clean up lock and dir", exc_info=1)
+
 
+def repostprocess (id: str, is_submission: bool) -> bool:
+    """
+    Post processes id's stored raw LaTeXML output again without
+    running LaTeXML, then replaces the converted html: the whole
+    tarball (and stored html object) for a submission, only
+    {id}/{id}.html for a document.
+
+    Returns
+    -------
+    bool
+        Whether the html was replaced. False if the conversion
+        isn't a success or its raw output wasn't kept, for the
+        caller to convert in full instead.
+    """
+    raw_bucket = current_app.config['RAW_LATEXML_SUBMISSION' if is_submission else 'RAW_LATEXML_DOC']
+    src_dir = f'extracted/{id}'
+    bucket_dir_container = f'{src_dir}/html'
+    html_file = f'{bucket_dir_container}/{id}/{id}.html'
+    try:
+        with id_lock(id, current_app.config['LOCK_DIR']):
+            row = get_conversion_row(id, is_submission)
+            if not raw_bucket or row is None or row.conversion_status != 1 \
+                    or row.latexml_version != current_app.config['LATEXML_COMMIT'] \
+                    or blob_metadata(raw_bucket, f'{id}.tar.gz') is None:
+                logger.info(f'{id}: Nothing to re-post-process')
+                return False
+            source_generation = row.source_generation
+            try:
+                shutil.rmtree(src_dir, ignore_errors=True)
+                os.makedirs(bucket_dir_container)
+                logger.info(f'{id}: Download raw LaTeXML output')
+                extract_blob(raw_bucket, f'{id}.tar.gz', bucket_dir_container)
+
+                qa_bucket = current_app.config['QA_BUCKET_SUB' if is_submission else 'QA_BUCKET_DOC']
+                qa_blob = blob_metadata(qa_bucket, f'{id}_stdout.txt')
+                missing_packages = _list_missing_packages(qa_blob.download_as_text()) if qa_blob else None
+
+                logger.info(f'{id}: Post process html')
+                postprocess_html(html_file, id, is_submission, get_license(id, is_submission), missing_packages)
+
+                logger.info(f'{id}: Upload html')
+                if is_submission:
+                    upload_tar_to_gcs(id, bucket_dir_container, current_app.config['OUT_BUCKET_SUB_ID'], f'{src_dir}/{id}.tar.gz')
+                    if current_app.config['PUBLISH_MODE'] == 'copy':
+                        upload_file_to_gcs(html_file, current_app.config['OUT_BUCKET_SUB_ID'], f'{id}/{id}.html')
+                else:
+                    upload_file_to_gcs(html_file, current_app.config['OUT_BUCKET_ARXIV_ID'], f'{id}/{id}.html')
+                return write_postprocessed(id, source_generation, is_submission)
+            finally:
+                shutil.rmtree(src_dir, ignore_errors=True)
+    except Exception as e:
+        logger.warning(f'{id}: Re-post-process failed', exc_info=1)
+        return False
+
+def postprocess_html (fpath: str, id: str, is_submission: bool, license: str,
+                      missing_packages: Optional[List[str]]) -> None:
+    """
+    Applies the post processing of a conversion to the raw LaTeXML
+    output at fpath: the missing package warning, the license and
+    the submission anchors or document base tag, in one streaming
+    pass when HTML_REWRITE_MODE is 'stream'.
+    """
+    if stream_rewrite_enabled():
+        rewriter = StreamRewriter(fpath) \
+            .prepend_to_class('ltx_page_content', page_content_prefix_html(license, missing_packages))
+        if is_submission:
+            VIEW_SUB_BASE = current_app.config['VIEW_SUB_BASE']
+            rewriter.rewrite_ltx_refs(lambda href: submission_href(href, id, VIEW_SUB_BASE))
+        else:
+            rewriter.append_to_head(base_tag_html(id))
+        rewriter.run()
+        return
+    postprocessor = PostProcessor(fpath)
+    if missing_packages:
+        postprocessor.register(missing_package_warning, missing_packages)
+    postprocessor.register(license_section, license, missing_packages)
+    if is_submission:
+        postprocessor.register(absolute_anchors_for_submission, id, current_app.config['VIEW_SUB_BASE'])
+    else:
+        postprocessor.register(base_tag, id)
+    postprocessor.run()
+
+def upload_raw_doc_output (id: str, src_dir: str, tar_fpath: str) -> None:
+    """ Keeps a document's LaTeXML output before post processing, if RAW_LATEXML_DOC is set """
+    if current_app.config['RAW_LATEXML_DOC']:
+        upload_tar_to_gcs(id, src_dir, current_app.config['RAW_LATEXML_DOC'], tar_fpath)
 
 def remove_ltxml(path: str) -> None:
     """
@@ -248,119 +378,64 @@ def do_latexml(main_fpath: str, out_dpath: str, sub_id: str, is_submission: bool
                       f"--javascript={LATEXML_URL_BASE}/js/feedbackOverlay.js",
                       "--navigationtoc=context",
                       f"--source={main_fpath}", f"--dest={out_dpath}/{sub_id}.html"]
-    completed_process = subprocess.run(
-        latexml_config,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        check=True,
-        text=True,
-        timeout=500)
+    stdout = _run_latexml(latexml_config)
     errpath = os.path.join(os.getcwd(), f"{sub_id}_stdout.txt")
     with open(errpath, "w") as f:
-        f.write(completed_process.stdout)
+        f.write(stdout)
     try:
         if is_submission:
-            bucket = get_google_storage_client().bucket(current_app.config['QA_BUCKET_SUB'])
+            bucket = bucket_util.get_google_storage_client().bucket(current_app.config['QA_BUCKET_SUB'])
         else:
-            bucket = get_google_storage_client().bucket(current_app.config['QA_BUCKET_DOC'])
+            bucket = bucket_util.get_google_storage_client().bucket(current_app.config['QA_BUCKET_DOC'])
         errblob = bucket.blob(f"{sub_id}_stdout.txt")
         errblob.upload_from_filename(f"{sub_id}_stdout.txt")
     except Exception as exc:
         raise GCPBlobError(
             f"Uploading {sub_id}_stdout.txt to {current_app.config['QA_BUCKET_SUB'] if is_submission else current_app.config['QA_BUCKET_DOC']} failed in do_latexml") from exc
     os.remove(errpath)
-    return _list_missing_packages(completed_process.stdout)
-
-def insert_base_tag (fpath: str, id: str) -> None:
-    """ This inserts the base tag into the html so we can use the /html/arxiv_id url """
-    base_html = f'<base href="/html/{id}/">'
-
-    with open(fpath, 'r+') as html:
-        soup = BeautifulSoup(html.read(), 'html.parser')
-        soup.head.append(BeautifulSoup(base_html, 'html.parser'))
-        html.truncate(0)
-        html.seek(0)
-        html.write(str(soup))
-
-def replace_absolute_anchors_for_doc (fpath: str, id: str) -> None:
-    HREF_RE = re.compile(r'\/html\/submission\/\d+\/view#.+')
-    VIEW_DOC_BASE = current_app.config['VIEW_DOC_BASE']
-    with open(fpath, 'r+') as html:
-        soup = BeautifulSoup(html.read(), 'html.parser')
-        for a in soup.find_all('a', attrs={'class': 'ltx_ref'}):
-            if a.get('href') and re.search(HREF_RE, a['href']) is not None:
-                relative_anchor = a['href'].split('/view')[1]
-                a['href'] = f'{VIEW_DOC_BASE}/html/{id}{relative_anchor}'
-            elif a.get('href') and a['href'][0] == '#':
-                a['href'] = f'{VIEW_DOC_BASE}/html/{id}{a["href"]}'
-            html.truncate(0)
-            html.seek(0)
-            html.write(str(soup))
-
-def insert_absolute_anchors_for_submission (fpath: str, sub_id: int) -> None:
-    VIEW_SUB_BASE = current_app.config['VIEW_SUB_BASE']
-    with open(fpath, 'r+') as html:
-        soup = BeautifulSoup(html.read(), 'html.parser')
-        for a in soup.find_all('a', attrs={'class': 'ltx_ref'}):
-            if a.get('href') and a['href'][0] == '#':
-                a['href'] = f'{VIEW_SUB_BASE}/html/submission/{sub_id}/view{a["href"]}'
-        html.truncate(0)
-        html.seek(0)
-        html.write(str(soup))
-
-def insert_missing_package_warning (fpath: str, missing_packages: List[str]) -> None:
-    """ This is the HTML for the closeable pop up warning for missing packages """
-    missing_packages_lis = "\n".join(map(lambda x: f"<li>failed: {x}</li>", missing_packages))
-    popup_html = f"""
-        <div class="package-alerts ltx_document" role="status" aria-label="Conversion errors have been found">
-            <button aria-label="Dismiss alert" onclick="closePopup()">
-                <span aria-hidden="true"><svg role="presentation" width="20" height="20" viewBox="0 0 44 44" aria-hidden="true" focusable="false">
-                <path d="M0.549989 4.44999L4.44999 0.549988L43.45 39.55L39.55 43.45L0.549989 4.44999Z" />
-                <path d="M39.55 0.549988L43.45 4.44999L4.44999 43.45L0.549988 39.55L39.55 0.549988Z" />
-                </svg></span>
-            </button>
-            <p>HTML conversions <a href="https://info.dev.arxiv.org/about/accessibility_html_error_messages.html" target="_blank">sometimes display errors</a> due to content that did not convert correctly from the source. This paper uses the following packages that are not yet supported by the HTML conversion tool. Feedback on these issues are not necessary; they are known and are being worked on.</p>
-                <ul arial-label="Unsupported packages used in this paper">
-                    {missing_packages_lis}
-                </ul>
-            <p>Authors: achieve the best HTML results from your LaTeX submissions by following these <a href="https://info.arxiv.org/help/submit_latex_best_practices.html" target="_blank">best practices</a>.</p>
-        </div>
-
-        <script>
-            function closePopup() {{
-                document.querySelector('.package-alerts').style.display = 'none';
-            }}
-        </script>
-        """
-    with open(fpath, 'r+') as html:
-        soup = BeautifulSoup(html.read(), 'html.parser')
-        soup.find('div', attrs={'class': 'ltx_page_content'}).insert(0, BeautifulSoup(popup_html, 'html.parser'))
-        html.truncate(0)
-        html.seek(0)
-        html.write(str(soup))
-
-def insert_license (fpath: str, id: str, is_submission: bool, is_missing_packages: Optional[List]):
+    return _list_missing_packages(stdout)
+
+def _run_latexml (latexml_config: List[str]) -> str:
+    """
+    Runs the conversion on a warm latexmls worker if the pool is
+    enabled, falling back to a cold latexmlc process if the pool
+    can't take the job. Returns the conversion log.
+    """
+    pool = get_latexml_pool()
+    if pool is not None:
+        try:
+            log, status_code = pool.convert(flags_to_options(latexml_config[1:]), timeout=500)
+            if status_code >= LATEXMLS_FATAL:
+                raise subprocess.CalledProcessError(status_code, 'latexmls', output=log)
+            return log
+        except LaTeXMLPoolError:
+            logger.warning('LaTeXML pool unavailable, falling back to latexmlc', exc_info=1)
+    completed_process = subprocess.run(
+        latexml_config,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        check=True,
+        text=True,
+        timeout=500)
+    return completed_process.stdout
+
+def get_license (id: str, is_submission: bool) -> str:
     if not is_submission:
         paper_id, version = id.split('v')
-        license = get_license_for_paper(paper_id, int(version))
-    else:
-        license = get_license_for_submission(int(id))
-    license_html = BeautifulSoup(f'<div id="license-tr">{license}</div>', 'html.parser')
-    with open(fpath, 'r+') as html:
-        soup = BeautifulSoup(html.read(), 'html.parser')
-        target_section = soup.new_tag('div', attrs={'class': 'section', 'id': 'target-section'})
-        document_wrapper = soup.find('div', attrs={'class': 'ltx_page_content'})
-        if is_missing_packages:
-            document_wrapper \
-                .find('div', attrs={'class': ['package-alerts', 'ltx_document']}) \
-                .insert_after(target_section)
-        else:
-            document_wrapper.insert(0, target_section)
-        target_section.append(license_html)
-        html.truncate(0)
-        html.seek(0)
-        html.write(str(soup))
+        return get_license_for_paper(paper_id, int(version))
+    return get_license_for_submission(int(id))
+
+def _planned_md5 (plan: Plan, source_generation: Optional[int]) -> Optional[str]:
+    """ The planned source's md5, if that is the generation that was downloaded """
+    if plan.blob is not None and plan.blob.generation == source_generation:
+        return plan.source_md5
+    return None
+
+def stream_ingest_enabled () -> bool:
+    return current_app.config['INGEST_MODE'] == 'stream'
 
 def _clean_up (tar, id):
-    os.remove(tar)
+    # Never written in stream mode
+    if os.path.exists(tar):
+        os.remove(tar)
     shutil.rmtree(f'extracted/{id}')
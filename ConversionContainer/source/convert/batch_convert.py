@@ -7,29 +7,30 @@ import traceback
 from flask import current_app
 
 from ..util import untar, id_lock
-from ..buckets import download_blob, upload_dir_to_gcs
+from ..buckets import download_blob_with_checksum, extract_blob, upload_dir_to_gcs
 from ..exceptions import *
 from .concurrency_control import (
     write_start, 
     write_success, 
-    write_failure,
-    has_doc_been_tried
+    write_failure
 )
+from .planner import plan_conversion, SKIP, REPOSTPROCESS
 from . import (
     remove_ltxml, 
     find_main_tex_source, 
     do_latexml,
-    insert_missing_package_warning,
-    insert_base_tag,
-    _clean_up
+    stream_ingest_enabled,
+    _clean_up,
+    _planned_md5,
+    repostprocess,
+    postprocess_html,
+    get_license,
+    upload_raw_doc_output
 )
 
 logger = logging.getLogger()
 
-def batch_process(id: str, new_id: bool, blob: str, bucket: str) -> bool:
-
-    if has_doc_been_tried(id):
-        return
+def batch_process(id: str, new_id: bool, blob: str, bucket: str) -> None:
 
     is_submission = False
 
@@ -39,8 +40,18 @@ def batch_process(id: str, new_id: bool, blob: str, bucket: str) -> bool:
     src_dir = f'extracted/{id}' # the directory we untar the blob to
     bucket_dir_container = f'{src_dir}/html' # the directory we will upload the *contents* of
     outer_bucket_dir = f'{bucket_dir_container}/{id}' # the highest level directory that will appear in the out bucket
+    source_generation = None
+    converting = False # Nothing to clean up until the conversion starts
 
     try:
+        # Only papers whose source, LaTeXML or post processing changed are redone
+        plan = plan_conversion(id, bucket, blob, is_submission, batch=True)
+        if plan.decision == SKIP:
+            return
+        if plan.decision == REPOSTPROCESS and repostprocess(id, is_submission):
+            return
+
+        converting = True
         with id_lock(id, current_app.config['LOCK_DIR']):
 
             try:
@@ -50,10 +61,14 @@ def batch_process(id: str, new_id: bool, blob: str, bucket: str) -> bool:
                 os.makedirs(outer_bucket_dir)
                 # Abort if this fails
             
-            # Check file format and download to ./[{id}.tar.gz]
+            # Check file format and download to ./[{id}.tar.gz],
+            # or in stream mode straight into ./extracted/id/
             try:
                 logger.info(f"Step 1: Download {id}")
-                download_blob(bucket, blob, tar_gz)
+                if stream_ingest_enabled():
+                    tex_checksum, source_generation = extract_blob(bucket, blob, src_dir)
+                else:
+                    tex_checksum, source_generation = download_blob_with_checksum(bucket, blob, tar_gz)
             except:
                 logger.info(f'Failed to download {id}')
                 traceback.print_exc()
@@ -61,11 +76,13 @@ def batch_process(id: str, new_id: bool, blob: str, bucket: str) -> bool:
             
             # Write to DB that process has started
             logger.info(f"Write start process to db")
-            write_start(id, tar_gz, is_submission)
+            write_start(id, tex_checksum, source_generation, is_submission,
+                        _planned_md5(plan, source_generation))
     
             # Untar file ./[tar] to ./extracted/id/
-            logger.info(f"Step 2: Untar {id}")
-            untar (tar_gz, src_dir)
+            if not stream_ingest_enabled():
+                logger.info(f"Step 2: Untar {id}")
+                untar (tar_gz, src_dir)
 
             # Remove .ltxml files from [source] (./extracted/id/)
             logger.info(f"Step 3: Remove .ltxml for {id}")
@@ -78,28 +95,33 @@ def batch_process(id: str, new_id: bool, blob: str, bucket: str) -> bool:
             # Run LaTeXML on main and output to ./extracted/id/html/id
             logger.info(f"Step 5: Do LaTeXML for {id}")
             missing_packages = do_latexml(main, outer_bucket_dir, id, False)
+            upload_raw_doc_output(id, bucket_dir_container, f'{src_dir}/{id}.raw.tar.gz')
 
+            # Post process html the same way as process and repostprocess
             if missing_packages:
                 logger.info(f"Missing the following packages: {str(missing_packages)}")
-                insert_missing_package_warning(f'{outer_bucket_dir}/{id}.html', missing_packages)
-
-            insert_base_tag(f'{outer_bucket_dir}/{id}.html', id)
+            postprocess_html(f'{outer_bucket_dir}/{id}.html', id, is_submission,
+                             get_license(id, is_submission), missing_packages)
 
-            # Post process html
             logger.info(f"Step 6: Upload html for {id}")            
             upload_dir_to_gcs(bucket_dir_container, current_app.config['OUT_BUCKET_ARXIV_ID'])
             
-            write_success(id, tar_gz, is_submission)
+            write_success(id, source_generation, is_submission)
     except:
+        if not converting:
+            # Planning failed, which says nothing about the conversion
+            logger.warning(f'Failed to plan conversion of {id}', exc_info=1)
+            return
         logger.info(f'Conversion unsuccessful')
         traceback.print_exc()
         try:
-            write_failure(id, tar_gz, is_submission)
+            write_failure(id, source_generation, is_submission)
         except Exception as e:
             logger.info(f'Failed to write failure for {id} with {e}')
     finally:
-        try:
-            with id_lock(id, current_app.config['LOCK_DIR'], 1):
-                _clean_up(tar_gz, id)
-        except Exception as e:
-            logger.info(f"Failed to clean up {id} with {e}")
+        if converting:
+            try:
+                with id_lock(id, current_app.config['LOCK_DIR'], 1):
+                    _clean_up(tar_gz, id)
+            except Exception as e:
+                logger.info(f"Failed to clean up {id} with {e}")
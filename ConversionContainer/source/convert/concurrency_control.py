@@ -1,7 +1,5 @@
-from typing import Any, Optional, Tuple
-import hashlib
+from typing import Any, Optional, Tuple, Union
 import os
-import gzip
 import logging
 from flask import current_app
 
@@ -9,23 +7,18 @@ from google.cloud.storage.blob import Blob
 
 from ..exceptions import DBConnectionError
 from ..models.db import DBLaTeXMLDocuments, DBLaTeXMLSubmissions, db
-from ..models.util import transaction, now, database_retry
+from ..models.util import transaction, unit_of_work, now, database_retry
 
 logger = logging.getLogger()
 
 def _latexml_commit (): return current_app.config['LATEXML_COMMIT']
 
+def _postprocess_version (): return current_app.config['POSTPROCESS_VERSION']
+
 def _get_id_version (paper_idv: str) -> Tuple[str, int]:
     parts = paper_idv.split('v')
     return parts[0], int(parts[1])
 
-def _get_checksum (abs_fname: str) -> str:
-    md5_hash = hashlib.md5()
-    with gzip.open(abs_fname, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            md5_hash.update(byte_block)
-    return md5_hash.hexdigest()
-
 def has_doc_been_tried (paper_idv: str) -> bool:
     paper_id, document_version = _get_id_version (paper_idv)
     rec = db.session.query(DBLaTeXMLDocuments) \
@@ -35,7 +28,24 @@ def has_doc_been_tried (paper_idv: str) -> bool:
     return rec is not None
 
 @database_retry(5)
-def _write_start_doc (paper_idv: str, tar_fpath: str):
+def get_conversion_row (id: Any, is_submission: bool) -> Optional[Union[DBLaTeXMLSubmissions, DBLaTeXMLDocuments]]:
+    """ The arXiv_latexml_sub row of submission id, or arXiv_latexml_doc row of paper_idv id """
+    try:
+        if is_submission:
+            return db.session.query(DBLaTeXMLSubmissions) \
+                .filter(DBLaTeXMLSubmissions.submission_id == int(id)) \
+                .first()
+        paper_id, document_version = _get_id_version(id)
+        return db.session.query(DBLaTeXMLDocuments) \
+            .filter(DBLaTeXMLDocuments.paper_id == paper_id) \
+            .filter(DBLaTeXMLDocuments.document_version == document_version) \
+            .first()
+    except Exception as e:
+        raise DBConnectionError from e
+
+@database_retry(5)
+def _write_start_doc (paper_idv: str, tex_checksum: str, source_generation: int,
+                      source_md5: Optional[str]):
     paper_id, document_version = _get_id_version (paper_idv)
     try:
         with transaction() as session:
@@ -49,20 +59,27 @@ def _write_start_doc (paper_idv: str, tar_fpath: str):
                     document_version=document_version,
                     conversion_status=0, # 0 for in progress, 1 for success, 2 for failure
                     latexml_version=_latexml_commit(),
-                    tex_checksum=_get_checksum(tar_fpath),
+                    tex_checksum=tex_checksum,
+                    source_generation=source_generation,
+                    source_md5=source_md5,
+                    postprocess_version=_postprocess_version(),
                     conversion_start_time=now()
                 )
                 session.add(rec)
             else:
                 rec.conversion_status = 0
                 rec.latexml_version = _latexml_commit()
-                rec.tex_checksum = _get_checksum(tar_fpath)
+                rec.tex_checksum = tex_checksum
+                rec.source_generation = source_generation
+                rec.source_md5 = source_md5
+                rec.postprocess_version = _postprocess_version()
                 rec.conversion_start_time = now()
     except Exception as e:
         raise DBConnectionError from e
 
 @database_retry(5)
-def _write_start_sub (submission_id: int, tar_fpath: str):
+def _write_start_sub (submission_id: int, tex_checksum: str, source_generation: int,
+                      source_md5: Optional[str]):
     try:
         with transaction() as session:
             rec = session.query(DBLaTeXMLSubmissions) \
@@ -73,117 +90,91 @@ def _write_start_sub (submission_id: int, tar_fpath: str):
                     submission_id=submission_id,
                     conversion_status=0, # 0 for in progress, 1 for success, 2 for failure
                     latexml_version=_latexml_commit(),
-                    tex_checksum=_get_checksum(tar_fpath),
+                    tex_checksum=tex_checksum,
+                    source_generation=source_generation,
+                    source_md5=source_md5,
+                    postprocess_version=_postprocess_version(),
                     conversion_start_time=now()
                 )
                 session.add(rec)
             else:
                 rec.conversion_status = 0
                 rec.latexml_version = _latexml_commit()
-                rec.tex_checksum = _get_checksum(tar_fpath)
+                rec.tex_checksum = tex_checksum
+                rec.source_generation = source_generation
+                rec.source_md5 = source_md5
+                rec.postprocess_version = _postprocess_version()
                 rec.conversion_start_time = now()
     except Exception as e:
         raise DBConnectionError from e
 
 
-def write_start (id: Any, tar_fpath: str, is_submission: bool):
+def write_start (id: Any, tex_checksum: str, source_generation: int, is_submission: bool,
+                 source_md5: Optional[str] = None):
+    """ source_md5 is the GCS md5 of the source at source_generation, if known """
     if is_submission:
-        _write_start_sub(int(id), tar_fpath)
+        _write_start_sub(int(id), tex_checksum, source_generation, source_md5)
     else:
-        _write_start_doc(id, tar_fpath)
-
-@database_retry(5)
-def _write_success_doc (paper_idv: str, tar_fpath: str) -> bool:
-    paper_id, document_version = _get_id_version (paper_idv)
-    success = False
-    try:
-        with transaction() as session:
-            obj = session.query(DBLaTeXMLDocuments) \
-                    .filter(DBLaTeXMLDocuments.paper_id == paper_id) \
-                    .filter(DBLaTeXMLDocuments.document_version == document_version) \
-                    .all()
-            if len(obj) > 0:
-                obj = obj[0]
-                if obj.tex_checksum == _get_checksum(tar_fpath) and \
-                    obj.latexml_version == _latexml_commit() and \
-                    obj.conversion_status != 1:
-                        obj.conversion_status = 1
-                        obj.conversion_end_time = now()
-                        success = True
-                        logger.info(f"document {paper_id}v{document_version} successfully written")
-    except Exception as e:
-        raise DBConnectionError from e
-    if not success:
-        logger.info(f"document {paper_id}v{document_version} failed to write")
-    return success
+        _write_start_doc(id, tex_checksum, source_generation, source_md5)
 
-@database_retry(5)
-def _write_success_sub (submission_id: int, tar_fpath: str) -> bool:
-    success = False
-    try:
-        with transaction() as session:
-            obj = session.query(DBLaTeXMLSubmissions) \
-                    .filter(int(submission_id) == DBLaTeXMLSubmissions.submission_id) \
-                    .all()
-            if len(obj) > 0:
-                obj = obj[0]
-                if obj.tex_checksum == _get_checksum(tar_fpath) and \
-                    obj.latexml_version == _latexml_commit() and \
-                    obj.conversion_status != 1:
-                        obj.conversion_status = 1
-                        obj.conversion_end_time = now()
-                        success = True
-                        logger.info(f"{submission_id}: Successfully written")
-    except Exception as e:
-        raise DBConnectionError from e
-    if not success:
-        logger.info(f"{submission_id}: Failed to write")
-    return success
+def _model (is_submission: bool) -> Any:
+    return DBLaTeXMLSubmissions if is_submission else DBLaTeXMLDocuments
 
-def write_success (id: int, tar_fpath: str, is_submission: bool):
+def _row_filter (id: Any, is_submission: bool) -> list:
+    """ The clauses selecting id's row of its latexml table """
     if is_submission:
-        return _write_success_sub(int(id), tar_fpath)
-    else:
-        return _write_success_doc(id, tar_fpath)
-    
-@database_retry(5)
-def _write_failure_doc (paper_idv: str, tar_fpath: str) -> bool:
-    paper_id, document_version = _get_id_version (paper_idv)
-    try:
-        with transaction() as session:
-            obj = session.query(DBLaTeXMLDocuments) \
-                    .filter(DBLaTeXMLDocuments.paper_id == paper_id) \
-                    .filter(DBLaTeXMLDocuments.document_version == document_version) \
-                    .all()
-            if len(obj) > 0:
-                obj = obj[0]
-                if obj.tex_checksum == _get_checksum(tar_fpath) and \
-                    obj.latexml_version == _latexml_commit():
-                    obj.conversion_status = 2
-                    obj.conversion_end_time = now()
-                    logger.info(f"document {paper_id}v{document_version} conversion failure written")
-    except Exception as e:
-        raise DBConnectionError from e
+        return [DBLaTeXMLSubmissions.submission_id == int(id)]
+    paper_id, document_version = _get_id_version (id)
+    return [DBLaTeXMLDocuments.paper_id == paper_id,
+            DBLaTeXMLDocuments.document_version == document_version]
 
 @database_retry(5)
-def _write_failure_sub (submission_id: int, tar_fpath: str) -> bool:
-    try:
-        with transaction() as session:
-            obj = session.query(DBLaTeXMLSubmissions) \
-                    .filter(DBLaTeXMLSubmissions.submission_id == submission_id) \
-                    .all()
-            if len(obj) > 0:
-                obj = obj[0]
-                if obj.tex_checksum == _get_checksum(tar_fpath) and \
-                    obj.latexml_version == _latexml_commit():
-                    obj.conversion_status = 2
-                    obj.conversion_end_time = now()
-                    logger.info(f"{submission_id}: Conversion failure written")
-    except Exception as e:
-        raise DBConnectionError from e
+def _transition (id: Any, source_generation: int, is_submission: bool, *where: Any, **values: Any) -> bool:
+    """
+    Applies values to id's row in one UPDATE if it is still the
+    conversion of source_generation by this LATEXML_COMMIT and
+    matches where
+    """
+    model = _model(is_submission)
+    with unit_of_work() as uow:
+        return uow.transition(
+            model,
+            *_row_filter(id, is_submission),
+            model.source_generation == source_generation,
+            model.latexml_version == _latexml_commit(),
+            *where,
+            **values)
+
+def write_success (id: int, source_generation: Optional[int], is_submission: bool):
+    if source_generation is None:
+        # The source blob is gone, or was never downloaded. Rows written
+        # before source_generation existed must not match either.
+        return False
+    success = _transition(id, source_generation, is_submission,
+                          _model(is_submission).conversion_status != 1,
+                          conversion_status=1, conversion_end_time=now())
+    logger.info(f"{id}: Successfully written" if success else f"{id}: Failed to write")
+    return success
 
-def write_failure (id: int, tar_fpath: str, is_submission: bool):
-    if is_submission:
-        return _write_failure_sub(int(id), tar_fpath)
-    else:
-        return _write_failure_doc(id, tar_fpath)
+def write_failure (id: int, source_generation: Optional[int], is_submission: bool):
+    if source_generation is None:
+        # The source blob is gone, or was never downloaded. Rows written
+        # before source_generation existed must not match either.
+        return False
+    failure = _transition(id, source_generation, is_submission,
+                          conversion_status=2, conversion_end_time=now())
+    if failure:
+        logger.info(f"{id}: Conversion failure written")
+    return failure
+
+def write_postprocessed (id: Any, source_generation: int, is_submission: bool) -> bool:
+    """
+    Records that id's html was post processed again with the
+    current POSTPROCESS_VERSION, unless it was reconverted or
+    started converting since source_generation was read
+    """
+    success = _transition(id, source_generation, is_submission,
+                          _model(is_submission).conversion_status == 1,
+                          postprocess_version=_postprocess_version())
+    logger.info(f"{id}: Post processing written" if success else f"{id}: Failed to write post processing")
+    return success
@@ -0,0 +1,172 @@
+"""Pool of warm LaTeXML daemons (latexmls) to send conversions to"""
+from typing import List, Optional, Tuple
+import atexit
+import logging
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+
+import requests
+from flask import current_app
+
+from ..exceptions import LaTeXMLPoolError
+
+logger = logging.getLogger()
+
+# latexmls status codes: 0 = ok, 1 = warnings, 2 = errors, 3 = fatal
+LATEXMLS_FATAL = 3
+
+def _free_port () -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _rss_bytes (pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def flags_to_options (flags: List[str]) -> List[Tuple[str, str]]:
+    """ Turns latexmlc command line flags (--name=value, --name) into latexmls request fields """
+    options = []
+    for flag in flags:
+        name, _, value = flag.lstrip('-').partition('=')
+        options.append((name, value))
+    return options
+
+class LaTeXMLWorker:
+    """ One latexmls process listening on its own localhost port """
+
+    def __init__ (self, command: List[str], start_timeout: float):
+        self.port = _free_port()
+        self.jobs = 0
+        self.process = subprocess.Popen(
+            [*command, f'--port={self.port}', '--expire=-1'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + start_timeout
+        while time.monotonic() < deadline:
+            if not self.alive():
+                break
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                logger.info(f'Started latexmls {self.process.pid} on port {self.port}')
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise LaTeXMLPoolError(f'latexmls failed to start on port {self.port}')
+
+    def alive (self) -> bool:
+        return self.process.poll() is None
+
+    def rss (self) -> int:
+        return _rss_bytes(self.process.pid)
+
+    def convert (self, options: List[Tuple[str, str]], timeout: float) -> Tuple[str, int]:
+        response = requests.post(f'http://127.0.0.1:{self.port}', data=options, timeout=timeout)
+        response.raise_for_status()
+        result = response.json()
+        self.jobs += 1
+        return result.get('log', ''), int(result.get('status_code', LATEXMLS_FATAL))
+
+    def stop (self) -> None:
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+class LaTeXMLPool:
+    """
+    Keeps up to size latexmls workers warm so conversions skip
+    reloading perl, the LaTeXML bindings and the --preload list.
+    Workers are started on first use and recycled after max_jobs
+    conversions, when their RSS crosses max_rss bytes or when a
+    job fails on them.
+    """
+
+    def __init__ (self, size: int, max_jobs: int, max_rss: int,
+                  checkout_timeout: float, command: Optional[List[str]] = None,
+                  start_timeout: float = 60):
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.checkout_timeout = checkout_timeout
+        self.command = command or ['latexmls']
+        self.start_timeout = start_timeout
+        # None is a slot whose worker has not been started (yet or again)
+        self.idle: queue.Queue[Optional[LaTeXMLWorker]] = queue.Queue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def _should_recycle (self, worker: LaTeXMLWorker) -> bool:
+        return not worker.alive() \
+            or worker.jobs >= self.max_jobs \
+            or worker.rss() > self.max_rss
+
+    def convert (self, options: List[Tuple[str, str]], timeout: float) -> Tuple[str, int]:
+        """ Runs one conversion on an idle worker and returns its (log, status_code) """
+        try:
+            worker = self.idle.get(timeout=self.checkout_timeout)
+        except queue.Empty as exc:
+            raise LaTeXMLPoolError('No idle latexmls worker') from exc
+        try:
+            if worker is None or not worker.alive():
+                worker = LaTeXMLWorker(self.command, self.start_timeout)
+            return worker.convert(options, timeout)
+        except requests.Timeout as exc:
+            # Same as a latexmlc timeout, falling back would just run it again
+            worker.stop()
+            worker = None
+            raise subprocess.TimeoutExpired('latexmls', timeout) from exc
+        except Exception as exc:
+            if worker:
+                worker.stop()
+            worker = None
+            raise LaTeXMLPoolError('latexmls conversion failed') from exc
+        finally:
+            if worker and self._should_recycle(worker):
+                logger.info(f'Recycling latexmls {worker.process.pid} after {worker.jobs} jobs')
+                worker.stop()
+                worker = None
+            self.idle.put(worker)
+
+    def shutdown (self) -> None:
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            if worker:
+                worker.stop()
+
+_pool: Optional[LaTeXMLPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+def get_latexml_pool () -> Optional[LaTeXMLPool]:
+    """ Returns this process's pool, or None if LATEXML_POOL_SIZE is 0 """
+    global _pool, _pool_pid
+    size = current_app.config['LATEXML_POOL_SIZE']
+    if not size:
+        return None
+    with _pool_lock:
+        # gunicorn forks workers after import, each one needs its own daemons
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = LaTeXMLPool(
+                size,
+                current_app.config['LATEXML_POOL_MAX_JOBS'],
+                current_app.config['LATEXML_POOL_MAX_RSS_MB'] * 1024 * 1024,
+                current_app.config['LATEXML_POOL_CHECKOUT_TIMEOUT'])
+            _pool_pid = os.getpid()
+            atexit.register(_pool.shutdown)
+        return _pool
@@ -0,0 +1,89 @@
+"""Decides what an incoming conversion needs before anything is downloaded"""
+from typing import Any, Dict, NamedTuple, Optional, Union
+from collections import defaultdict
+import logging
+import threading
+
+from flask import current_app
+from google.cloud.storage import Blob
+
+from ..buckets import blob_metadata
+from ..models.util import now
+from ..models.db import DBLaTeXMLDocuments, DBLaTeXMLSubmissions
+from .concurrency_control import get_conversion_row
+
+logger = logging.getLogger()
+
+SKIP = 'skip'
+CONVERT = 'convert'
+REPOSTPROCESS = 'repostprocess'
+
+class Plan (NamedTuple):
+    decision: str
+    reason: str
+    # Metadata of the source the plan was made against, None if it doesn't exist
+    blob: Optional[Blob]
+
+    @property
+    def source_md5 (self) -> Optional[str]:
+        return self.blob.md5_hash if self.blob else None
+
+_plans_lock = threading.Lock()
+_plans: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+def _decide (row: Optional[Union[DBLaTeXMLSubmissions, DBLaTeXMLDocuments]],
+             blob: Optional[Blob], force: bool, batch: bool) -> Plan:
+    if blob is None:
+        # Let the conversion fail on download as it always has
+        return Plan(CONVERT, 'no_source', blob)
+    if force:
+        return Plan(CONVERT, 'forced', blob)
+    if row is None:
+        return Plan(CONVERT, 'new', blob)
+    if batch and row.source_md5 is None and row.source_generation is None:
+        # Rows from before source metadata was recorded, and document rows
+        # publish wrote. Reconverting these would redo the whole legacy
+        # corpus and replace published html carrying its watermark and license
+        return Plan(SKIP, 'source_unknown', blob)
+    same_source = (row.source_md5 is not None and row.source_md5 == blob.md5_hash) \
+        or row.source_generation == blob.generation
+    if not same_source:
+        return Plan(CONVERT, 'source_changed', blob)
+    if row.latexml_version != current_app.config['LATEXML_COMMIT']:
+        return Plan(CONVERT, 'latexml_changed', blob)
+    if row.conversion_status == 2:
+        # Same source through the same LaTeXML fails the same way,
+        # unless the failure was transient, so retry once in a while
+        if row.conversion_end_time is not None and \
+                now() - row.conversion_end_time < current_app.config['FAILED_CONVERSION_RETRY_AFTER']:
+            return Plan(SKIP, 'failed_unchanged', blob)
+        return Plan(CONVERT, 'failed_retry', blob)
+    if row.conversion_status != 1:
+        # In progress elsewhere, or abandoned mid conversion
+        return Plan(CONVERT, 'unfinished', blob)
+    if row.postprocess_version != current_app.config['POSTPROCESS_VERSION']:
+        return Plan(REPOSTPROCESS, 'postprocess_changed', blob)
+    return Plan(SKIP, 'unchanged', blob)
+
+def plan_conversion (id: Any, bucket: str, blob_name: str,
+                     is_submission: bool, force: bool = False, batch: bool = False) -> Plan:
+    """
+    Compares the source blob's GCS metadata with the latexml row
+    for id. Skips sources converted before from the same bytes
+    with the current LATEXML_COMMIT, and for FAILED_CONVERSION_RETRY_AFTER
+    seconds those whose conversion failed, re-post-processes those
+    whose POSTPROCESS_VERSION changed and converts everything else,
+    or everything if force. In a batch, rows that don't record
+    their source are skipped rather than converted.
+    """
+    blob = blob_metadata(bucket, blob_name)
+    plan = _decide(None if force else get_conversion_row(id, is_submission), blob, force, batch)
+    with _plans_lock:
+        _plans[plan.decision][plan.reason] += 1
+    logger.info(f'{id}: Plan {plan.decision} ({plan.reason})')
+    return plan
+
+def conversion_plan_stats () -> Dict[str, Dict[str, int]]:
+    """ Decisions made in this process, by decision and reason """
+    with _plans_lock:
+        return { decision: dict(reasons) for decision, reasons in _plans.items() }
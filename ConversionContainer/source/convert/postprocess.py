@@ -0,0 +1,133 @@
+"""Single-parse post processing of LaTeXML html output"""
+from typing import (
+    Any,
+    Callable,
+    List,
+    Optional,
+    Tuple
+)
+import re
+import logging
+
+from bs4 import BeautifulSoup
+
+from ..exceptions import HTMLInjectionError
+
+logger = logging.getLogger()
+
+Transform = Callable[..., None]
+
+class PostProcessor:
+    """
+    Parses a converted html file once, applies the registered
+    transforms to the same tree in the order they were
+    registered and writes the result back once.
+
+    Transforms are functions that take the parsed
+    BeautifulSoup document as their first argument
+    and modify it in place.
+    """
+
+    def __init__ (self, fpath: str):
+        self.fpath = fpath
+        self.transforms: List[Tuple[Transform, Tuple[Any, ...]]] = []
+
+    def register (self, transform: Transform, *args: Any) -> 'PostProcessor':
+        """ Appends transform(soup, *args) to the pipeline """
+        self.transforms.append((transform, args))
+        return self
+
+    def run (self) -> None:
+        with open(self.fpath, 'r+') as html:
+            soup = BeautifulSoup(html.read(), 'html.parser')
+            for transform, args in self.transforms:
+                try:
+                    transform(soup, *args)
+                except Exception as exc:
+                    raise HTMLInjectionError(
+                        f'{transform.__name__} failed for {self.fpath}') from exc
+            html.truncate(0)
+            html.seek(0)
+            html.write(str(soup))
+
+def base_tag_html (id: str) -> str:
+    return f'<base href="/html/{id}/"/>'
+
+def base_tag (soup: BeautifulSoup, id: str) -> None:
+    """ This inserts the base tag into the html so we can use the /html/arxiv_id url """
+    soup.head.append(BeautifulSoup(base_tag_html(id), 'html.parser'))
+
+def missing_package_warning (soup: BeautifulSoup, missing_packages: List[str]) -> None:
+    """ This is the HTML for the closeable pop up warning for missing packages """
+    missing_packages_lis = "\n".join(map(lambda x: f"<li>failed: {x}</li>", missing_packages))
+    popup_html = f"""
+        <div class="package-alerts ltx_document" role="status" aria-label="Conversion errors have been found">
+            <button aria-label="Dismiss alert" onclick="closePopup()">
+                <span aria-hidden="true"><svg role="presentation" width="20" height="20" viewBox="0 0 44 44" aria-hidden="true" focusable="false">
+                <path d="M0.549989 4.44999L4.44999 0.549988L43.45 39.55L39.55 43.45L0.549989 4.44999Z" />
+                <path d="M39.55 0.549988L43.45 4.44999L4.44999 43.45L0.549988 39.55L39.55 0.549988Z" />
+                </svg></span>
+            </button>
+            <p>HTML conversions <a href="https://info.dev.arxiv.org/about/accessibility_html_error_messages.html" target="_blank">sometimes display errors</a> due to content that did not convert correctly from the source. This paper uses the following packages that are not yet supported by the HTML conversion tool. Feedback on these issues are not necessary; they are known and are being worked on.</p>
+                <ul arial-label="Unsupported packages used in this paper">
+                    {missing_packages_lis}
+                </ul>
+            <p>Authors: achieve the best HTML results from your LaTeX submissions by following these <a href="https://info.arxiv.org/help/submit_latex_best_practices.html" target="_blank">best practices</a>.</p>
+        </div>
+
+        <script>
+            function closePopup() {{
+                document.querySelector('.package-alerts').style.display = 'none';
+            }}
+        </script>
+        """
+    soup.find('div', attrs={'class': 'ltx_page_content'}).insert(0, BeautifulSoup(popup_html, 'html.parser'))
+
+def license_section (soup: BeautifulSoup, license: str, is_missing_packages: Optional[List]) -> None:
+    """ Inserts the target section holding the license, after the missing package popup if there is one """
+    license_html = BeautifulSoup(f'<div id="license-tr">{license}</div>', 'html.parser')
+    target_section = soup.new_tag('div', attrs={'class': 'section', 'id': 'target-section'})
+    document_wrapper = soup.find('div', attrs={'class': 'ltx_page_content'})
+    if is_missing_packages:
+        document_wrapper \
+            .find('div', attrs={'class': ['package-alerts', 'ltx_document']}) \
+            .insert_after(target_section)
+    else:
+        document_wrapper.insert(0, target_section)
+    target_section.append(license_html)
+
+def page_content_prefix_html (license: str, missing_packages: Optional[List]) -> str:
+    """ What missing_package_warning and license_section insert at the start of div.ltx_page_content """
+    soup = BeautifulSoup('<div class="ltx_page_content"></div>', 'html.parser')
+    if missing_packages:
+        missing_package_warning(soup, missing_packages)
+    license_section(soup, license, missing_packages)
+    return soup.div.decode_contents()
+
+HREF_RE = re.compile(r'\/html\/submission\/\d+\/view#.+')
+
+def submission_href (href: Optional[str], sub_id: int, view_sub_base: str) -> Optional[str]:
+    """ Returns the absolute href for an ltx_ref anchor in a submission, None if unchanged """
+    if href and href[0] == '#':
+        return f'{view_sub_base}/html/submission/{sub_id}/view{href}'
+    return None
+
+def doc_href (href: Optional[str], id: str, view_doc_base: str) -> Optional[str]:
+    """ Returns the absolute href for an ltx_ref anchor in a published document, None if unchanged """
+    if href and re.search(HREF_RE, href) is not None:
+        relative_anchor = href.split('/view')[1]
+        return f'{view_doc_base}/html/{id}{relative_anchor}'
+    elif href and href[0] == '#':
+        return f'{view_doc_base}/html/{id}{href}'
+    return None
+
+def _rewrite_ltx_refs (soup: BeautifulSoup, rewrite: Callable[[Optional[str]], Optional[str]]) -> None:
+    for a in soup.find_all('a', attrs={'class': 'ltx_ref'}):
+        if (href := rewrite(a.get('href'))) is not None:
+            a['href'] = href
+
+def absolute_anchors_for_submission (soup: BeautifulSoup, sub_id: int, view_sub_base: str) -> None:
+    _rewrite_ltx_refs(soup, lambda href: submission_href(href, sub_id, view_sub_base))
+
+def absolute_anchors_for_doc (soup: BeautifulSoup, id: str, view_doc_base: str) -> None:
+    _rewrite_ltx_refs(soup, lambda href: doc_href(href, id, view_doc_base))
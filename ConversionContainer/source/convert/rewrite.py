@@ -0,0 +1,228 @@
+"""Streaming (non-DOM) rewriting of converted html files"""
+from typing import (
+    Callable,
+    Dict,
+    IO,
+    Iterator,
+    List,
+    Optional,
+    Tuple
+)
+import html
+import os
+import re
+
+from bs4.dammit import EntitySubstitution
+from flask import current_app
+
+from ..exceptions import HTMLInjectionError
+
+HrefRewrite = Callable[[Optional[str]], Optional[str]]
+
+START_TAG_RE = re.compile(
+    r'<([a-zA-Z][^\s/>]*)'
+    r'((?:\s+[^\s/>"\'=]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'>]*))?)*)'
+    r'\s*(/?)>')
+END_TAG_RE = re.compile(r'</\s*([a-zA-Z][^\s/>]*)[^>]*>')
+ATTR_RE = re.compile(r'([^\s/>"\'=]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s"\'>]*))?')
+
+# Elements whose content html.parser does not tokenize
+RAW_TEXT_ELEMENTS = ('script', 'style')
+RAW_TEXT_END_RE = { name: re.compile(f'</{name}', re.I) for name in RAW_TEXT_ELEMENTS }
+# A '<' that has not closed within this many characters is treated as text
+MAX_TAG_LENGTH = 1 << 20
+
+def stream_rewrite_enabled () -> bool:
+    return current_app.config['HTML_REWRITE_MODE'] == 'stream'
+
+class _Token:
+    __slots__ = ('kind', 'text', 'name', 'attrs', 'attrs_offset', 'self_closing')
+
+    def __init__ (self, kind: str, text: str, name: str = '',
+                  attrs: str = '', attrs_offset: int = 0, self_closing: bool = False):
+        self.kind = kind
+        self.text = text
+        self.name = name
+        self.attrs = attrs
+        self.attrs_offset = attrs_offset
+        self.self_closing = self_closing
+
+def _next_token (buf: str, pos: int, eof: bool, raw_text: Optional[str]) -> Optional[_Token]:
+    """ Returns the token starting at pos, or None if more input is needed to finish it """
+    if raw_text:
+        end = RAW_TEXT_END_RE[raw_text].search(buf, pos)
+        if end is None:
+            if eof:
+                return _Token('text', buf[pos:]) if pos < len(buf) else None
+            # Hold back enough to recognize an end tag split across chunks
+            safe = len(buf) - len(raw_text) - 2
+            return _Token('text', buf[pos:safe]) if safe > pos else None
+        if end.start() > pos:
+            return _Token('text', buf[pos:end.start()])
+
+    i = buf.find('<', pos)
+    if i == -1:
+        return _Token('text', buf[pos:]) if pos < len(buf) else None
+    if i > pos:
+        return _Token('text', buf[pos:i])
+
+    incomplete = not eof and len(buf) - pos < MAX_TAG_LENGTH
+    if buf.startswith('<!--', pos):
+        j = buf.find('-->', pos + 4)
+        if j != -1:
+            return _Token('other', buf[pos:j + 3])
+    elif buf.startswith('</', pos):
+        if (m := END_TAG_RE.match(buf, pos)):
+            return _Token('end', m.group(), m.group(1).lower())
+    elif buf.startswith('<!', pos) or buf.startswith('<?', pos):
+        j = buf.find('>', pos)
+        if j != -1:
+            return _Token('other', buf[pos:j + 1])
+    elif (m := START_TAG_RE.match(buf, pos)):
+        return _Token('start', m.group(), m.group(1).lower(), m.group(2),
+                      m.start(2) - pos, bool(m.group(3)))
+    elif len(buf) - pos < 2 or not buf[pos + 1].isalpha():
+        return _Token('text', '<') if (eof or len(buf) - pos >= 2) else None
+
+    if incomplete:
+        return None
+    return _Token('text', '<')
+
+def _tokens (f: IO[str], chunk_size: int) -> Iterator[_Token]:
+    buf, pos, eof = '', 0, False
+    raw_text: Optional[str] = None
+    while True:
+        token = _next_token(buf, pos, eof, raw_text)
+        if token is None:
+            if eof:
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        pos += len(token.text)
+        if token.kind == 'start' and token.name in RAW_TEXT_ELEMENTS and not token.self_closing:
+            raw_text = token.name
+        elif token.kind == 'end' and token.name == raw_text:
+            raw_text = None
+        yield token
+
+def _parse_attrs (attrs: str) -> Dict[str, Tuple[Optional[str], Tuple[int, int]]]:
+    """ Maps attribute name to its unescaped value and the span of its raw value in attrs """
+    parsed: Dict[str, Tuple[Optional[str], Tuple[int, int]]] = {}
+    for m in ATTR_RE.finditer(attrs):
+        raw = m.group(2)
+        if raw is None:
+            parsed[m.group(1).lower()] = (None, m.span())
+            continue
+        value = raw[1:-1] if raw[:1] in ('"', "'") else raw
+        parsed[m.group(1).lower()] = (html.unescape(value), m.span(2))
+    return parsed
+
+class StreamRewriter:
+    """
+    Streaming counterpart of PostProcessor for edits that
+    don't need a document tree: appending markup to the end
+    of <head> or of an element by id, prepending it to the
+    first div of a class, and rewriting the href of a.ltx_ref
+    anchors. The file is tokenized in one linear
+    pass, everything that isn't edited is copied through
+    verbatim and the result replaces the file once finished,
+    so memory use is bounded by chunk_size plus the largest tag.
+
+    For html that BeautifulSoup serialized (everything this
+    container writes) the output matches the PostProcessor
+    transforms exactly.
+    """
+
+    def __init__ (self, fpath: str, chunk_size: int = 1 << 16):
+        self.fpath = fpath
+        self.chunk_size = chunk_size
+        self.head_html: List[str] = []
+        self.id_html: Dict[str, List[str]] = {}
+        self.class_html: Dict[str, List[str]] = {}
+        self.href_rewrites: List[HrefRewrite] = []
+
+    def append_to_head (self, markup: str) -> 'StreamRewriter':
+        self.head_html.append(markup)
+        return self
+
+    def append_to_id (self, element_id: str, markup: str) -> 'StreamRewriter':
+        self.id_html.setdefault(element_id, []).append(markup)
+        return self
+
+    def prepend_to_class (self, class_name: str, markup: str) -> 'StreamRewriter':
+        """ Inserts markup at the start of the first div of class_name, after any markup prepended before """
+        self.class_html.setdefault(class_name, []).append(markup)
+        return self
+
+    def rewrite_ltx_refs (self, rewrite: HrefRewrite) -> 'StreamRewriter':
+        """ rewrite gets the current href and returns the new one, or None to leave it """
+        self.href_rewrites.append(rewrite)
+        return self
+
+    def _rewrite_anchor (self, token: _Token) -> str:
+        attrs = _parse_attrs(token.attrs)
+        classes = (attrs.get('class', (None,))[0] or '').split()
+        if 'ltx_ref' not in classes or 'href' not in attrs:
+            return token.text
+        original, (start, end) = attrs['href']
+        # BeautifulSoup reads a valueless attribute as ''
+        original = original if original is not None else ''
+        href = original
+        for rewrite in self.href_rewrites:
+            if (new_href := rewrite(href)) is not None:
+                href = new_href
+        if href == original:
+            return token.text
+        value = EntitySubstitution.substitute_xml(href, True)
+        if attrs['href'][0] is None:
+            value = f'href={value}'
+        offset = token.attrs_offset
+        return token.text[:offset + start] + value + token.text[offset + end:]
+
+    def run (self) -> None:
+        tmp_fpath = f'{self.fpath}.rewrite'
+        pending_head = bool(self.head_html)
+        pending_ids = dict(self.id_html)
+        pending_classes = dict(self.class_html)
+        open_targets: List[List] = [] # [tag name, depth, markup]
+        try:
+            with open(self.fpath, 'r') as src, open(tmp_fpath, 'w') as dst:
+                for token in _tokens(src, self.chunk_size):
+                    if token.kind == 'start':
+                        for target in open_targets:
+                            if target[0] == token.name and not token.self_closing:
+                                target[1] += 1
+                        if pending_ids and not token.self_closing and 'id' in token.attrs:
+                            element_id = _parse_attrs(token.attrs).get('id', (None,))[0]
+                            if element_id in pending_ids:
+                                open_targets.append([token.name, 0, ''.join(pending_ids.pop(element_id))])
+                        if self.href_rewrites and token.name == 'a':
+                            dst.write(self._rewrite_anchor(token))
+                            continue
+                        if pending_classes and token.name == 'div' and 'class' in token.attrs:
+                            classes = (_parse_attrs(token.attrs).get('class', (None,))[0] or '').split()
+                            prepend = [''.join(pending_classes.pop(name)) for name in classes if name in pending_classes]
+                            if prepend:
+                                dst.write(token.text + ''.join(prepend))
+                                continue
+                    elif token.kind == 'end':
+                        if pending_head and token.name == 'head':
+                            dst.write(''.join(self.head_html))
+                            pending_head = False
+                        for target in reversed(list(open_targets)):
+                            if target[0] == token.name:
+                                if target[1] == 0:
+                                    dst.write(target[2])
+                                    open_targets.remove(target)
+                                else:
+                                    target[1] -= 1
+                    dst.write(token.text)
+            if pending_head or pending_ids or pending_classes or open_targets:
+                raise HTMLInjectionError(
+                    f'Failed to find insertion point for stream rewrite of {self.fpath}')
+            os.replace(tmp_fpath, self.fpath)
+        finally:
+            if os.path.exists(tmp_fpath):
+                os.remove(tmp_fpath)
@@ -14,7 +14,7 @@ from ..util.db_queries import (
 from . import process
 from ..publish import _publish
 
-def single_convert (paper_id: str, version: int):
+def single_convert (paper_id: str, version: int, force: bool = True) -> None:
     try:
         submission_id, source_flags = get_process_data_from_db(paper_id, version)
     except:
@@ -25,11 +25,11 @@ def single_convert (paper_id: str, version: int):
     blob = f'{submission_id}/{submission_id}.gz' if single_file else f'{submission_id}/{submission_id}.tar.gz'
     bucket = current_app.config['IN_BUCKET_SUB_ID']
 
-    process(submission_id, blob, bucket, single_file)
+    process(submission_id, blob, bucket, single_file, force)
 
     _publish(submission_id, paper_id, version)
 
-def reconvert_submission (submission_id: int) -> bool:
+def reconvert_submission (submission_id: int, force: bool = True) -> None:
     try:
         source_flags = get_source_flags_for_submission(submission_id)
     except:
@@ -40,4 +40,4 @@ def reconvert_submission (submission_id: int) -> bool:
     blob = f'{submission_id}/{submission_id}.gz' if single_file else f'{submission_id}/{submission_id}.tar.gz'
     bucket = current_app.config['IN_BUCKET_SUB_ID']
 
-    process(submission_id, blob, bucket, single_file)
\ No newline at end of file
+    process(submission_id, blob, bucket, single_file, force)
\ No newline at end of file
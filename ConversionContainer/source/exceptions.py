@@ -12,6 +12,9 @@ class TarError(RuntimeError):
 class LaTeXMLRemoveError(RuntimeError):
     """Raised when removing a .ltxml file fails."""
 
+class LaTeXMLPoolError(RuntimeError):
+    """Raised when the latexmls daemon pool cannot run a conversion."""
+
 class MainTeXError(RuntimeError):
     """Raised when finding a main .tex file fails or no main .tex file is found."""
 
@@ -0,0 +1,76 @@
+"""Bounded background executors for work started by the routes"""
+from typing import Any, Callable, Dict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from flask import Flask, current_app
+
+logger = logging.getLogger()
+
+class BoundedExecutor:
+    """
+    Runs jobs on at most max_workers threads with at most
+    max_queued jobs waiting behind them. submit refuses work
+    instead of queueing without bound, so the caller can answer
+    with a retryable status and let pub/sub redeliver elsewhere.
+    Jobs run inside the application context of the submitter.
+    """
+
+    def __init__ (self, name: str, max_workers: int, max_queued: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.queued = 0
+
+    def submit (self, fn: Callable, *args: Any) -> bool:
+        """ Returns False without running fn if the executor is full """
+        if not self._slots.acquire(blocking=False):
+            return False
+        app = current_app._get_current_object()
+        with self._lock:
+            self.queued += 1
+
+        def run ():
+            with self._lock:
+                self.queued -= 1
+                self.in_flight += 1
+            try:
+                with app.app_context():
+                    fn(*args)
+            except Exception:
+                logger.warning(f'{self.name}: {fn.__name__}{args} failed', exc_info=1)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                self._slots.release()
+
+        self._executor.submit(run)
+        return True
+
+    def stats (self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'max_workers': self.max_workers,
+                'max_queued': self.max_queued
+            }
+
+_executors_lock = threading.Lock()
+
+def get_executor (name: str, max_workers: int, max_queued: int) -> BoundedExecutor:
+    """ Returns the app's executor called name, creating it on first use """
+    app: Flask = current_app._get_current_object()
+    with _executors_lock:
+        executors = app.extensions.setdefault('executors', {})
+        if name not in executors:
+            executors[name] = BoundedExecutor(name, max_workers, max_queued)
+        return executors[name]
+
+def get_executors () -> Dict[str, BoundedExecutor]:
+    return current_app.extensions.get('executors', {})
@@ -1,7 +1,7 @@
 """ORM models for latexml table"""
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime
 
 db: SQLAlchemy = SQLAlchemy()
 
@@ -22,6 +22,12 @@ class DBLaTeXMLDocuments(db.Model):
     conversion_status = Column(Integer, nullable=False)
     latexml_version = Column(String(40), nullable=False)
     tex_checksum = Column(String)
+    # GCS generation of the source blob that was converted
+    source_generation = Column(BigInteger)
+    # GCS md5 of the source blob, equal across re-uploads of the same bytes
+    source_md5 = Column(String(32))
+    # POSTPROCESS_VERSION the html was post processed with
+    postprocess_version = Column(String(40))
     conversion_start_time = Column(Integer)
     conversion_end_time = Column(Integer)
     publish_dt = Column(DateTime)
@@ -41,5 +47,11 @@ class DBLaTeXMLSubmissions (db.Model):
     conversion_status = Column(Integer, nullable=False)
     latexml_version = Column(String(40), nullable=False)
     tex_checksum = Column(String)
+    # GCS generation of the source blob that was converted
+    source_generation = Column(BigInteger)
+    # GCS md5 of the source blob, equal across re-uploads of the same bytes
+    source_md5 = Column(String(32))
+    # POSTPROCESS_VERSION the html was post processed with
+    postprocess_version = Column(String(40))
     conversion_start_time = Column(Integer)
     conversion_end_time = Column(Integer)
\ No newline at end of file
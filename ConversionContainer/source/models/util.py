@@ -1,7 +1,7 @@
 """Helpers and Flask application integration."""
 from contextlib import contextmanager
 
-from typing import Generator, Callable
+from typing import Any, Callable, Dict, Generator, Optional
 from datetime import datetime
 from pytz import timezone, UTC
 import logging
@@ -9,7 +9,9 @@ import time
 from functools import wraps
 
 from flask import Flask
-from sqlalchemy import text
+from sqlalchemy import bindparam, column, select, text, update
+from sqlalchemy.sql.selectable import TextualSelect
+from sqlalchemy.types import TypeEngine
 from sqlalchemy.orm.session import Session
 
 from .db import db
@@ -49,6 +51,58 @@ def transaction() -> Generator[Session, None, None]:
         raise DBConnectionError from e
 
 
+class UnitOfWork:
+    """
+    One paper's reads and status transitions in as few round trips
+    as possible. Scalar reads queued with read() are sent together
+    as one SELECT by fetch(), each transition() is one guarded
+    UPDATE, and everything commits once on leaving unit_of_work().
+    """
+
+    def __init__ (self, session: Session):
+        self.session = session
+        self.written = False
+        self._reads: Dict[str, TextualSelect] = {}
+
+    def read (self, name: str, sql: str, type_: Optional[TypeEngine] = None, **params) -> 'UnitOfWork':
+        """ Queues sql, selecting at most one row of one column, to be fetched as name of type_ """
+        self._reads[name] = text(sql) \
+            .bindparams(*(bindparam(key, value, unique=True) for key, value in params.items())) \
+            .columns(column(name, type_))
+        return self
+
+    def fetch (self) -> Dict[str, Any]:
+        """ Runs the queued reads as scalar subqueries of one SELECT, None for those with no row """
+        reads, self._reads = self._reads, {}
+        if not reads:
+            return {}
+        query = select(*(clause.scalar_subquery().label(name) for name, clause in reads.items()))
+        return dict(self.session.execute(query).mappings().one())
+
+    def transition (self, model: Any, *where: Any, **values: Any) -> bool:
+        """ Sets values on the rows of model matching where in one UPDATE, returns whether any matched """
+        result = self.session.execute(
+            update(model).where(*where).values(**values),
+            execution_options={ 'synchronize_session': False })
+        self.written = True
+        return result.rowcount > 0
+
+
+@contextmanager
+def unit_of_work() -> Generator[UnitOfWork, None, None]:
+    """
+    Context manager for a :class:`UnitOfWork` committed as one transaction.
+    Rows it read stay loaded but are detached when it ends.
+    """
+    with transaction() as session:
+        uow = UnitOfWork(session)
+        yield uow
+        if uow.written:
+            session.commit()
+    # Hands the connection back instead of idling in a transaction until teardown
+    session.close()
+
+
 def init_app(app: Flask) -> None:
     """Set configuration defaults and attach session to the application."""
     db.init_app(app)
@@ -1,24 +1,37 @@
 from typing import Dict, Tuple
 import logging
 import shutil
+import time
 from base64 import b64decode
 import json
 from flask import current_app
 
 from ..models.util import transaction, db
 
-from ..convert import insert_base_tag, replace_absolute_anchors_for_doc
+from ..convert.postprocess import (
+    PostProcessor,
+    base_tag,
+    base_tag_html,
+    absolute_anchors_for_doc,
+    doc_href
+)
+from ..convert.rewrite import StreamRewriter, stream_rewrite_enabled
+from ..util import StageTimer
 
 from .db_queries import submission_has_html, \
-    write_published_html
+    write_published_html, document_published
 from .buckets import (
+    copy_sub_to_doc_bucket,
     download_sub_to_doc_dir,
-    upload_dir_to_doc_bucket, 
+    upload_dir_to_doc_bucket,
+    upload_html_to_doc_bucket,
     delete_sub,
     move_sub_qa_to_doc_qa
 )
-from .watermark import make_published_watermark, insert_watermark
+from .watermark import make_published_watermark, watermark_section
 from .fastly_purge import fastly_purge_abs
+from .purge_queue import get_purge_queue
+from .dedup import get_publish_dedup
 
 logger = logging.getLogger()
 
@@ -30,10 +43,45 @@ def _parse_json_payload (payload: Dict) -> Tuple[int, str, int]:
         data['version']
     )
 
-def publish (payload: Dict):
-    _publish(*_parse_json_payload(payload))
+def publish (payload: Dict) -> bool:
+    """
+    Publishes the payload's submission unless the same (submission_id,
+    paper_id, version) is being or was recently published here, or
+    arXiv_latexml_doc shows it already published. pub/sub was answered
+    when the publish was queued, so a failed publish is retried here,
+    up to PUBLISH_ATTEMPTS times with exponential backoff.
+
+    Returns
+    -------
+    bool
+        False if every attempt failed, True if it was published or dropped
+    """
+    key = _parse_json_payload(payload)
+    dedup = get_publish_dedup()
+    if not dedup.claim(key):
+        return True
+    published = False
+    try:
+        _, paper_id, version = key
+        attempts = current_app.config['PUBLISH_ATTEMPTS']
+        for attempt in range(1, attempts + 1):
+            if document_published(paper_id, version):
+                dedup.dropped_published(key)
+                published = True
+            else:
+                published = _publish(*key)
+            if published:
+                break
+            if attempt < attempts:
+                logger.warning(f'Publish of {key} failed, attempt {attempt} of {attempts}')
+                time.sleep(current_app.config['PUBLISH_RETRY_BACKOFF'] * 2 ** (attempt - 1))
+        else:
+            logger.error(f'Giving up publishing {key} after {attempts} attempts')
+    finally:
+        dedup.release(key, published)
+    return published
 
-def _publish (submission_id: int, paper_id: str, version: int):
+def _publish (submission_id: int, paper_id: str, version: int) -> bool:
     """Triggered from a message on a Cloud Pub/Sub topic.
     Args:
          paylod (dict): Event payload containing a base64 encoded 
@@ -43,12 +91,15 @@ def _publish (submission_id: int, paper_id: str, version: int):
       2. Query arXiv_latexml_sub to check for html for submission
          [continue to step 3 if exists else end]
       3. Copy HTML directory from latexml_submission_converted to 
-         latexml_arxiv_id_converted with new name
+         latexml_arxiv_id_converted with new name, server side when
+         the submission's objects were stored
       4. Write new row to arXiv_latexml_doc
       5. Delete from latexml_submission_converted
 
+    Returns whether the submission was published, and logs the
+    time taken by each stage it reached
     """
-
+    timer = StageTimer()
     try:
         # 1.
         paper_idv = f'{paper_id}v{version}'
@@ -61,45 +112,76 @@ def _publish (submission_id: int, paper_id: str, version: int):
         submission_row = submission_has_html(submission_id)
         if submission_row is None:
             logger.info(f'No html found for submission {submission_id}/{paper_idv}')
-            return
+            return False
         else:
             logger.info(f'Identified successful conversion for {submission_id}/{paper_idv}')
+        timer.lap('lookup')
         
-        # Download submission conversion and rename. Return path to main .html file
-        html_file = download_sub_to_doc_dir(submission_id, paper_idv)
-        logger.info(f'Successfully downloaded {submission_id} to {paper_idv} dir')
-
-        # Insert base tag
-        insert_base_tag(html_file, paper_idv)
-        logger.info(f'Successfully injected base tag for {submission_id}/{paper_idv}')
-
-        # Inject watermark into html
-        insert_watermark(html_file, make_published_watermark(submission_id, paper_id, version))    
-        logger.info(f'Successfully injected watermark for {submission_id}/{paper_idv}')
-
-        replace_absolute_anchors_for_doc(html_file, paper_idv)
-        logger.info(f'Successfully replaced anchor tags for {submission_id}/{paper_idv}')
+        # Copy the submission's objects server side and download only its html,
+        # or download the whole conversion and rename. Return path to main .html file
+        html_file = None
+        if current_app.config['PUBLISH_MODE'] == 'copy':
+            html_file = copy_sub_to_doc_bucket(submission_id, paper_idv)
+        copied = html_file is not None
+        if copied:
+            logger.info(f'Successfully copied {submission_id} to {paper_idv}')
+            timer.lap('copy')
+        else:
+            html_file = download_sub_to_doc_dir(submission_id, paper_idv)
+            logger.info(f'Successfully downloaded {submission_id} to {paper_idv} dir')
+            timer.lap('download')
+
+        # Insert base tag, inject watermark and replace anchor tags in one pass
+        watermark = make_published_watermark(submission_id, paper_id, version)
+        VIEW_DOC_BASE = current_app.config['VIEW_DOC_BASE']
+        if stream_rewrite_enabled():
+            StreamRewriter(html_file) \
+                .append_to_head(base_tag_html(paper_idv)) \
+                .append_to_id('target-section', str(watermark)) \
+                .rewrite_ltx_refs(lambda href: doc_href(href, paper_idv, VIEW_DOC_BASE)) \
+                .run()
+        else:
+            PostProcessor(html_file) \
+                .register(base_tag, paper_idv) \
+                .register(watermark_section, watermark) \
+                .register(absolute_anchors_for_doc, paper_idv, VIEW_DOC_BASE) \
+                .run()
+        logger.info(f'Successfully post processed html for {submission_id}/{paper_idv}')
+        timer.lap('postprocess')
         
-        # Upload directory to published conversion bucket
-        upload_dir_to_doc_bucket (submission_id)
+        # Upload the html, or the whole directory, to published conversion bucket
+        if copied:
+            upload_html_to_doc_bucket (html_file, paper_idv)
+        else:
+            upload_dir_to_doc_bucket (submission_id)
         logger.info(f'Successfully uploaded {submission_id}/{paper_idv}')         
+        timer.lap('upload')
 
         # Update database accordingly
         write_published_html (paper_id, version, submission_row)
+        timer.lap('db_write')
 
         # Move log output from sub bucket to published bucket
         move_sub_qa_to_doc_qa (submission_id, paper_idv)
         logger.info(f'Successfully wrote {submission_id}/{paper_idv} qa to doc bucket')
+        timer.lap('qa_move')
 
         # Purge abs page from fastly so we can see it
         if not current_app.config['IS_DEV']:
-            fastly_purge_abs(paper_id, version, current_app.config['FASTLY_PURGE_KEY'])
-
+            if current_app.config['FASTLY_PURGE_MODE'] == 'queue':
+                get_purge_queue().enqueue(paper_id, version)
+            else:
+                purge = fastly_purge_abs(paper_id, version, current_app.config['FASTLY_PURGE_KEY'])
+                logger.info(f'Fastly purge for {paper_idv}: {purge}')
+            timer.lap('purge')
+
+        return True
     except Exception as e:
         try:
             logger.warning(f'Error publishing {submission_id}/{paper_id}', exc_info=1)
         except:
             logger.warning(f'Error publishing unknown', exc_info=1)
+        return False
     finally:
         try:
             # Delete from local fs
@@ -109,5 +191,6 @@ def _publish (submission_id: int, paper_id: str, version: int):
                 logger.warning(f'Failed to delete directory for {submission_id}', exc_info=1)
             except:
                 logger.warning('Failed to delete directory for unknown', exc_info=1)
+        logger.info(f'Publish timings for {submission_id}/{paper_id}v{version}: {timer}')
 
     
\ No newline at end of file
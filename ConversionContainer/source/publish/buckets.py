@@ -1,16 +1,16 @@
+from typing import Any, Dict, Optional
 import os
 import tarfile
 
-from google.cloud import storage
 from flask import current_app
 
 from ..buckets import download_blob, \
-    upload_dir_to_gcs, delete_blob
+    upload_dir_to_gcs, upload_file_to_gcs, delete_blob, \
+    stored_object_names, copy_objects_in_gcs, delete_objects, \
+    util as bucket_util
 from ..util import untar
 from .util import rename
 
-storage_client = storage.Client()
-
 def download_sub_to_doc_dir (submission_id: int, paper_idv: str):
     blob_name = f'{submission_id}.tar.gz'
     tar_name = f'{submission_id}.tar'
@@ -19,13 +19,42 @@ def download_sub_to_doc_dir (submission_id: int, paper_idv: str):
     untar(tar_name, dir_name)
     return rename(dir_name, submission_id, paper_idv)
 
-def upload_dir_to_doc_bucket (submission_id: int):
+def upload_dir_to_doc_bucket (submission_id: int) -> Dict[str, Any]:
     dir_name = f'sites/{submission_id}'
-    upload_dir_to_gcs(dir_name, current_app.config['OUT_BUCKET_ARXIV_ID'])
+    return upload_dir_to_gcs(dir_name, current_app.config['OUT_BUCKET_ARXIV_ID'])
+
+def copy_sub_to_doc_bucket (submission_id: int, paper_idv: str) -> Optional[str]:
+    """
+    Copies the submission's stored objects, all but its html, to
+    {paper_idv}/ in the doc bucket server side, and downloads its
+    html to where download_sub_to_doc_dir would put it.
+
+    Returns
+    -------
+    Optional[str]
+        Path to the downloaded html, None if the submission was
+        converted without storing its objects
+    """
+    names = stored_object_names(submission_id, current_app.config['OUT_BUCKET_SUB_ID'])
+    if names is None:
+        return None
+    html_name = f'{submission_id}.html'
+    copy_objects_in_gcs(
+        current_app.config['OUT_BUCKET_SUB_ID'],
+        current_app.config['OUT_BUCKET_ARXIV_ID'],
+        { f'{submission_id}/{name}': f'{paper_idv}/{name}' for name in names if name != html_name })
+    html_file = f'sites/{submission_id}/{paper_idv}/{paper_idv}.html'
+    os.makedirs(os.path.dirname(html_file), exist_ok=True)
+    download_blob(current_app.config['OUT_BUCKET_SUB_ID'], f'{submission_id}/{html_name}', html_file)
+    return html_file
+
+def upload_html_to_doc_bucket (html_file: str, paper_idv: str) -> Dict[str, Any]:
+    return upload_file_to_gcs(html_file, current_app.config['OUT_BUCKET_ARXIV_ID'], f'{paper_idv}/{paper_idv}.html')
 
 def move_sub_qa_to_doc_qa (submission_id: str, paper_idv: str):
     blob_name = f'{submission_id}_stdout.txt'
     out_name = f'{paper_idv}_stdout.txt'
+    storage_client = bucket_util.get_google_storage_client()
     bucket = storage_client.bucket(current_app.config['QA_BUCKET_SUB'])
     bucket.copy_blob(
         bucket.blob(blob_name), 
@@ -34,4 +63,5 @@ def move_sub_qa_to_doc_qa (submission_id: str, paper_idv: str):
 
 def delete_sub (submission_id: int):
     delete_blob (current_app.config['OUT_BUCKET_SUB_ID'], f'{submission_id}.tar.gz')
+    delete_objects (submission_id, current_app.config['OUT_BUCKET_SUB_ID'])
 
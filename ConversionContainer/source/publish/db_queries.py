@@ -1,64 +1,69 @@
-from typing import Optional
+from typing import Optional, Tuple
 from datetime import datetime
 from contextlib import contextmanager
 import logging
 
-from flask import current_app
-
 from sqlalchemy.orm import Session
-from sqlalchemy.sql import text
+from sqlalchemy.types import DateTime
 from sqlalchemy.exc import IntegrityError
 
 from ..exceptions import DBConnectionError
 from ..models.db import db, DBLaTeXMLDocuments, DBLaTeXMLSubmissions
-from ..models.util import database_retry, transaction
+from ..models.util import database_retry, transaction, unit_of_work
 
 logger = logging.getLogger()
 
 @database_retry(3)
 def submission_has_html (submission_id: int) -> Optional[DBLaTeXMLSubmissions]:
-    with current_app.app_context():
-        with transaction() as session:
-            row = db.session.query(DBLaTeXMLSubmissions) \
-                .filter(DBLaTeXMLSubmissions.submission_id == submission_id) \
-                .first()
-            return row if (row and row.conversion_status == 1) else None
+    with unit_of_work() as uow:
+        row = uow.session.query(DBLaTeXMLSubmissions) \
+            .filter(DBLaTeXMLSubmissions.submission_id == submission_id) \
+            .first()
+    return row if (row and row.conversion_status == 1) else None
 
 @database_retry(3)
-def write_published_html (paper_id: str, version: int, html_submission: DBLaTeXMLSubmissions):
-    with current_app.app_context():
-        with transaction() as session:
-            try:
-                row = DBLaTeXMLDocuments (
-                    paper_id=paper_id,
-                    document_version=version,
-                    conversion_status=1,
-                    latexml_version=html_submission.latexml_version,
-                    tex_checksum=html_submission.tex_checksum,
-                    conversion_start_time=html_submission.conversion_start_time,
-                    conversion_end_time=html_submission.conversion_end_time,
-                    publish_dt=datetime.utcnow()
-                )
-                session.merge(row)
-                session.commit()
-            except IntegrityError as e:
-                logger.info(f'Integrity Error for {paper_id}, rolling back')
-                session.rollback()
-
+def document_published (paper_id: str, version: int) -> bool:
+    """ Whether arXiv_latexml_doc already has a published conversion of paper_id v version """
+    with unit_of_work() as uow:
+        publish_dt = uow.session.query(DBLaTeXMLDocuments.publish_dt) \
+            .filter(DBLaTeXMLDocuments.paper_id == paper_id) \
+            .filter(DBLaTeXMLDocuments.document_version == version) \
+            .scalar()
+    return publish_dt is not None
 
 @database_retry(3)
-def get_submission_timestamp (submission_id: int) -> Optional[str]:
-    with current_app.app_context():
-        with transaction() as session:
-            query = text("SELECT submit_time from arXiv_submissions WHERE submission_id=:submission_id")
-            query = query.bindparams(submission_id=submission_id)
-            ts: datetime = session.execute(query).scalar() # TODO: Add error handling
-            return ts.strftime('%d %b %Y')
+def write_published_html (paper_id: str, version: int, html_submission: DBLaTeXMLSubmissions):
+    with transaction() as session:
+        try:
+            row = DBLaTeXMLDocuments (
+                paper_id=paper_id,
+                document_version=version,
+                conversion_status=1,
+                latexml_version=html_submission.latexml_version,
+                tex_checksum=html_submission.tex_checksum,
+                # The html came from the submission's source, not the document's
+                source_generation=None,
+                source_md5=None,
+                conversion_start_time=html_submission.conversion_start_time,
+                conversion_end_time=html_submission.conversion_end_time,
+                publish_dt=datetime.utcnow()
+            )
+            session.merge(row)
+            session.commit()
+        except IntegrityError as e:
+            logger.info(f'Integrity Error for {paper_id}, rolling back')
+            session.rollback()
+
 
 @database_retry(3)
-def get_version_primary_category (paper_id: str, version: int) -> Optional[str]:
-    with current_app.app_context():
-        with transaction() as session:
-            query = text("SELECT abs_categories FROM arXiv_metadata WHERE paper_id=:paper_id AND version=:version")
-            query = query.bindparams(paper_id=paper_id, version=version)
-            return session.execute(query).scalar().split(' ')[0] # TODO: Needs to be tested
\ No newline at end of file
+def get_watermark_metadata (submission_id: int, paper_id: str, version: int) -> Tuple[str, str]:
+    """ The submission's submit date and the version's primary category, read in one round trip """
+    with unit_of_work() as uow:
+        row = uow \
+            .read('submit_time', "SELECT submit_time from arXiv_submissions WHERE submission_id=:submission_id",
+                  DateTime(), submission_id=submission_id) \
+            .read('abs_categories', "SELECT abs_categories FROM arXiv_metadata WHERE paper_id=:paper_id AND version=:version",
+                  paper_id=paper_id, version=version) \
+            .fetch()
+    # TODO: Add error handling
+    return row['submit_time'].strftime('%d %b %Y'), row['abs_categories'].split(' ')[0]
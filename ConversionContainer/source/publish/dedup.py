@@ -0,0 +1,79 @@
+"""Drops duplicate publish deliveries before they reach GCS"""
+from typing import Dict, Tuple
+import logging
+import threading
+import time
+
+from flask import current_app
+
+logger = logging.getLogger()
+
+PublishKey = Tuple[int, str, int]
+
+class PublishDedup:
+    """
+    In-process record of (submission_id, paper_id, version) keys
+    that are being published, or were published less than ttl
+    seconds ago, with counts of the deliveries it let through
+    and of the duplicates dropped.
+    """
+
+    def __init__ (self, ttl: float):
+        self.ttl = ttl
+        # key -> expiry, inf while the publish is running
+        self.keys: Dict[PublishKey, float] = {}
+        self._lock = threading.Lock()
+        self.counts = {
+            'accepted': 0,
+            'dropped_in_flight': 0,
+            'dropped_recent': 0,
+            'dropped_published': 0
+        }
+
+    def claim (self, key: PublishKey) -> bool:
+        """ Returns False if key is running or recently published, otherwise marks it running """
+        now = time.monotonic()
+        with self._lock:
+            expires = self.keys.get(key)
+            if expires is not None and expires > now:
+                reason = 'dropped_in_flight' if expires == float('inf') else 'dropped_recent'
+                self.counts[reason] += 1
+                logger.info(f'Dropped duplicate publish of {key} ({reason})')
+                return False
+            self.keys[key] = float('inf')
+            self.counts['accepted'] += 1
+            # Expired keys are cleared as new ones arrive
+            if len(self.keys) > 1000:
+                self.keys = { k: v for k, v in self.keys.items() if v > now }
+            return True
+
+    def release (self, key: PublishKey, published: bool):
+        """
+        Remembers key for ttl if it was published, forgets it if every
+        attempt failed so a later delivery of the same key publishes again
+        """
+        with self._lock:
+            if published:
+                self.keys[key] = time.monotonic() + self.ttl
+            else:
+                self.keys.pop(key, None)
+
+    def dropped_published (self, key: PublishKey):
+        """ Counts a delivery that arXiv_latexml_doc shows was already published """
+        with self._lock:
+            self.counts['dropped_published'] += 1
+        logger.info(f'Dropped duplicate publish of {key} (dropped_published)')
+
+    def stats (self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts, tracked=len(self.keys))
+
+_dedup_lock = threading.Lock()
+
+def get_publish_dedup () -> PublishDedup:
+    """ Returns the app's publish dedup, creating it on first use """
+    app = current_app._get_current_object()
+    with _dedup_lock:
+        if 'publish_dedup' not in app.extensions:
+            app.extensions['publish_dedup'] = PublishDedup(app.config['PUBLISH_DEDUP_TTL'])
+        return app.extensions['publish_dedup']
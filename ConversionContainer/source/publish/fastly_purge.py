@@ -1,21 +1,123 @@
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from flask import current_app
 
-def fastly_purge_abs (paper_id: str, version: int, fastly_key: str):
+PURGE_DOMAINS = ["arxiv.org", "web3.arxiv.org", "www.arxiv.org"]
+PURGE_BACKOFF = 0.5
+# Most surrogate keys Fastly accepts in one bulk purge
+MAX_SURROGATE_KEYS = 256
+
+Paper = Tuple[str, int]
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_session_lock = threading.Lock()
+
+def _get_session () -> requests.Session:
+    """ This process's purge session, so purges reuse connections to Fastly """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            _session.mount('https://', HTTPAdapter(pool_connections=len(PURGE_DOMAINS), pool_maxsize=16))
+            _session_pid = os.getpid()
+        return _session
+
+def _purge (method: str, url: str, headers: dict, timeout: float, attempts: int) -> Dict[str, Any]:
+    """ Sends one purge, retrying connection errors, 429s and 5xxs """
+    start = time.perf_counter()
+    for attempt in range(1, attempts + 1):
+        status, error = None, None
+        try:
+            status = _get_session().request(method, url, headers=headers, timeout=timeout).status_code
+            if status < 500 and status != 429:
+                break
+        except requests.RequestException as e:
+            error = str(e)
+        if attempt < attempts:
+            time.sleep(PURGE_BACKOFF * 2 ** (attempt - 1))
+    return {
+        'target': url,
+        'ok': status == 200,
+        'status': status,
+        'error': error,
+        'attempts': attempt,
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+
+def _abs_purges (papers: List[Paper], fastly_key: str) -> List[Tuple[tuple, List[Paper]]]:
+    """ ((method, url, headers), papers it clears) of each purge that clears the papers' abs pages """
     headers = {
         "Fastly-Key": fastly_key,
         "Accept": "application/json",
     }
-    domains = ["arxiv.org", "web3.arxiv.org", "www.arxiv.org"]
-    for domain in domains:
-        _purge_url (f"https://{ domain }/abs/{ paper_id }", headers)
-        _purge_url (f"https://{ domain }/abs/{ paper_id }v{ version }", headers)
-
-def _purge_url (url: str, headers: dict):
-    response = requests.request("PURGE", url, headers=headers)
-    if response.status_code == 200:
-        logging.info(f'successfully purged { url }')
-    else:
-        logging.warning(f'failed to purge { url }')
\ No newline at end of file
+    service_id = current_app.config['FASTLY_SERVICE_ID']
+    if service_id:
+        # One surrogate key purge covers every domain and version of up to MAX_SURROGATE_KEYS papers
+        key_format = current_app.config['FASTLY_ABS_SURROGATE_KEY']
+        url = f"{current_app.config['FASTLY_API_URL']}/service/{service_id}/purge"
+        purges = []
+        for i in range(0, len(papers), MAX_SURROGATE_KEYS):
+            chunk = papers[i:i + MAX_SURROGATE_KEYS]
+            keys = dict.fromkeys(key_format.format(paper_id=paper_id, version=version)
+                                 for paper_id, version in chunk)
+            purges.append((('POST', url, { **headers, "Surrogate-Key": ' '.join(keys) }), chunk))
+        return purges
+    return [
+        (('PURGE', url, headers), [(paper_id, version)])
+        for paper_id, version in papers
+        for domain in PURGE_DOMAINS
+        for url in (f"https://{ domain }/abs/{ paper_id }",
+                    f"https://{ domain }/abs/{ paper_id }v{ version }")
+    ]
+
+def purge_abs (papers: List[Paper], fastly_key: str) -> Dict[str, Any]:
+    """
+    Purges the abs pages of every (paper_id, version) from Fastly,
+    in bulk by surrogate key when FASTLY_SERVICE_ID is set and
+    otherwise url by url, all sent at once
+
+    Returns
+    -------
+    Dict[str, Any]
+        Whether every purge succeeded, the result of each purge,
+        the papers whose pages may not have been purged and the
+        time taken
+    """
+    start = time.perf_counter()
+    timeout = current_app.config['FASTLY_PURGE_TIMEOUT']
+    attempts = current_app.config['FASTLY_PURGE_ATTEMPTS']
+    purges = _abs_purges(papers, fastly_key)
+    if not purges:
+        return { 'ok': True, 'purges': [], 'failed_papers': [], 'seconds': 0.0 }
+    with ThreadPoolExecutor(max_workers=min(len(purges), 16), thread_name_prefix='purge') as executor:
+        results = list(executor.map(
+            lambda purge: _purge(*purge[0], timeout, attempts), purges))
+
+    failed_papers = list(dict.fromkeys(
+        paper
+        for (_, purged), r in zip(purges, results) if not r['ok']
+        for paper in purged))
+    for r in results:
+        if r['ok']:
+            logging.info(f'successfully purged { r["target"] }')
+        else:
+            logging.warning(f'failed to purge { r["target"] }: {r["status"] or r["error"]}')
+    return {
+        'ok': not failed_papers,
+        'purges': results,
+        'failed_papers': failed_papers,
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+
+def fastly_purge_abs (paper_id: str, version: int, fastly_key: str) -> Dict[str, Any]:
+    """ Purges one paper's abs pages, see purge_abs """
+    return purge_abs([(paper_id, version)], fastly_key)
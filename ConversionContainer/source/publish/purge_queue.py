@@ -0,0 +1,218 @@
+"""Coalesces the abs page purges of many publishes into bulk Fastly purges"""
+from typing import Dict, List, Optional
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from flask import Flask, current_app
+
+from .fastly_purge import Paper, purge_abs
+
+logger = logging.getLogger()
+
+class PurgeQueue:
+    """
+    Collects papers to purge for window seconds or until
+    max_papers are waiting, then purges them together on a
+    background thread so a publish never waits on Fastly.
+
+    Papers whose purge failed are written as a batch file to
+    retry_dir and purged again every retry_interval seconds, up
+    to retry_max times. Files left there by other workers or a
+    previous process are picked up the same way, as are files
+    claimed more than claim_timeout seconds ago by a worker that
+    never finished them. Papers still waiting when the process
+    exits are purged before it does.
+    """
+
+    def __init__ (self, app: Flask, fastly_key: str, window: float, max_papers: int,
+                  retry_dir: str, retry_interval: float, retry_max: int, claim_timeout: float):
+        self.app = app
+        self.fastly_key = fastly_key
+        self.window = window
+        self.max_papers = max_papers
+        self.retry_dir = retry_dir
+        self.retry_interval = retry_interval
+        self.retry_max = retry_max
+        self.claim_timeout = claim_timeout
+        self.pid = os.getpid()
+
+        self.pending: Dict[Paper, None] = {}
+        # The batch taken by the background thread until it is flushed
+        self.flushing: List[Paper] = []
+        self.cond = threading.Condition()
+        self.counts = {
+            'enqueued': 0,
+            'coalesced': 0,
+            'batches': 0,
+            'purged': 0,
+            'failed': 0,
+            'retried': 0,
+            'dropped': 0,
+            'reclaimed': 0
+        }
+        os.makedirs(retry_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='purge-queue', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def enqueue (self, paper_id: str, version: int):
+        """ Queues the paper's abs pages for purging """
+        with self.cond:
+            self.counts['enqueued'] += 1
+            if (paper_id, version) in self.pending:
+                self.counts['coalesced'] += 1
+            self.pending[(paper_id, version)] = None
+            self.cond.notify()
+
+    def _take_batch (self, timeout: float) -> List[Paper]:
+        """ Waits up to timeout for a paper, then up to window for more to join it """
+        with self.cond:
+            if not self.pending and not self.cond.wait_for(lambda: self.pending, timeout):
+                return []
+            deadline = time.monotonic() + self.window
+            self.cond.wait_for(
+                lambda: len(self.pending) >= self.max_papers,
+                max(deadline - time.monotonic(), 0))
+            batch = list(self.pending)[:self.max_papers]
+            for paper in batch:
+                del self.pending[paper]
+            self.flushing = batch
+            return batch
+
+    def _run (self):
+        with self.app.app_context():
+            next_retry = time.monotonic()
+            while True:
+                try:
+                    batch = self._take_batch(max(next_retry - time.monotonic(), 0))
+                    if batch:
+                        try:
+                            self.flush(batch)
+                        except Exception:
+                            self._save(batch, 1)
+                            raise
+                        finally:
+                            with self.cond:
+                                self.flushing = []
+                    if time.monotonic() >= next_retry:
+                        self.retry()
+                        next_retry = time.monotonic() + self.retry_interval
+                except Exception:
+                    logger.warning('Purge queue iteration failed', exc_info=1)
+                    time.sleep(1)
+
+    def flush (self, batch: List[Paper], attempt: int = 0) -> bool:
+        """ Purges batch, saving the papers that failed for retry. Returns whether all were purged """
+        result = purge_abs(batch, self.fastly_key)
+        failed = result['failed_papers']
+        with self.cond:
+            self.counts['batches'] += 1
+            self.counts['purged'] += len(batch) - len(failed)
+            self.counts['failed'] += len(failed)
+        logger.info(f'Purged {len(batch) - len(failed)} of {len(batch)} papers '
+                    f'in {result["seconds"]}s with {len(result["purges"])} requests')
+        if failed:
+            self._save(failed, attempt + 1)
+        return not failed
+
+    def _save (self, papers: List[Paper], attempts: int):
+        if attempts > self.retry_max:
+            with self.cond:
+                self.counts['dropped'] += len(papers)
+            logger.error(f'Giving up purging {papers} after {self.retry_max} retries')
+            return
+        fpath = os.path.join(self.retry_dir, f'{uuid.uuid4().hex}.json')
+        # Written aside and renamed so no reader sees a partial file
+        with open(f'{fpath}.tmp', 'w') as f:
+            json.dump({ 'attempts': attempts, 'papers': papers }, f)
+        os.rename(f'{fpath}.tmp', fpath)
+
+    def close (self):
+        """ Purges the papers still waiting, including a batch cut short mid flush, at exit """
+        if self.pid != os.getpid():
+            return
+        with self.cond:
+            papers = list(dict.fromkeys(self.flushing + list(self.pending)))
+            self.pending.clear()
+            self.flushing = []
+        with self.app.app_context():
+            for i in range(0, len(papers), self.max_papers):
+                self.flush(papers[i:i + self.max_papers])
+
+    def _reclaim (self):
+        """ Returns files claimed more than claim_timeout seconds ago to the saved batches """
+        now = time.time()
+        for fname in os.listdir(self.retry_dir):
+            name, _, pid = fname.rpartition('.')
+            if not (name.endswith('.json') and pid.isdigit()):
+                continue
+            claimed = os.path.join(self.retry_dir, fname)
+            try:
+                if now - os.stat(claimed).st_mtime < self.claim_timeout:
+                    continue
+                os.rename(claimed, os.path.join(self.retry_dir, name))
+            except FileNotFoundError:
+                continue
+            with self.cond:
+                self.counts['reclaimed'] += 1
+            logger.warning(f'Reclaimed {fname}, left claimed by process {pid}')
+
+    def retry (self):
+        """
+        Purges the papers of every saved batch, claiming each file so only
+        one worker retries it. A file is only removed once its batch was
+        flushed, and is put back for the next retry if the flush raised
+        """
+        self._reclaim()
+        for fname in sorted(os.listdir(self.retry_dir)):
+            if not fname.endswith('.json'):
+                continue
+            fpath = os.path.join(self.retry_dir, fname)
+            claimed = f'{fpath}.{self.pid}'
+            try:
+                os.rename(fpath, claimed)
+                # Renaming keeps the mtime of the save, claim_timeout runs from now
+                os.utime(claimed)
+            except FileNotFoundError:
+                continue
+            try:
+                with open(claimed) as f:
+                    saved = json.load(f)
+                papers = [tuple(paper) for paper in saved['papers']]
+                with self.cond:
+                    self.counts['retried'] += len(papers)
+                self.flush(papers, saved['attempts'])
+            except Exception:
+                os.rename(claimed, fpath)
+                raise
+            os.remove(claimed)
+
+    def stats (self) -> Dict[str, int]:
+        with self.cond:
+            return dict(self.counts, pending=len(self.pending),
+                        saved=sum(fname.endswith('.json') for fname in os.listdir(self.retry_dir)))
+
+_purge_queue_lock = threading.Lock()
+
+def get_purge_queue () -> PurgeQueue:
+    """ Returns the app's purge queue, starting it on first use in each process """
+    app = current_app._get_current_object()
+    with _purge_queue_lock:
+        queue: Optional[PurgeQueue] = app.extensions.get('purge_queue')
+        # Its thread doesn't survive a fork
+        if queue is None or queue.pid != os.getpid():
+            queue = app.extensions['purge_queue'] = PurgeQueue(
+                app,
+                app.config['FASTLY_PURGE_KEY'],
+                app.config['FASTLY_PURGE_WINDOW'],
+                app.config['FASTLY_PURGE_BATCH_SIZE'],
+                app.config['FASTLY_PURGE_RETRY_DIR'],
+                app.config['FASTLY_PURGE_RETRY_INTERVAL'],
+                app.config['FASTLY_PURGE_RETRY_MAX'],
+                app.config['FASTLY_PURGE_CLAIM_TIMEOUT'])
+        return queue
@@ -2,7 +2,6 @@
 from typing import Tuple, Dict
 from datetime import datetime
 import os
-from threading import Thread
 import logging
 import json
 from base64 import b64decode
@@ -11,26 +10,39 @@ import flask
 from flask import Blueprint, request, jsonify, \
     current_app, Response
 
-from .convert import process
+from .convert import process, repostprocess
 from .convert.batch_convert import batch_process
 from .convert.single_convert import single_convert, reconvert_submission
 from .publish import publish
 from .util import get_arxiv_id_from_blob
+from .executor import BoundedExecutor, get_executor, get_executors
+from .buckets.util import google_storage_client_stats
+from .publish.dedup import get_publish_dedup
+from .convert.planner import conversion_plan_stats
 
 logger = logging.getLogger()
 
-# FlaskThread pushes the Flask applcation context
-class FlaskThread(Thread):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.app = current_app._get_current_object()
+blueprint = Blueprint('routes', __name__)
 
-    def run(self):
-        with self.app.app_context():
-            super().run()
 
-blueprint = Blueprint('routes', __name__)
+def _conversion_executor () -> BoundedExecutor:
+    return get_executor(
+        'conversion',
+        current_app.config['CONVERSION_CONCURRENCY'],
+        current_app.config['CONVERSION_QUEUE_SIZE'])
+
+def _publish_executor () -> BoundedExecutor:
+    return get_executor(
+        'publish',
+        current_app.config['PUBLISH_CONCURRENCY'],
+        current_app.config['PUBLISH_QUEUE_SIZE'])
 
+def _submit_conversion (fn, *args) -> Tuple[str, int]:
+    """ Queues the conversion, or answers 429 so pub/sub redelivers it later """
+    if _conversion_executor().submit(fn, *args): # This requires cpu allocation always on in cloud run
+        return '', 200
+    logger.warning(f'Conversion queue full, rejecting {fn.__name__}{args}')
+    return '', 429
 
 # Unwraps payload and only starts processing if it is 
 # the desired format and a .tar.gz
@@ -55,36 +67,44 @@ def _unwrap_batch_conversion_payload (payload: Dict[str, str]) -> Tuple[str, str
         data['bucket']
     )
 
-def _unwrap_single_conversion_payload (payload: Dict[str, str]) -> Tuple[str, int]:
+# Explicit reconversions convert even if the planner would skip,
+# unless the message sets 'force' to false
+def _unwrap_single_conversion_payload (payload: Dict[str, str]) -> Tuple[str, int, bool]:
     data = json.loads(b64decode(payload['message']['data']).decode('utf-8'))
-    return data['paper_id'], data['version']
+    return data['paper_id'], data['version'], bool(data.get('force', True))
 
-def _unwrap_reconvert_sub_payload (payload: Dict[str, str]) -> Tuple[int]:
+def _unwrap_reconvert_sub_payload (payload: Dict[str, str]) -> Tuple[int, bool]:
     data = json.loads(b64decode(payload['message']['data']).decode('utf-8'))
-    return (data['submission_id'],)
+    return data['submission_id'], bool(data.get('force', True))
+
+def _unwrap_repostprocess_payload (payload: Dict[str, str]) -> Tuple[str, bool]:
+    data = json.loads(b64decode(payload['message']['data']).decode('utf-8'))
+    if 'submission_id' in data:
+        return str(data['submission_id']), True
+    return f"{data['paper_id']}v{data['version']}", False
 
 # The post request from the eventarc trigger that queries this route will come in this format:
 # https://github.com/googleapis/google-cloudevents/blob/main/proto/google/events/cloud/storage/v1/data.proto
 @blueprint.route('/process', methods=['POST'])
 def process_route () -> Response:
     """
-    Takes in the eventarc trigger payload and creates a thread
-    to perform the latexml conversion on the blob specified
-    in the payload.
+    Takes in the eventarc trigger payload and queues the
+    latexml conversion of the blob specified in the payload
+    on the conversion executor.
 
     Returns
     -------
     Response
-        Returns a 202 response with no payload
+        Returns a 202 response with no payload for extraneous
+        files, 200 once the conversion is queued and 429 if
+        the conversion queue is full
     """
     try:
         id, blob, bucket, single_file = _unwrap_payload(request.json)
     except Exception as e:
         return '', 202
     logger.info(f'Begin processing for {blob} from {bucket}')
-    thread = FlaskThread(target=process, args=(id, blob, bucket, single_file,)) # This requires cpu allocation always on in cloud run
-    thread.start()
-    return '', 200
+    return _submit_conversion(process, id, blob, bucket, single_file)
 
 @blueprint.route('/batch-convert', methods=['POST'])
 def batch_convert_route () -> Response:
@@ -93,20 +113,44 @@ def batch_convert_route () -> Response:
 
 @blueprint.route('/single-convert', methods=['POST'])
 def single_convert_route () -> Response:
-    thread = FlaskThread(target=single_convert, args=_unwrap_single_conversion_payload(request.json))
-    thread.start()
-    return '', 200
+    return _submit_conversion(single_convert, *_unwrap_single_conversion_payload(request.json))
 
 @blueprint.route('/reconvert-submission', methods=['POST'])
 def reprocess_submission () -> Response:
-    thread = FlaskThread(target=reconvert_submission, args=_unwrap_reconvert_sub_payload(request.json))
-    thread.start()
-    return '', 200
+    return _submit_conversion(reconvert_submission, *_unwrap_reconvert_sub_payload(request.json))
+
+@blueprint.route('/repostprocess', methods=['POST'])
+def repostprocess_route () -> Response:
+    """
+    Queues post processing the stored raw LaTeXML output of the
+    submission_id, or paper_id and version, in the pub/sub payload
+    again, without running LaTeXML
+
+    Returns
+    -------
+    Response
+        Returns 200 once queued and 429 if the conversion queue
+        is full
+    """
+    return _submit_conversion(repostprocess, *_unwrap_repostprocess_payload(request.json))
 
 @blueprint.route('/publish', methods=['POST'])
 def publish_route () -> Response:
-    publish(request.json)
-    return '', 202
+    """
+    Queues the publish of the submission in the pub/sub payload
+    on the publish executor, apart from conversions. The publish
+    retries itself if it fails, see publish.
+
+    Returns
+    -------
+    Response
+        Returns 202 once the publish is queued and 429 if the
+        publish queue is full
+    """
+    if _publish_executor().submit(publish, request.json):
+        return '', 202
+    logger.warning('Publish queue full, rejecting publish')
+    return '', 429
 
 @blueprint.route('/health', methods=['GET'])
 def health() -> tuple[flask.Response, int]:
@@ -116,11 +160,23 @@ def health() -> tuple[flask.Response, int]:
     Returns
     -------
     tuple[flask.Response, int]
-        List of current cloud run tasks and the current time.
+        List of current cloud run tasks, the current time and
+        the in flight and queued counts of each executor and
+        the GCS client creations, conversion plans, duplicate
+        publishes dropped and queued Fastly purges in this process.
     """
+    _conversion_executor()
+    _publish_executor()
+    # Only started by the first queued purge
+    purge_queue = current_app.extensions.get('purge_queue')
     data = {
         "time": datetime.now(),
-        "CLOUD_RUN_TASK_INDEX": list(os.environ.items())
+        "CLOUD_RUN_TASK_INDEX": list(os.environ.items()),
+        "executors": { name: executor.stats() for name, executor in get_executors().items() },
+        "gcs_client": google_storage_client_stats(),
+        "conversion_plans": conversion_plan_stats(),
+        "publish_dedup": get_publish_dedup().stats(),
+        "purge_queue": purge_queue.stats() if purge_queue else None
     }
     return jsonify(data), 200
     
\ No newline at end of file
@@ -1,14 +1,19 @@
-from typing import Any, Tuple, Optional
+from typing import Any, BinaryIO, Dict, Tuple, Optional
 from contextlib import contextmanager
+import hashlib
 import os
 import shutil
 import tarfile
 import gzip
 import re
+import time
+import zlib
 
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from filelock import FileLock
 
+from ..exceptions import TarError
+
 # arXiv ID format used from 1991 to 2007-03
 RE_ARXIV_OLD_ID = re.compile(
     r'^(?P<archive>[a-z]{1,}(\-[a-z]{2,})?)(\.([a-zA-Z\-]{2,}))?\/'
@@ -33,11 +38,98 @@ def get_arxiv_id_from_blob (blob: str) -> Optional[Tuple[str, bool]]:
     else:
         return None
 
+class GzipChecksum:
+    """
+    Writable file object that md5s the gunzipped bytes written
+    to it, optionally passing the compressed bytes through to dst.
+    Gives the same digest as md5ing gzip.open(fpath).read() but
+    can be filled while the source is being downloaded.
+    """
+
+    def __init__ (self, dst: Optional[BinaryIO] = None):
+        self.dst = dst
+        self._md5 = hashlib.md5()
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def write (self, data: bytes) -> int:
+        written = len(data)
+        if self.dst is not None:
+            self.dst.write(data)
+        while data:
+            if self._decompressor.eof:
+                # gzip allows zero padding between the members of a multi member file
+                data = data.lstrip(b'\x00')
+                if not data:
+                    break
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._md5.update(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data if self._decompressor.eof else b''
+        return written
+
+    def hexdigest (self) -> str:
+        return self._md5.hexdigest()
+
+class ChecksumReader:
+    """ Read only file object passing everything read from src to a GzipChecksum """
+
+    def __init__ (self, src: BinaryIO):
+        self.src = src
+        self.checksum = GzipChecksum()
+
+    def read (self, size: int = -1) -> bytes:
+        data = self.src.read(size)
+        self.checksum.write(data)
+        return data
+
+    def drain (self) -> str:
+        """ Reads whatever the consumer left, e.g. tar padding, and returns the checksum """
+        for _ in iter(lambda: self.read(1 << 16), b''):
+            pass
+        return self.checksum.hexdigest()
+
+def gzip_checksum (fpath: str) -> str:
+    """ The md5 of the gunzipped contents of fpath """
+    checksum = GzipChecksum()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            checksum.write(block)
+    return checksum.hexdigest()
+
 def untar (fpath: str, dir_name: str):
     with tarfile.open(fpath) as tar:
         tar.extractall(dir_name)
         tar.close()
 
+def _check_member (member: tarfile.TarInfo, root: str):
+    def inside (path: str) -> bool:
+        return os.path.commonpath([root, os.path.realpath(path)]) == root
+    dest = os.path.join(root, member.name)
+    if not inside(dest):
+        raise TarError(f'Tar entry {member.name} is outside the extraction directory')
+    if member.issym() and not inside(os.path.join(os.path.dirname(dest), member.linkname)):
+        raise TarError(f'Tar symlink {member.name} points outside the extraction directory')
+    if member.islnk() and not inside(os.path.join(root, member.linkname)):
+        raise TarError(f'Tar hardlink {member.name} points outside the extraction directory')
+    if member.isdev():
+        raise TarError(f'Tar entry {member.name} is a device or fifo')
+
+def untar_stream (fileobj: BinaryIO, dir_name: str):
+    """
+    Extracts a .tar.gz read sequentially from fileobj, one entry
+    at a time, rejecting entries that would land outside dir_name
+    """
+    root = os.path.realpath(dir_name)
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+        for member in tar:
+            # realpath in the check follows symlinks extracted earlier in the stream
+            _check_member(member, root)
+            tar.extract(member, dir_name)
+
+def unzip_single_file_stream (fileobj: BinaryIO, fpath: str):
+    with gzip.GzipFile(fileobj=fileobj) as ungzip:
+        with open(fpath, 'wb+') as out:
+            shutil.copyfileobj(ungzip, out)
+
 def unzip_single_file (fpath: str, dir_name: str):
     fname = f'{os.path.basename(fpath)[:-3]}.tex'
     with gzip.open(fpath) as ungzip:
@@ -65,4 +157,24 @@ def timeout(seconds: float):
     except TimeoutError:
         raise
     finally:
-        executor.shutdown(wait=False)
\ No newline at end of file
+        executor.shutdown(wait=False)
+
+class StageTimer:
+    """ Seconds spent in each named stage of a job, in the order the stages ran """
+
+    def __init__ (self):
+        self.seconds: Dict[str, float] = {}
+        self._start = self._last = time.perf_counter()
+
+    def lap (self, stage: str):
+        """ Ends stage, which began when the previous one ended """
+        now = time.perf_counter()
+        self.seconds[stage] = now - self._last
+        self._last = now
+
+    def total (self) -> float:
+        return self._last - self._start
+
+    def __str__ (self) -> str:
+        stages = ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in self.seconds.items())
+        return f'{stages or "no stages"} (total {self.total():.2f}s)'
@@ -0,0 +1,33 @@
+"""
+Stand-in for latexmls: listens on --port and answers every POST
+with a latexmls style json response, writing <html/> to dest.
+"""
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+class Handler (BaseHTTPRequestHandler):
+    def do_POST (self):
+        length = int(self.headers['Content-Length'])
+        options = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True)
+        with open(options['dest'][0], 'w') as f:
+            f.write('<html/>')
+        status_code = 3 if 'fatal' in options['source'][0] else 1
+        body = json.dumps({
+            'status_code': status_code,
+            'log': f"Warning:missing_file:foo Can't find package foo at {options['source'][0]} pid {os.getpid()}"
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message (self, *args):
+        pass
+
+if __name__ == '__main__':
+    port = int(next(a for a in sys.argv if a.startswith('--port=')).split('=')[1])
+    HTTPServer(('127.0.0.1', port), Handler).serve_forever()
@@ -1,18 +1,25 @@
 import pytest
+import os
+import shutil
+import tarfile
 
 from source.factory import create_web_app
 from source.models.util import (
     create_all,
     drop_all,
 )
+from tests.fake_fastly import FakeFastly
 
 LATEXML_DB_URI = 'sqlite:///:memory:?cache=latexml'
 CLASSIC_DATABASE_URI = 'sqlite:///:memory:'
 
 TESTING_CONFIG = {
     'IN_BUCKET_ARXIV_ID': 'latexml_arxiv_id_source',
+    'IN_BUCKET_SUB_ID': 'latexml_submission_source',
     'OUT_BUCKET_ARXIV_ID': 'latexml_arxiv_id_converted',
     'OUT_BUCKET_SUB_ID': 'latexml_submission_converted',
+    'RAW_LATEXML_SUBMISSION': 'latexml_raw_submission',
+    'RAW_LATEXML_DOC': 'latexml_raw_doc',
 
     'CLASSIC_DATABASE_URI': 'sqlite:///:memory:',
 
@@ -20,6 +27,43 @@ TESTING_CONFIG = {
     'QA_BUCKET_DOC': 'latexml_qa_doc',
 
     'LATEXML_COMMIT': 'test_commit_version',
+    'POSTPROCESS_VERSION': 'test_postprocess_version',
+    'FAILED_CONVERSION_RETRY_AFTER': 3600,
+
+    'VIEW_SUB_BASE': 'https://services.arxiv.org',
+    'VIEW_DOC_BASE': 'https://arxiv.org',
+    'HTML_REWRITE_MODE': 'soup',
+    'INGEST_MODE': 'download',
+    'IS_DEV': True,
+    'FASTLY_PURGE_KEY': 'no-key-dev',
+    'FASTLY_PURGE_TIMEOUT': 1,
+    'FASTLY_PURGE_ATTEMPTS': 2,
+    'FASTLY_SERVICE_ID': None,
+    'FASTLY_ABS_SURROGATE_KEY': 'abs-{paper_id}',
+    'FASTLY_API_URL': 'https://api.fastly.com',
+    'FASTLY_PURGE_MODE': 'direct',
+    'FASTLY_PURGE_WINDOW': 0.2,
+    'FASTLY_PURGE_BATCH_SIZE': 256,
+    'FASTLY_PURGE_RETRY_DIR': '/tmp/purge-retry',
+    'FASTLY_PURGE_RETRY_INTERVAL': 0.2,
+    'FASTLY_PURGE_RETRY_MAX': 2,
+    'FASTLY_PURGE_CLAIM_TIMEOUT': 60,
+
+    'CONVERSION_CONCURRENCY': 1,
+    'CONVERSION_QUEUE_SIZE': 1,
+    'PUBLISH_CONCURRENCY': 1,
+    'PUBLISH_QUEUE_SIZE': 1,
+    'PUBLISH_ATTEMPTS': 2,
+    'PUBLISH_RETRY_BACKOFF': 0,
+    'GCS_HTTP_POOL_SIZE': 4,
+    'UPLOAD_CONCURRENCY': 4,
+    'UPLOAD_CACHE_CONTROL': 'public, max-age=3600',
+    'ASSET_STORE_MODE': 'off',
+    'ASSET_STORE_BUCKET': None,
+    'ASSET_STORE_PREFIX': '_assets/',
+    'ASSET_STORE_MIN_BYTES': 512,
+    'PUBLISH_DEDUP_TTL': 60,
+    'PUBLISH_MODE': 'download',
 
     'LATEXML_DB_URI': LATEXML_DB_URI,
     'SQLALCHEMY_DATABASE_URI': CLASSIC_DATABASE_URI,
@@ -28,6 +72,8 @@ TESTING_CONFIG = {
     'LOCK_DIR': '/arxiv/locks'
 }
 
+SITE_TAR = 'tests/ancillary_files/5393936.tar.gz'
+
 def get_test_config():
     return TESTING_CONFIG.copy()
 
@@ -39,7 +85,33 @@ def app():
         create_all()
     return app
 
+@pytest.fixture
+def fake_fastly(app, tmp_path):
+    """ Points the app's surrogate key purges at a local FakeFastly """
+    fastly = FakeFastly().start()
+    app.config.update({
+        'FASTLY_API_URL': fastly.url,
+        'FASTLY_SERVICE_ID': 'test-service',
+        'FASTLY_PURGE_RETRY_DIR': str(tmp_path / 'purge-retry')
+    })
+    yield fastly
+    fastly.stop()
+
 @pytest.fixture
 def app_client(app):
     with app.app_context():
-        yield app.test_client()
\ No newline at end of file
+        yield app.test_client()
+
+@pytest.fixture
+def html_copies(tmp_path):
+    """ Returns a function making fresh copies of the converted 5393936.html """
+    assert os.path.exists(SITE_TAR), \
+        f'This test depends on {SITE_TAR}'
+    with tarfile.open(SITE_TAR) as tar:
+        tar.extractall(tmp_path)
+    src = os.path.join(tmp_path, '5393936', '5393936.html')
+    def copy(name: str) -> str:
+        dst = os.path.join(tmp_path, name)
+        shutil.copy(src, dst)
+        return dst
+    return copy
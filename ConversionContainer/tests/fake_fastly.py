@@ -0,0 +1,57 @@
+"""A local stand-in for the Fastly purge API"""
+from typing import Dict, List
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+class FakeFastly:
+    """
+    Answers POST /service/<id>/purge, recording the surrogate keys
+    and status of each request. fail_next makes the next n requests
+    answer 503.
+    """
+
+    def __init__ (self):
+        self.requests: List[Dict[str, str]] = []
+        self.failures = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler (BaseHTTPRequestHandler):
+            def do_POST (self):
+                with fake.lock:
+                    status = 503 if fake.failures > 0 else 200
+                    fake.failures -= status == 503
+                    fake.requests.append({
+                        'path': self.path,
+                        'key': self.headers.get('Fastly-Key'),
+                        'surrogate_keys': self.headers.get('Surrogate-Key', '').split(),
+                        'status': status
+                    })
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message (self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start (self) -> 'FakeFastly':
+        self._thread.start()
+        return self
+
+    def stop (self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail_next (self, n: int):
+        with self.lock:
+            self.failures = n
+
+    def purged_keys (self) -> List[str]:
+        """ Surrogate keys of every request that succeeded """
+        with self.lock:
+            return [key for request in self.requests if request['status'] == 200
+                    for key in request['surrogate_keys']]
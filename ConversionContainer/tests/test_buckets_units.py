@@ -0,0 +1,311 @@
+import pytest
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+from unittest.mock import MagicMock
+
+from source.buckets import upload_dir_to_gcs, upload_objects_to_gcs, extract_blob
+from source.buckets import util as bucket_util
+from source.util import gzip_checksum
+from source.publish.buckets import copy_sub_to_doc_bucket
+from source.exceptions import TarError
+
+SITE_TAR = 'tests/ancillary_files/5393936.tar.gz'
+
+FILES = {
+    '2402.00001v1/2402.00001v1.html': b'<html></html>',
+    '2402.00001v1/x1.png': b'\x89PNG' + b'\x00' * 1000,
+    '2402.00001v1/figures/x2.svg': b'<svg/>',
+}
+
+@pytest.fixture
+def site_dir (tmp_path):
+    for name, data in FILES.items():
+        fpath = os.path.join(tmp_path, name)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, 'wb') as f:
+            f.write(data)
+    return str(tmp_path)
+
+@pytest.fixture
+def mock_bucket (mocker):
+    """ Returns the mock bucket and the blobs it handed out by name """
+    blobs, lock = {}, threading.Lock()
+    def blob (name):
+        with lock:
+            blobs.setdefault(name, MagicMock())
+            return blobs[name]
+    bucket = MagicMock()
+    bucket.blob.side_effect = blob
+    client = MagicMock()
+    client.bucket.return_value = bucket
+    mocker.patch('source.buckets.util.get_google_storage_client', return_value=client)
+    mocker.patch('source.buckets.upload.UPLOAD_BACKOFF', 0)
+    return bucket, blobs
+
+@pytest.fixture
+def fresh_client_state (mocker):
+    """ Forgets any shared client and counts storage.Client constructions """
+    mocker.patch.object(bucket_util, '_client', None)
+    mocker.patch.object(bucket_util, '_client_pid', None)
+    mocker.patch.object(bucket_util, '_client_creations', 0)
+    return mocker.patch('source.buckets.util.storage.Client', side_effect=lambda: MagicMock())
+
+"""
+******************************
+**** storage client tests ****
+******************************
+"""
+
+@pytest.mark.buckets_unit_tests
+def test_storage_client_is_shared (app, fresh_client_state):
+    clients = []
+    def get_client ():
+        with app.app_context():
+            clients.append(bucket_util.get_google_storage_client())
+    threads = [threading.Thread(target=get_client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = bucket_util.google_storage_client_stats()
+
+    assert fresh_client_state.call_count == 1, \
+        f'storage.Client was constructed {fresh_client_state.call_count} times'
+    assert all(client is clients[0] for client in clients), 'Threads got different clients'
+    assert stats['creations'] == 1, f'Incorrect creations {stats}'
+    adapter = clients[0]._http.mount.call_args.args[1]
+    assert adapter._pool_maxsize == app.config['GCS_HTTP_POOL_SIZE'], \
+        'Connection pool not sized from GCS_HTTP_POOL_SIZE'
+
+@pytest.mark.buckets_unit_tests
+def test_storage_client_recreated_after_fork (app, fresh_client_state, mocker):
+    with app.app_context():
+        parent = bucket_util.get_google_storage_client()
+        mocker.patch('source.buckets.util.os.getpid', return_value=os.getpid() + 1)
+        child = bucket_util.get_google_storage_client()
+        assert bucket_util.get_google_storage_client() is child, 'Child did not reuse its client'
+
+    assert child is not parent, 'Forked worker reused the parent\'s client'
+    assert bucket_util.google_storage_client_stats()['creations'] == 2, \
+        'Client creations were not counted'
+
+"""
+******************************
+**** upload_dir tests ********
+******************************
+"""
+
+@pytest.mark.buckets_unit_tests
+def test_upload_dir_manifest (app, site_dir, mock_bucket):
+    _, blobs = mock_bucket
+    with app.app_context():
+        manifest = upload_dir_to_gcs(site_dir, 'latexml_arxiv_id_converted')
+
+    assert manifest['bucket'] == 'latexml_arxiv_id_converted', \
+        f'Incorrect bucket {manifest["bucket"]}'
+    assert {o['name']: o['bytes'] for o in manifest['objects']} == \
+        { name: len(data) for name, data in FILES.items() }, \
+        'Manifest does not list every object with its size'
+    assert manifest['bytes'] == sum(len(data) for data in FILES.values()), \
+        f'Incorrect total bytes {manifest["bytes"]}'
+
+    content_types = {
+        name: blob.upload_from_filename.call_args.kwargs['content_type']
+        for name, blob in blobs.items()
+    }
+    assert content_types == {
+        '2402.00001v1/2402.00001v1.html': 'text/html; charset=utf-8',
+        '2402.00001v1/x1.png': 'image/png',
+        '2402.00001v1/figures/x2.svg': 'image/svg+xml'
+    }, f'Incorrect content types {content_types}'
+    assert all(blob.cache_control == app.config['UPLOAD_CACHE_CONTROL'] for blob in blobs.values()), \
+        'Cache-Control not set on every object'
+
+@pytest.mark.buckets_unit_tests
+def test_upload_dir_retries_object (app, site_dir, mock_bucket):
+    bucket, blobs = mock_bucket
+    flaky = bucket.blob('2402.00001v1/x1.png')
+    flaky.upload_from_filename.side_effect = [ConnectionError('reset'), None]
+    with app.app_context():
+        manifest = upload_dir_to_gcs(site_dir, 'latexml_arxiv_id_converted')
+
+    attempts = { o['name']: o['attempts'] for o in manifest['objects'] }
+    assert attempts['2402.00001v1/x1.png'] == 2, 'Failed upload was not retried'
+    assert attempts['2402.00001v1/2402.00001v1.html'] == 1, 'Successful upload was retried'
+
+@pytest.mark.buckets_unit_tests
+def test_upload_dir_raises_after_attempts (app, site_dir, mock_bucket):
+    bucket, _ = mock_bucket
+    bucket.blob('2402.00001v1/x1.png').upload_from_filename.side_effect = ConnectionError('reset')
+    with app.app_context():
+        with pytest.raises(ConnectionError):
+            upload_dir_to_gcs(site_dir, 'latexml_arxiv_id_converted')
+
+def _tar_gz (*members: tarfile.TarInfo) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for member in members:
+            tar.addfile(member, io.BytesIO(b'x' * member.size) if member.isfile() else None)
+    return buf.getvalue()
+
+def _file (name: str) -> tarfile.TarInfo:
+    member = tarfile.TarInfo(name)
+    member.size = 1
+    return member
+
+def _link (name: str, target: str, type: bytes = tarfile.SYMTYPE) -> tarfile.TarInfo:
+    member = tarfile.TarInfo(name)
+    member.type = type
+    member.linkname = target
+    return member
+
+@pytest.fixture
+def mock_source_blob (mocker):
+    """ Serves data as the source blob at generation 7, returns the mock bucket """
+    def serve (data: bytes):
+        bucket = MagicMock()
+        bucket.get_blob.return_value = MagicMock(generation=7)
+        bucket.blob.return_value.open.side_effect = lambda *args, **kwargs: io.BytesIO(data)
+        client = MagicMock()
+        client.bucket.return_value = bucket
+        mocker.patch('source.buckets.util.get_google_storage_client', return_value=client)
+        return bucket
+    return serve
+
+"""
+******************************
+**** extract_blob tests ******
+******************************
+"""
+
+@pytest.mark.buckets_unit_tests
+def test_extract_blob_tar (mock_source_blob, tmp_path):
+    with open(SITE_TAR, 'rb') as f:
+        bucket = mock_source_blob(f.read())
+    dst = os.path.join(tmp_path, 'extracted')
+    os.makedirs(dst)
+
+    tex_checksum, generation = extract_blob('bucket', '5393936/5393936.tar.gz', dst)
+
+    assert os.path.exists(os.path.join(dst, '5393936', '5393936.html')), 'Tarball was not extracted'
+    assert tex_checksum == gzip_checksum(SITE_TAR), f'Incorrect checksum: {tex_checksum}'
+    assert generation == 7, f'Incorrect generation {generation}'
+    assert bucket.blob.call_args.kwargs['generation'] == 7, 'Stream was not pinned to the generation'
+
+@pytest.mark.buckets_unit_tests
+def test_extract_blob_single_file (mock_source_blob, tmp_path):
+    mock_source_blob(gzip.compress(b'\\documentclass{article}'))
+    tex_checksum, _ = extract_blob('bucket', '1/1.gz', str(tmp_path), 'main.tex')
+    with open(os.path.join(tmp_path, 'main.tex'), 'rb') as f:
+        assert f.read() == b'\\documentclass{article}', 'Single file was not gunzipped'
+    assert tex_checksum == hashlib.md5(b'\\documentclass{article}').hexdigest(), \
+        f'Incorrect checksum: {tex_checksum}'
+
+@pytest.mark.buckets_unit_tests
+@pytest.mark.parametrize('members', [
+    [_file('../escaped.txt')],
+    [_file('/tmp/absolute.txt')],
+    [_link('link', '../..'), _file('link/escaped.txt')],
+    [_link('hard', '../escaped.txt', tarfile.LNKTYPE)],
+], ids=['dotdot', 'absolute', 'symlink', 'hardlink'])
+def test_extract_blob_rejects_path_traversal (mock_source_blob, tmp_path, members):
+    mock_source_blob(_tar_gz(_file('main.tex'), *members))
+    dst = os.path.join(tmp_path, 'a', 'extracted')
+    os.makedirs(dst)
+    with pytest.raises(TarError):
+        extract_blob('bucket', '1/1.tar.gz', dst)
+    assert not os.path.exists(os.path.join(tmp_path, 'a', 'escaped.txt')), \
+        'Entry was written outside the extraction directory'
+
+"""
+******************************
+**** asset store tests *******
+******************************
+"""
+
+@pytest.fixture
+def mock_asset_bucket (mock_bucket):
+    """ mock_bucket whose get_blob and rewrite know which objects were uploaded """
+    bucket, blobs = mock_bucket
+    stored = set()
+    def blob (name):
+        b = blobs.setdefault(name, MagicMock())
+        b.upload_from_filename.side_effect = lambda *args, **kwargs: stored.add(name)
+        b.rewrite.side_effect = lambda source, token=None: (stored.add(name), (None, 0, 0))[1]
+        return b
+    bucket.blob.side_effect = blob
+    bucket.get_blob.side_effect = lambda name: blobs[name] if name in stored else None
+    return bucket, blobs
+
+@pytest.mark.buckets_unit_tests
+def test_upload_dir_asset_store (app, site_dir, tmp_path, mock_asset_bucket):
+    _, blobs = mock_asset_bucket
+    png = FILES['2402.00001v1/x1.png']
+    asset = f'_assets/{hashlib.sha256(png).hexdigest()}.png'
+    app.config['ASSET_STORE_MODE'] = 'content'
+    with app.app_context():
+        v1 = upload_dir_to_gcs(site_dir, 'latexml_arxiv_id_converted')
+        # The next version ships the same figure
+        os.rename(os.path.join(site_dir, '2402.00001v1'), os.path.join(site_dir, '2402.00001v2'))
+        v2 = upload_dir_to_gcs(site_dir, 'latexml_arxiv_id_converted')
+
+    by_name = { o['name']: o for o in v1['objects'] + v2['objects'] }
+    assert by_name['2402.00001v1/x1.png']['asset'] == asset, 'Figure not copied from the asset store'
+    assert (by_name['2402.00001v1/x1.png']['bytes_uploaded'], by_name['2402.00001v2/x1.png']['bytes_uploaded']) \
+        == (len(png), 0), 'Figure was uploaded again for v2'
+    assert blobs[asset].upload_from_filename.call_count == 1, 'Asset uploaded more than once'
+    assert blobs[asset].upload_from_filename.call_args.kwargs['if_generation_match'] == 0, \
+        'Asset upload could overwrite an existing asset'
+    for name in ('2402.00001v1/x1.png', '2402.00001v2/x1.png'):
+        assert not blobs[name].upload_from_filename.called, f'{name} was uploaded instead of copied'
+        assert blobs[name].rewrite.call_args.args[0] is blobs[asset], f'{name} not rewritten from the asset'
+        assert (blobs[name].content_type, blobs[name].cache_control) == \
+            ('image/png', app.config['UPLOAD_CACHE_CONTROL']), f'{name} copied without its metadata'
+    # Below ASSET_STORE_MIN_BYTES, and html, are uploaded directly
+    for name in ('2402.00001v2/2402.00001v1.html', '2402.00001v2/figures/x2.svg'):
+        assert 'asset' not in by_name[name] and blobs[name].upload_from_filename.called, \
+            f'{name} was not uploaded directly'
+    assert v2['bytes_uploaded'] == v2['bytes'] - len(png), f'Incorrect bytes uploaded {v2["bytes_uploaded"]}'
+
+"""
+******************************
+*** submission object tests **
+******************************
+"""
+
+@pytest.mark.buckets_unit_tests
+def test_publish_copies_stored_objects (app, site_dir, tmp_path, mock_bucket, mocker, monkeypatch):
+    bucket, blobs = mock_bucket
+    os.rename(os.path.join(site_dir, '2402.00001v1'), os.path.join(site_dir, '1234'))
+    os.rename(os.path.join(site_dir, '1234', '2402.00001v1.html'), os.path.join(site_dir, '1234', '1234.html'))
+    stale = MagicMock()
+    stale.name = '1234/old.png'
+    bucket.list_blobs.return_value = [stale]
+    handed_out = bucket.blob.side_effect
+    def blob (name):
+        b = handed_out(name)
+        b.rewrite.return_value = (None, 0, 0)
+        return b
+    bucket.blob.side_effect = blob
+    with app.app_context():
+        upload_objects_to_gcs(1234, site_dir, 'latexml_submission_converted')
+        listing = blobs['1234.objects.json'].upload_from_string.call_args.args[0]
+        bucket.get_blob.return_value.download_as_text.return_value = listing
+        monkeypatch.chdir(tmp_path)
+        download = mocker.patch('source.publish.buckets.download_blob')
+        html_file = copy_sub_to_doc_bucket(1234, '2402.00001v1')
+
+    assert stale.delete.called, 'Object of a previous conversion kept'
+    assert sorted(json.loads(listing)['names']) == ['1234.html', 'figures/x2.svg', 'x1.png'], \
+        f'Incorrect object listing {listing}'
+    for name in ('x1.png', 'figures/x2.svg'):
+        assert blobs[f'2402.00001v1/{name}'].rewrite.call_args.args[0] is blobs[f'1234/{name}'], \
+            f'{name} not copied server side'
+    assert '2402.00001v1/1234.html' not in blobs, 'Html copied before post processing'
+    assert download.call_args.args[1:] == ('1234/1234.html', html_file) \
+        and html_file == 'sites/1234/2402.00001v1/2402.00001v1.html', 'Html not downloaded for post processing'
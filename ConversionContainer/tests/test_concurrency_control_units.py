@@ -3,16 +3,24 @@ from unittest.mock import MagicMock
 from typing import Optional, Any
 from flask_sqlalchemy.query import Query
 import os
+import gzip
+import hashlib
+import io
 
 from source.models.util import (
     transaction,
     now
 )
 from source.models.db import DBLaTeXMLDocuments, DBLaTeXMLSubmissions
-from source.convert.concurrency_control import write_start, write_success
+from source.convert.concurrency_control import write_start, write_success, write_failure, write_postprocessed
+from source.util import GzipChecksum, gzip_checksum
 
 from time import sleep
 
+# Stand in GCS generations of the source blobs in ancillary_files
+GENERATION_2012_02205 = 1708000000000002
+GENERATION_3966840 = 1708000000000001
+
 # @pytest.fixture(autouse=True)
 # def change_test_dir(request, monkeypatch):
 #     monkeypatch.chdir(request.fspath.dirname)
@@ -21,6 +29,7 @@ from time import sleep
 def insert_into_sub():
     def insert(sub_id: int, conversion_status: int,
                latexml_version: str, tex_checksum: str,
+               source_generation: int,
                conversion_start_time: int,
                conversion_end_time: Optional[int] = None) -> bool:
         with transaction() as session:
@@ -30,6 +39,7 @@ def insert_into_sub():
                     conversion_status=conversion_status,
                     latexml_version=latexml_version,
                     tex_checksum=tex_checksum,
+                    source_generation=source_generation,
                     conversion_start_time=conversion_start_time,
                     conversion_end_time=conversion_end_time
                 )
@@ -50,6 +60,7 @@ def insert_into_doc():
     def insert(paper_id: str, document_version: int, 
                conversion_status: int, latexml_version: str, 
                tex_checksum: str,
+               source_generation: int,
                conversion_start_time: int,
                conversion_end_time: Optional[int] = None) -> bool:
         with transaction() as session:
@@ -60,6 +71,7 @@ def insert_into_doc():
                     conversion_status=conversion_status,
                     latexml_version=latexml_version,
                     tex_checksum=tex_checksum,
+                    source_generation=source_generation,
                     conversion_start_time=conversion_start_time,
                     conversion_end_time=conversion_end_time
                 )
@@ -77,6 +89,40 @@ def select_from_doc():
     return select
 
 
+"""
+******************************
+***** checksum tests *********
+******************************
+"""
+
+@pytest.mark.cc_unit_tests
+@pytest.mark.parametrize('chunk_size', [1 << 16, 4093, 1])
+def test_gzip_checksum_streamed_matches_gunzip (chunk_size):
+    assert os.path.exists('tests/ancillary_files/5393936.tar.gz'), \
+        'This test depends on tests/ancillary_files/5393936.tar.gz'
+    with open('tests/ancillary_files/5393936.tar.gz', 'rb') as f:
+        data = f.read()
+    # Second member after zero padding, as gzip.open accepts
+    data += b'\x00' * 4 + gzip.compress(b'second member')
+
+    checksum = GzipChecksum()
+    for i in range(0, len(data), chunk_size):
+        checksum.write(data[i:i + chunk_size])
+
+    with gzip.open(io.BytesIO(data)) as f:
+        expected = hashlib.md5(f.read()).hexdigest()
+    assert checksum.hexdigest() == expected, \
+        f'Incorrect checksum: {checksum.hexdigest()}'
+
+@pytest.mark.cc_unit_tests
+def test_gzip_checksum_passes_through (tmp_path):
+    dst = os.path.join(tmp_path, 'copy.tar.gz')
+    with open('tests/ancillary_files/5393936.tar.gz', 'rb') as src, open(dst, 'wb') as f:
+        checksum = GzipChecksum(f)
+        checksum.write(src.read())
+    assert gzip_checksum(dst) == checksum.hexdigest(), \
+        'Passed through file differs from the bytes checksummed'
+
 """
 ******************************
 ***** write_start tests ******
@@ -88,7 +134,7 @@ def test_write_start_sub_simple (app, select_from_sub):
     assert os.path.exists('tests/ancillary_files/3966840.tar.gz'), \
         'This test depends on tests/ancillary_files/3966840.tar.gz'
     with app.app_context():
-        write_start(1, 'tests/ancillary_files/3966840.tar.gz', 'sub')
+        write_start(1, gzip_checksum('tests/ancillary_files/3966840.tar.gz'), GENERATION_3966840, 'sub')
 
         row: Optional[Query] = select_from_sub(1)
         assert row is not None, 'Failed to write row'
@@ -96,6 +142,8 @@ def test_write_start_sub_simple (app, select_from_sub):
             f'Incorrect conversion_status \'{row.conversion_status}\' should be 0'
         assert row.tex_checksum == '7fba16945d97c8828f6f7c255bd1ab10', \
             f'Incorrect checksum: {row.tex_checksum}'
+        assert row.source_generation == GENERATION_3966840, \
+            f'Incorrect source_generation: {row.source_generation}'
         
 @pytest.mark.cc_unit_tests
 def test_write_start_sub_overlap (app, select_from_sub):
@@ -104,10 +152,10 @@ def test_write_start_sub_overlap (app, select_from_sub):
     assert os.path.exists('tests/ancillary_files/2012.02205.tar.gz'), \
         'This test depends on tests/ancillary_files/2012.02205.tar.gz'
     with app.app_context():
-        write_start(1, 'tests/ancillary_files/2012.02205.tar.gz', 'sub')
+        write_start(1, gzip_checksum('tests/ancillary_files/2012.02205.tar.gz'), GENERATION_2012_02205, 'sub')
         old_ts = select_from_sub(1).conversion_start_time
         sleep(1)
-        write_start(1, 'tests/ancillary_files/3966840.tar.gz', 'sub')
+        write_start(1, gzip_checksum('tests/ancillary_files/3966840.tar.gz'), GENERATION_3966840, 'sub')
 
         row: Optional[Query] = select_from_sub(1)
         assert row is not None, 'Failed to write row'
@@ -115,6 +163,8 @@ def test_write_start_sub_overlap (app, select_from_sub):
             f'Incorrect conversion_status \'{row.conversion_status}\' should be 0'
         assert row.tex_checksum == '7fba16945d97c8828f6f7c255bd1ab10', \
             f'Incorrect checksum: {row.tex_checksum}'
+        assert row.source_generation == GENERATION_3966840, \
+            f'Incorrect source_generation: {row.source_generation}'
         assert row.conversion_start_time > old_ts, \
             f'Start timestamp is not later on second write: \
             {row.conversion_start_time} ≯ {old_ts}'
@@ -124,7 +174,7 @@ def test_write_start_sub_overlap (app, select_from_sub):
 #     assert os.path.exists('tests/ancillary_files/2012.02205.tar.gz'), \
 #         'This test depends on tests/ancillary_files/2012.02205.tar.gz'
 #     with app.app_context():
-#         write_start('2012.02205', 'tests/ancillary_files/2012.02205.tar.gz', False)
+#         write_start('2012.02205', gzip_checksum('tests/ancillary_files/2012.02205.tar.gz'), GENERATION_2012_02205, False)
 
 #         row: Query = select_from_doc('2012.02205', 1)
 #         assert row is not None, 'Failed to write row'
@@ -138,7 +188,7 @@ def test_write_start_doc_with_version_simple (app, select_from_doc):
     assert os.path.exists('tests/ancillary_files/2012.02205.tar.gz'), \
         'This test depends on tests/ancillary_files/2012.02205.tar.gz'
     with app.app_context():
-        write_start('2012.02205v2', 'tests/ancillary_files/2012.02205.tar.gz', False)
+        write_start('2012.02205v2', gzip_checksum('tests/ancillary_files/2012.02205.tar.gz'), GENERATION_2012_02205, False)
 
         row: Optional[Query] = select_from_doc('2012.02205', 2)
         assert row is not None, 'Failed to write row'
@@ -146,14 +196,16 @@ def test_write_start_doc_with_version_simple (app, select_from_doc):
             f'Incorrect conversion_status \'{row.conversion_status}\' should be 0'
         assert row.tex_checksum == '5a67f1a2f9b1b436f2bd604e0131cf3a', \
             f'Incorrect checksum: {row.tex_checksum}'
+        assert row.source_generation == GENERATION_2012_02205, \
+            f'Incorrect source_generation: {row.source_generation}'
         
 @pytest.mark.cc_unit_tests
 def test_write_start_doc_multiple_versions (app, select_from_doc):
     assert os.path.exists('tests/ancillary_files/2012.02205.tar.gz'), \
         'This test depends on tests/ancillary_files/2012.02205.tar.gz'
     with app.app_context():
-        write_start('2012.02205v1', 'tests/ancillary_files/2012.02205.tar.gz', False)
-        write_start('2012.02205v2', 'tests/ancillary_files/3966840.tar.gz', False) 
+        write_start('2012.02205v1', gzip_checksum('tests/ancillary_files/2012.02205.tar.gz'), GENERATION_2012_02205, False)
+        write_start('2012.02205v2', gzip_checksum('tests/ancillary_files/3966840.tar.gz'), GENERATION_3966840, False) 
 
         row_v1: Optional[Query] = select_from_doc('2012.02205', 1)
         assert row_v1 is not None, 'Failed to write row'
@@ -161,6 +213,8 @@ def test_write_start_doc_multiple_versions (app, select_from_doc):
             f'Incorrect conversion_status \'{row_v1.conversion_status}\' should be 0'
         assert row_v1.tex_checksum == '5a67f1a2f9b1b436f2bd604e0131cf3a', \
             f'Incorrect checksum: {row_v1.tex_checksum}'
+        assert row_v1.source_generation == GENERATION_2012_02205, \
+            f'Incorrect source_generation: {row_v1.source_generation}'
         
         row_v2: Optional[Query] = select_from_doc('2012.02205', 2)
         assert row_v2 is not None, 'Failed to write row'
@@ -168,16 +222,18 @@ def test_write_start_doc_multiple_versions (app, select_from_doc):
             f'Incorrect conversion_status \'{row_v2.conversion_status}\' should be 0'
         assert row_v2.tex_checksum == '7fba16945d97c8828f6f7c255bd1ab10', \
             f'Incorrect checksum: {row_v2.tex_checksum}'
+        assert row_v2.source_generation == GENERATION_3966840, \
+            f'Incorrect source_generation: {row_v2.source_generation}'
         
 @pytest.mark.cc_unit_tests
 def test_write_start_doc_overlap (app, select_from_doc):
     assert os.path.exists('tests/ancillary_files/2012.02205.tar.gz'), \
         'This test depends on tests/ancillary_files/2012.02205.tar.gz'
     with app.app_context():
-        write_start('2012.02205v1', 'tests/ancillary_files/2012.02205.tar.gz', False)
+        write_start('2012.02205v1', gzip_checksum('tests/ancillary_files/2012.02205.tar.gz'), GENERATION_2012_02205, False)
         old_ts = select_from_doc('2012.02205', 1).conversion_start_time
         sleep(1)
-        write_start('2012.02205v1', 'tests/ancillary_files/3966840.tar.gz', False)
+        write_start('2012.02205v1', gzip_checksum('tests/ancillary_files/3966840.tar.gz'), GENERATION_3966840, False)
 
         row: Optional[Query] = select_from_doc('2012.02205', 1)
         assert row is not None, 'Failed to write row'
@@ -185,6 +241,8 @@ def test_write_start_doc_overlap (app, select_from_doc):
             f'Incorrect conversion_status \'{row.conversion_status}\' should be 0'
         assert row.tex_checksum == '7fba16945d97c8828f6f7c255bd1ab10', \
             f'Incorrect checksum: {row.tex_checksum}'
+        assert row.source_generation == GENERATION_3966840, \
+            f'Incorrect source_generation: {row.source_generation}'
         assert row.conversion_start_time > old_ts, \
             f'Start timestamp is not later on second write: \
             {row.conversion_start_time} ≯ {old_ts}'
@@ -194,10 +252,10 @@ def test_write_start_doc_overlap_with_version (app, select_from_doc):
     assert os.path.exists('tests/ancillary_files/2012.02205.tar.gz'), \
         'This test depends on tests/ancillary_files/2012.02205.tar.gz'
     with app.app_context():        
-        write_start('2012.02205v3', 'tests/ancillary_files/2012.02205.tar.gz', False)
+        write_start('2012.02205v3', gzip_checksum('tests/ancillary_files/2012.02205.tar.gz'), GENERATION_2012_02205, False)
         old_ts = select_from_doc('2012.02205', 3).conversion_start_time
         sleep(1)
-        write_start('2012.02205v3', 'tests/ancillary_files/3966840.tar.gz', False)
+        write_start('2012.02205v3', gzip_checksum('tests/ancillary_files/3966840.tar.gz'), GENERATION_3966840, False)
 
         row: Optional[Query] = select_from_doc('2012.02205', 3)
         assert row is not None, 'Failed to write row'
@@ -205,6 +263,8 @@ def test_write_start_doc_overlap_with_version (app, select_from_doc):
             f'Incorrect conversion_status \'{row.conversion_status}\' should be 0'
         assert row.tex_checksum == '7fba16945d97c8828f6f7c255bd1ab10', \
             f'Incorrect checksum: {row.tex_checksum}'
+        assert row.source_generation == GENERATION_3966840, \
+            f'Incorrect source_generation: {row.source_generation}'
         assert row.conversion_start_time > old_ts, \
             f'Start timestamp is not later on second write: \
             {row.conversion_start_time} ≯ {old_ts}'
@@ -227,11 +287,12 @@ def test_write_success_sub_simple (app, insert_into_sub, select_from_sub):
             conversion_status=0,
             latexml_version=app.config['LATEXML_COMMIT'],
             tex_checksum='5a67f1a2f9b1b436f2bd604e0131cf3a',
+            source_generation=GENERATION_2012_02205,
             conversion_start_time=now()
         )
         sleep(1)
 
-        result = write_success(1, 'tests/ancillary_files/2012.02205.tar.gz', 'sub')
+        result = write_success(1, GENERATION_2012_02205, 'sub')
 
         row: Optional[Query] = select_from_sub (1)
         assert row is not None, 'Insert failed to write. Check test db configuration'
@@ -258,12 +319,13 @@ def test_write_success_sub_overlap (app, insert_into_sub, select_from_sub):
             conversion_status=0,
             latexml_version=app.config['LATEXML_COMMIT'],
             tex_checksum='5a67f1a2f9b1b436f2bd604e0131cf3a',
+            source_generation=GENERATION_2012_02205,
             conversion_start_time=now()
         )
         sleep(1)
 
         # Emulate old version being written while new is still processing
-        old_version_result = write_success(1, 'tests/ancillary_files/3966840.tar.gz', 'sub')
+        old_version_result = write_success(1, GENERATION_3966840, 'sub')
         sleep(1)
 
         row: Optional[Query] = select_from_sub (1)
@@ -277,7 +339,7 @@ def test_write_success_sub_overlap (app, insert_into_sub, select_from_sub):
         assert not old_version_result, 'write_success should return False'
 
         # Now new version finishes processing
-        new_version_result = write_success(1, 'tests/ancillary_files/2012.02205.tar.gz', 'sub')
+        new_version_result = write_success(1, GENERATION_2012_02205, 'sub')
 
         row: Optional[Query] = select_from_sub (1)
         assert row is not None, 'Row is None'
@@ -304,12 +366,13 @@ def test_write_success_sub_overlap_out_of_order (app, insert_into_sub, select_fr
             conversion_status=0,
             latexml_version=app.config['LATEXML_COMMIT'],
             tex_checksum='5a67f1a2f9b1b436f2bd604e0131cf3a',
+            source_generation=GENERATION_2012_02205,
             conversion_start_time=now()
         )
         sleep(1)
 
         # Emulate new version beating the old version through the system
-        new_version_result = write_success(1, 'tests/ancillary_files/2012.02205.tar.gz', 'sub')
+        new_version_result = write_success(1, GENERATION_2012_02205, 'sub')
         sleep(1)
 
         row: Optional[Query] = select_from_sub (1)
@@ -327,7 +390,7 @@ def test_write_success_sub_overlap_out_of_order (app, insert_into_sub, select_fr
         assert new_version_result, 'write_success should return True'
         
         # Now new version finishes processing
-        old_version_result = write_success(1, 'tests/ancillary_files/3966840.tar.gz', 'sub')
+        old_version_result = write_success(1, GENERATION_3966840, 'sub')
 
         row: Optional[Query] = select_from_sub (1)
         assert row is not None, 'Row is None'
@@ -352,11 +415,12 @@ def test_write_success_doc_simple (app, insert_into_doc, select_from_doc):
             conversion_status=0,
             latexml_version=app.config['LATEXML_COMMIT'],
             tex_checksum='5a67f1a2f9b1b436f2bd604e0131cf3a',
+            source_generation=GENERATION_2012_02205,
             conversion_start_time=now()
         )
         sleep(1)
 
-        result = write_success('2012.02205v1', 'tests/ancillary_files/2012.02205.tar.gz', False)
+        result = write_success('2012.02205v1', GENERATION_2012_02205, False)
 
         row: Optional[Query] = select_from_doc ('2012.02205', 1)
         assert row is not None, 'Insert failed to write. Check test db configuration'
@@ -384,12 +448,13 @@ def test_write_success_doc_overlap (app, insert_into_doc, select_from_doc):
             conversion_status=0,
             latexml_version=app.config['LATEXML_COMMIT'],
             tex_checksum='5a67f1a2f9b1b436f2bd604e0131cf3a',
+            source_generation=GENERATION_2012_02205,
             conversion_start_time=now()
         )
         sleep(1)
 
         # Emulate old version being written while new is still processing
-        old_version_result = write_success('2012.02205v3', 'tests/ancillary_files/3966840.tar.gz', False)
+        old_version_result = write_success('2012.02205v3', GENERATION_3966840, False)
         sleep(1)
 
         row: Optional[Query] = select_from_doc ('2012.02205', 3)
@@ -403,7 +468,7 @@ def test_write_success_doc_overlap (app, insert_into_doc, select_from_doc):
         assert not old_version_result, 'write_success should return False'
 
         # Now new version finishes processing
-        new_version_result = write_success('2012.02205v3', 'tests/ancillary_files/2012.02205.tar.gz', False)
+        new_version_result = write_success('2012.02205v3', GENERATION_2012_02205, False)
 
         row: Optional[Query] = select_from_doc ('2012.02205', 3)
         assert row is not None, 'Row is None'
@@ -431,12 +496,13 @@ def test_write_success_doc_overlap_out_of_order (app, insert_into_doc, select_fr
             conversion_status=0,
             latexml_version=app.config['LATEXML_COMMIT'],
             tex_checksum='5a67f1a2f9b1b436f2bd604e0131cf3a',
+            source_generation=GENERATION_2012_02205,
             conversion_start_time=now()
         )
         sleep(1)
 
         # Emulate new version beating the old version through the system
-        new_version_result = write_success('2012.02205v3', 'tests/ancillary_files/2012.02205.tar.gz', False)
+        new_version_result = write_success('2012.02205v3', GENERATION_2012_02205, False)
         sleep(1)
 
         row: Optional[Query] = select_from_doc ('2012.02205', 3)
@@ -454,7 +520,7 @@ def test_write_success_doc_overlap_out_of_order (app, insert_into_doc, select_fr
         assert new_version_result, 'write_success should return True'
 
         # Now new version finishes processing
-        old_version_result = write_success('2012.02205v3', 'tests/ancillary_files/3966840.tar.gz', False)
+        old_version_result = write_success('2012.02205v3', GENERATION_3966840, False)
 
         row: Optional[Query] = select_from_doc ('2012.02205', 3)
         assert row is not None, 'Row is None'
@@ -467,3 +533,53 @@ def test_write_success_doc_overlap_out_of_order (app, insert_into_doc, select_fr
             got {row.conversion_end_time}'
         assert not old_version_result, 'write_success should return False'
 
+@pytest.mark.cc_unit_tests
+def test_write_without_generation_does_not_match_legacy_row (app, insert_into_sub, select_from_sub):
+    with app.app_context():
+        # Written before source_generation was stored
+        insert_into_sub (
+            sub_id=1,
+            conversion_status=0,
+            latexml_version=app.config['LATEXML_COMMIT'],
+            tex_checksum='5a67f1a2f9b1b436f2bd604e0131cf3a',
+            source_generation=None,
+            conversion_start_time=now()
+        )
+
+        # The source blob was deleted before the freshness check
+        assert not write_success(1, None, 'sub'), 'write_success should return False'
+        assert not write_failure(1, None, 'sub'), 'write_failure should return False'
+
+        row: Optional[Query] = select_from_sub (1)
+        assert row.conversion_status == 0, \
+            f'Incorrect conversion_status \'{row.conversion_status}\' should be 0'
+        assert row.conversion_end_time is None, \
+            f'Conversion end time was erroneously written: {row.conversion_end_time}'
+
+@pytest.mark.cc_unit_tests
+def test_status_transitions_guarded (app, insert_into_sub, select_from_sub):
+    with app.app_context():
+        insert_into_sub (
+            sub_id=1,
+            conversion_status=0,
+            latexml_version=app.config['LATEXML_COMMIT'],
+            tex_checksum='5a67f1a2f9b1b436f2bd604e0131cf3a',
+            source_generation=GENERATION_3966840,
+            conversion_start_time=now()
+        )
+
+        assert not write_success(1, GENERATION_3966840 + 1, True), \
+            'write_success matched a newer source'
+        assert not write_postprocessed(1, GENERATION_3966840, True), \
+            'write_postprocessed matched an unfinished conversion'
+        assert write_success(1, GENERATION_3966840, True), 'write_success should return True'
+        end_time = select_from_sub(1).conversion_end_time
+        assert not write_success(1, GENERATION_3966840, True), \
+            'write_success matched a finished conversion'
+        assert write_postprocessed(1, GENERATION_3966840, True), 'write_postprocessed should return True'
+
+        row: Optional[Query] = select_from_sub (1)
+        assert (row.conversion_status, row.conversion_end_time) == (1, end_time), \
+            f'Success rewritten: {row.conversion_status}, {row.conversion_end_time}'
+        assert row.postprocess_version == app.config['POSTPROCESS_VERSION'], \
+            f'Incorrect postprocess_version {row.postprocess_version}'
@@ -0,0 +1,106 @@
+import pytest
+import os
+import re
+import shutil
+import subprocess
+import sys
+from unittest.mock import MagicMock
+
+from source.convert import _run_latexml, _list_missing_packages
+from source.convert.latexml_pool import LaTeXMLPool, flags_to_options, LATEXMLS_FATAL
+from source.exceptions import LaTeXMLPoolError
+
+FAKE_LATEXMLS = [sys.executable, 'tests/ancillary_files/latexmls/fake_latexmls.py']
+
+@pytest.fixture
+def make_pool ():
+    pools = []
+    def make (size: int = 1, max_jobs: int = 10, max_rss: int = 1 << 40, command=FAKE_LATEXMLS):
+        pool = LaTeXMLPool(size, max_jobs, max_rss, checkout_timeout=5, command=command, start_timeout=10)
+        pools.append(pool)
+        return pool
+    yield make
+    for pool in pools:
+        pool.shutdown()
+
+def _options (tmp_path, source: str = 'main.tex'):
+    return flags_to_options(['--pmml', f'--source={source}', f'--dest={tmp_path}/out.html'])
+
+def _pid (log: str) -> str:
+    return re.search(r'pid (\d+)', log).group(1)
+
+"""
+******************************
+***** LaTeXMLPool tests ******
+******************************
+"""
+
+@pytest.mark.processing_unit_tests
+def test_flags_to_options ():
+    assert flags_to_options(['--preload=[nobibtex]latexml.sty', '--pmml', '--dest=a=b.html']) == \
+        [('preload', '[nobibtex]latexml.sty'), ('pmml', ''), ('dest', 'a=b.html')]
+
+@pytest.mark.processing_unit_tests
+def test_pool_reuses_warm_worker (make_pool, tmp_path):
+    pool = make_pool()
+    first, status = pool.convert(_options(tmp_path), timeout=10)
+    second, _ = pool.convert(_options(tmp_path), timeout=10)
+    assert status == 1, f'Incorrect status_code {status}'
+    assert os.path.exists(f'{tmp_path}/out.html'), 'Conversion output was not written'
+    assert _list_missing_packages(first) == ['foo'], 'Log was not returned from latexmls'
+    assert _pid(first) == _pid(second), 'Second job did not reuse the warm worker'
+
+@pytest.mark.processing_unit_tests
+def test_pool_recycles_after_max_jobs (make_pool, tmp_path):
+    pool = make_pool(max_jobs=1)
+    first, _ = pool.convert(_options(tmp_path), timeout=10)
+    second, _ = pool.convert(_options(tmp_path), timeout=10)
+    assert _pid(first) != _pid(second), 'Worker was not recycled after max_jobs'
+
+@pytest.mark.processing_unit_tests
+def test_pool_recycles_over_max_rss (make_pool, tmp_path):
+    pool = make_pool(max_rss=1)
+    first, _ = pool.convert(_options(tmp_path), timeout=10)
+    second, _ = pool.convert(_options(tmp_path), timeout=10)
+    assert _pid(first) != _pid(second), 'Worker was not recycled over max_rss'
+
+@pytest.mark.processing_unit_tests
+def test_pool_worker_fails_to_start (make_pool, tmp_path):
+    pool = make_pool(command=[sys.executable, '-c', 'import sys; sys.exit(1)'])
+    with pytest.raises(LaTeXMLPoolError):
+        pool.convert(_options(tmp_path), timeout=10)
+    # The slot is returned so the pool can try again later
+    assert pool.idle.qsize() == 1, 'Failed worker slot was not returned to the pool'
+
+@pytest.mark.processing_unit_tests
+def test_run_latexml_falls_back_to_latexmlc (make_pool, mocker, tmp_path):
+    pool = make_pool(command=[sys.executable, '-c', 'import sys; sys.exit(1)'])
+    mocker.patch('source.convert.get_latexml_pool', return_value=pool)
+    run = mocker.patch('source.convert.subprocess.run', return_value=MagicMock(stdout='cold log'))
+    assert _run_latexml(['latexmlc', '--pmml', '--source=main.tex']) == 'cold log'
+    assert run.called, 'Did not fall back to latexmlc'
+
+@pytest.mark.processing_unit_tests
+def test_run_latexml_pool_fatal (make_pool, mocker, tmp_path):
+    mocker.patch('source.convert.get_latexml_pool', return_value=make_pool())
+    run = mocker.patch('source.convert.subprocess.run')
+    with pytest.raises(subprocess.CalledProcessError):
+        _run_latexml(['latexmlc', '--source=fatal.tex', f'--dest={tmp_path}/out.html'])
+    assert not run.called, 'Fell back to latexmlc on a fatal conversion'
+
+@pytest.mark.processing_unit_tests
+@pytest.mark.skipif(shutil.which('latexmls') is None, reason='Needs the latexmls plugin, see the Dockerfile')
+def test_pool_real_latexmls (make_pool, tmp_path):
+    """ The pool's protocol against the pinned latexmls, not the fake """
+    with open(tmp_path / 'main.tex', 'w') as f:
+        f.write('\\documentclass{article}\n\\begin{document}\nWarm pool $x^2$\n\\end{document}\n')
+    pool = make_pool(command=['latexmls'])
+    pids = []
+    for name in ('first', 'second'):
+        options = flags_to_options(['--pmml', f'--source={tmp_path}/main.tex', f'--dest={tmp_path}/{name}.html'])
+        log, status = pool.convert(options, timeout=120)
+        assert status < LATEXMLS_FATAL, f'latexmls conversion failed with {status}: {log}'
+        with open(tmp_path / f'{name}.html') as f:
+            assert 'Warm pool' in f.read(), 'Conversion output missing the document'
+        pids.append(pool.idle.queue[0].process.pid)
+    assert pids[0] == pids[1], 'Second job did not reuse the warm worker'
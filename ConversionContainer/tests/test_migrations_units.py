@@ -0,0 +1,63 @@
+import pytest
+import os
+from glob import glob
+
+from sqlalchemy import create_engine, inspect, text
+
+from source.models.db import DBLaTeXMLDocuments, DBLaTeXMLSubmissions
+
+MIGRATIONS_DIR = 'migrations'
+
+# arXiv_latexml_doc and arXiv_latexml_sub as deployed before any migration
+LEGACY_TABLES = [
+    """CREATE TABLE arXiv_latexml_doc (
+        paper_id VARCHAR(20) NOT NULL,
+        document_version INTEGER NOT NULL,
+        conversion_status INTEGER NOT NULL,
+        latexml_version VARCHAR(40) NOT NULL,
+        tex_checksum VARCHAR,
+        conversion_start_time INTEGER,
+        conversion_end_time INTEGER,
+        publish_dt DATETIME,
+        PRIMARY KEY (paper_id, document_version))""",
+    """CREATE TABLE arXiv_latexml_sub (
+        submission_id INTEGER NOT NULL,
+        conversion_status INTEGER NOT NULL,
+        latexml_version VARCHAR(40) NOT NULL,
+        tex_checksum VARCHAR,
+        conversion_start_time INTEGER,
+        conversion_end_time INTEGER,
+        PRIMARY KEY (submission_id))"""
+]
+
+def _statements (fpath: str):
+    with open(fpath) as f:
+        sql = '\n'.join(line for line in f if not line.lstrip().startswith('--'))
+    return [statement for statement in sql.split(';') if statement.strip()]
+
+"""
+******************************
+****** Migration tests *******
+******************************
+"""
+
+@pytest.mark.migration_unit_tests
+def test_migrations_bring_legacy_tables_to_models ():
+    migrations = sorted(glob(os.path.join(MIGRATIONS_DIR, '*.sql')))
+    assert migrations, f'No migrations in {MIGRATIONS_DIR}'
+    engine = create_engine('sqlite:///:memory:')
+    with engine.begin() as conn:
+        for statement in LEGACY_TABLES:
+            conn.execute(text(statement))
+        for fpath in migrations:
+            for statement in _statements(fpath):
+                conn.execute(text(statement))
+
+    inspector = inspect(engine)
+    for model in (DBLaTeXMLDocuments, DBLaTeXMLSubmissions):
+        table = model.__tablename__
+        columns = { column['name'] for column in inspector.get_columns(table) }
+        mapped = { column.name for column in model.__table__.columns }
+        assert mapped == columns, \
+            f'{table} after migrations differs from its model: ' \
+            f'missing {mapped - columns}, unmapped {columns - mapped}'
@@ -0,0 +1,185 @@
+import pytest
+import json
+from base64 import b64encode
+from unittest.mock import MagicMock
+from typing import Optional
+
+from source.models.util import transaction, now
+from source.models.db import DBLaTeXMLDocuments, DBLaTeXMLSubmissions
+from source.convert.concurrency_control import write_start, write_success, get_conversion_row
+from source.publish.db_queries import write_published_html, submission_has_html
+from source.convert.planner import plan_conversion, conversion_plan_stats, \
+    SKIP, CONVERT, REPOSTPROCESS
+from source.convert import process
+from source.convert.batch_convert import batch_process
+
+SOURCE_GENERATION = 1708000000000001
+SOURCE_MD5 = 'q2Xk8WbWnY4b1yJ8eAKmOQ=='
+LATEXML_COMMIT = 'test_commit_version'
+POSTPROCESS_VERSION = 'test_postprocess_version'
+
+@pytest.fixture
+def source_blob (mocker):
+    """ The source's GCS metadata as seen by the planner, returns a setter """
+    blob_metadata = mocker.patch('source.convert.planner.blob_metadata')
+    def set (generation: Optional[int] = SOURCE_GENERATION, md5_hash: str = SOURCE_MD5):
+        blob_metadata.return_value = None if generation is None \
+            else MagicMock(generation=generation, md5_hash=md5_hash)
+    set()
+    return set
+
+@pytest.fixture
+def sub_row (app):
+    def insert (conversion_status: int = 1, latexml_version: str = LATEXML_COMMIT,
+                source_generation: int = SOURCE_GENERATION, source_md5: Optional[str] = SOURCE_MD5,
+                postprocess_version: Optional[str] = POSTPROCESS_VERSION,
+                conversion_end_time: Optional[int] = None):
+        with app.app_context(), transaction() as session:
+            session.add(DBLaTeXMLSubmissions(
+                submission_id=1, conversion_status=conversion_status,
+                latexml_version=latexml_version, tex_checksum='checksum',
+                source_generation=source_generation, source_md5=source_md5,
+                postprocess_version=postprocess_version, conversion_start_time=0,
+                conversion_end_time=conversion_end_time))
+    return insert
+
+def _plan (app, force: bool = False, batch: bool = False):
+    with app.app_context():
+        return plan_conversion(1, 'latexml_submission_source', '1/1.tar.gz', True, force, batch)
+
+"""
+******************************
+****** Planner tests *********
+******************************
+"""
+
+@pytest.mark.planner_unit_tests
+def test_plan_new_submission (app, source_blob):
+    plan = _plan(app)
+    assert (plan.decision, plan.reason) == (CONVERT, 'new'), f'Incorrect plan {plan}'
+    assert plan.source_md5 == SOURCE_MD5, 'Plan lost the source md5'
+
+@pytest.mark.planner_unit_tests
+def test_plan_skips_unchanged (app, source_blob, sub_row):
+    sub_row()
+    plan = _plan(app)
+    assert (plan.decision, plan.reason) == (SKIP, 'unchanged'), f'Incorrect plan {plan}'
+
+@pytest.mark.planner_unit_tests
+def test_plan_skips_reupload_of_same_bytes (app, source_blob, sub_row):
+    sub_row()
+    source_blob(generation=SOURCE_GENERATION + 1)
+    plan = _plan(app)
+    assert (plan.decision, plan.reason) == (SKIP, 'unchanged'), f'Incorrect plan {plan}'
+
+@pytest.mark.planner_unit_tests
+def test_plan_legacy_row_uses_generation (app, source_blob, sub_row):
+    sub_row(source_md5=None)
+    assert _plan(app).decision == SKIP, 'Same generation without an md5 was not skipped'
+    source_blob(generation=SOURCE_GENERATION + 1)
+    plan = _plan(app)
+    assert (plan.decision, plan.reason) == (CONVERT, 'source_changed'), f'Incorrect plan {plan}'
+
+@pytest.mark.planner_unit_tests
+@pytest.mark.parametrize('row, blob, expected', [
+    ({}, { 'md5_hash': 'changed', 'generation': SOURCE_GENERATION + 1 }, (CONVERT, 'source_changed')),
+    ({ 'latexml_version': 'old_commit' }, {}, (CONVERT, 'latexml_changed')),
+    ({ 'conversion_status': 2, 'conversion_end_time': now() - 60 }, {}, (SKIP, 'failed_unchanged')),
+    # FAILED_CONVERSION_RETRY_AFTER = 3600
+    ({ 'conversion_status': 2, 'conversion_end_time': now() - 7200 }, {}, (CONVERT, 'failed_retry')),
+    ({ 'conversion_status': 2 }, {}, (CONVERT, 'failed_retry')),
+    ({ 'conversion_status': 2, 'latexml_version': 'old_commit' }, {}, (CONVERT, 'latexml_changed')),
+    ({ 'conversion_status': 0 }, {}, (CONVERT, 'unfinished')),
+    ({ 'postprocess_version': 'old' }, {}, (REPOSTPROCESS, 'postprocess_changed')),
+    ({ 'postprocess_version': None }, {}, (REPOSTPROCESS, 'postprocess_changed')),
+])
+def test_plan_decisions (app, source_blob, sub_row, row, blob, expected):
+    sub_row(**row)
+    source_blob(**blob)
+    plan = _plan(app)
+    assert (plan.decision, plan.reason) == expected, f'Incorrect plan {plan}'
+
+@pytest.mark.planner_unit_tests
+def test_plan_force_and_missing_source (app, source_blob, sub_row):
+    sub_row()
+    assert _plan(app, force=True)[:2] == (CONVERT, 'forced'), 'Forced plan was not a conversion'
+    source_blob(generation=None)
+    assert _plan(app)[:2] == (CONVERT, 'no_source'), 'Missing source was not left to the conversion'
+
+@pytest.mark.planner_unit_tests
+def test_plan_document (app, source_blob):
+    with app.app_context(), transaction() as session:
+        session.add(DBLaTeXMLDocuments(
+            paper_id='2012.02205', document_version=2, conversion_status=1,
+            latexml_version=LATEXML_COMMIT, tex_checksum='checksum',
+            source_generation=SOURCE_GENERATION, source_md5=SOURCE_MD5,
+            postprocess_version=POSTPROCESS_VERSION, conversion_start_time=0))
+    with app.app_context():
+        assert plan_conversion('2012.02205v2', 'b', 'b', False).decision == SKIP, \
+            'Unchanged document was not skipped'
+        assert plan_conversion('2012.02205v1', 'b', 'b', False).reason == 'new', \
+            'Another version of the document was not new'
+
+@pytest.mark.planner_unit_tests
+@pytest.mark.parametrize('batch, expected', [(True, (SKIP, 'source_unknown')), (False, (CONVERT, 'source_changed'))])
+def test_plan_legacy_row_without_source (app, source_blob, sub_row, batch, expected):
+    sub_row(source_generation=None, source_md5=None)
+    plan = _plan(app, batch=batch)
+    assert (plan.decision, plan.reason) == expected, f'Incorrect plan {plan}'
+
+@pytest.mark.planner_unit_tests
+def test_plan_batch_skips_published_document (app, source_blob, sub_row):
+    # Converted by batch, then published over from submission 1
+    with app.app_context():
+        write_start('2012.02205v2', 'checksum', SOURCE_GENERATION, False, SOURCE_MD5)
+        assert write_success('2012.02205v2', SOURCE_GENERATION, False), 'Conversion was not written'
+    sub_row(source_generation=SOURCE_GENERATION - 1, source_md5='submission')
+    with app.app_context():
+        write_published_html('2012.02205', 2, submission_has_html(1))
+        row = get_conversion_row('2012.02205v2', False)
+        assert (row.source_generation, row.source_md5) == (None, None), \
+            f'Published row kept a source it was not converted from {row.source_generation} {row.source_md5}'
+        plan = plan_conversion('2012.02205v2', 'b', 'b', False, batch=True)
+        assert (plan.decision, plan.reason) == (SKIP, 'source_unknown'), \
+            f'Batch planned to replace published html {plan}'
+        assert plan_conversion('2012.02205v2', 'b', 'b', False, force=True).decision == CONVERT, \
+            'Forced conversion of a published document was skipped'
+
+@pytest.mark.planner_unit_tests
+@pytest.mark.parametrize('module, convert', [
+    ('source.convert', lambda: process('1', '1/1.tar.gz', 'latexml_submission_source', False)),
+    ('source.convert.batch_convert', lambda: batch_process('2012.02205v2', False, 'b', 'b')),
+])
+def test_plan_failure_is_not_a_conversion_failure (app, mocker, module, convert):
+    mocker.patch(f'{module}.plan_conversion', side_effect=RuntimeError('No metadata'))
+    write_failure = mocker.patch(f'{module}.write_failure')
+    id_lock = mocker.patch(f'{module}.id_lock')
+    with app.app_context():
+        convert()
+    assert not write_failure.called, 'Planning error was written as a conversion failure'
+    assert not id_lock.called, 'Cleaned up a conversion that never started'
+
+@pytest.mark.planner_unit_tests
+def test_batch_convert_route_survives_plan_failure (app_client, mocker):
+    mocker.patch('source.convert.batch_convert.plan_conversion', side_effect=RuntimeError('No metadata'))
+    data = json.dumps({ 'id': '2012.02205v2', 'blob': 'b', 'bucket': 'b' })
+    response = app_client.post('/batch-convert',
+        json={ 'message': { 'data': b64encode(data.encode('utf-8')).decode('utf-8') } })
+    assert response.status_code == 200, f'Incorrect status_code {response.status_code}'
+
+@pytest.mark.planner_unit_tests
+def test_plan_stats (app, source_blob, sub_row):
+    before = conversion_plan_stats().get(SKIP, {}).get('unchanged', 0)
+    sub_row()
+    _plan(app)
+    _plan(app)
+    assert conversion_plan_stats()[SKIP]['unchanged'] == before + 2, \
+        f'Incorrect plan stats {conversion_plan_stats()}'
+
+@pytest.mark.planner_unit_tests
+def test_plan_skips_after_conversion (app, source_blob):
+    with app.app_context():
+        write_start(1, 'checksum', SOURCE_GENERATION, True, SOURCE_MD5)
+        assert write_success(1, SOURCE_GENERATION, True), 'Conversion was not written'
+    plan = _plan(app)
+    assert (plan.decision, plan.reason) == (SKIP, 'unchanged'), f'Incorrect plan {plan}'
@@ -0,0 +1,94 @@
+import pytest
+import os
+
+from bs4 import BeautifulSoup
+
+from source.convert import postprocess
+from source.convert.postprocess import (
+    PostProcessor,
+    base_tag,
+    missing_package_warning,
+    license_section,
+    absolute_anchors_for_submission,
+    absolute_anchors_for_doc
+)
+from source.publish.watermark import watermark_section
+from source.exceptions import HTMLInjectionError
+
+def _watermark () -> BeautifulSoup:
+    return BeautifulSoup('<div id="watermark-tr">arXiv:2402.00001v1 [math.OC] 06 Feb 2024</div>', 'html.parser')
+
+def _read (fpath: str) -> str:
+    with open(fpath) as f:
+        return f.read()
+
+"""
+******************************
+***** PostProcessor tests ****
+******************************
+"""
+
+@pytest.mark.postprocess_unit_tests
+def test_publish_pipeline_matches_sequential (html_copies):
+    sequential, pipelined = html_copies('sequential.html'), html_copies('pipelined.html')
+
+    PostProcessor(sequential).register(base_tag, '2402.00001v1').run()
+    PostProcessor(sequential).register(watermark_section, _watermark()).run()
+    PostProcessor(sequential).register(absolute_anchors_for_doc, '2402.00001v1', 'https://arxiv.org').run()
+
+    PostProcessor(pipelined) \
+        .register(base_tag, '2402.00001v1') \
+        .register(watermark_section, _watermark()) \
+        .register(absolute_anchors_for_doc, '2402.00001v1', 'https://arxiv.org') \
+        .run()
+
+    assert _read(sequential) == _read(pipelined), \
+        'Single parse pipeline output differs from sequential output'
+    assert 'https://arxiv.org/html/2402.00001v1#S1' in _read(pipelined), \
+        'Submission anchors were not rewritten'
+
+@pytest.mark.postprocess_unit_tests
+def test_convert_pipeline_matches_sequential (html_copies):
+    sequential, pipelined = html_copies('sequential.html'), html_copies('pipelined.html')
+    missing = ['foo.sty', 'bar.sty']
+
+    PostProcessor(sequential).register(missing_package_warning, missing).run()
+    PostProcessor(sequential).register(license_section, 'License: CC BY 4.0', missing).run()
+    PostProcessor(sequential).register(absolute_anchors_for_submission, 5393936, 'https://services.arxiv.org').run()
+
+    PostProcessor(pipelined) \
+        .register(missing_package_warning, missing) \
+        .register(license_section, 'License: CC BY 4.0', missing) \
+        .register(absolute_anchors_for_submission, 5393936, 'https://services.arxiv.org') \
+        .run()
+
+    assert _read(sequential) == _read(pipelined), \
+        'Single parse pipeline output differs from sequential output'
+
+@pytest.mark.postprocess_unit_tests
+def test_pipeline_parses_once (html_copies, mocker):
+    fpath = html_copies('pipelined.html')
+    size = os.path.getsize(fpath)
+    spy = mocker.spy(postprocess, 'BeautifulSoup')
+
+    PostProcessor(fpath) \
+        .register(base_tag, '2402.00001v1') \
+        .register(watermark_section, _watermark()) \
+        .register(absolute_anchors_for_doc, '2402.00001v1', 'https://arxiv.org') \
+        .run()
+
+    document_parses = [c for c in spy.call_args_list if len(c.args[0]) >= size // 2]
+    assert len(document_parses) == 1, \
+        f'Document parsed {len(document_parses)} times, should be 1'
+
+@pytest.mark.postprocess_unit_tests
+def test_pipeline_transform_failure (html_copies):
+    fpath = html_copies('pipelined.html')
+    before = _read(fpath)
+
+    def broken (soup):
+        raise ValueError
+
+    with pytest.raises(HTMLInjectionError):
+        PostProcessor(fpath).register(base_tag, '2402.00001v1').register(broken).run()
+    assert _read(fpath) == before, 'File was written despite a failed transform'
@@ -2,19 +2,27 @@ import pytest
 import shutil
 from unittest.mock import MagicMock
 import os
+import tarfile
+import source.convert
 from source.convert import (
     untar,
     remove_ltxml,
     _clean_up,
     do_latexml,
-    find_main_tex_source
+    find_main_tex_source,
+    repostprocess
 )
+from source.convert.batch_convert import batch_process
+from source.convert.planner import Plan, CONVERT
+from source.convert.concurrency_control import write_start, write_success, get_conversion_row
 from source.exceptions import FileTypeError
 
 # @pytest.fixture(autouse=True)
 # def change_test_dir(request, monkeypatch):
 #     monkeypatch.chdir(request.fspath.dirname)
 
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
 @pytest.fixture(autouse=True)
 def mock_google_storage_client (mocker):
     mocker.patch('source.buckets.util.get_google_storage_client', 
@@ -129,4 +137,132 @@ def test_find_main_text_source_multiple_sources ():
 ******************************
 """
 
-# TODO: This will also just be mostly mocked. 
\ No newline at end of file
+# TODO: This will also just be mostly mocked. 
+"""
+******************************
+**** re-postprocess tests ****
+******************************
+"""
+
+MISSING_PACKAGE_LOG = "Warning:missing_file:mypkg Can't find package mypkg at main.tex; line 3"
+
+@pytest.fixture
+def mock_repostprocess_io (app, mocker, tmp_path, monkeypatch):
+    """ Serves a raw LaTeXML output made from the 5393936 site and records the html uploaded """
+    monkeypatch.chdir(tmp_path)
+    app.config['LOCK_DIR'] = str(tmp_path / 'locks')
+    uploads = {}
+
+    def raw_tar (id: str) -> str:
+        with tarfile.open(os.path.join(TESTS_DIR, 'ancillary_files', '5393936.tar.gz')) as tar:
+            tar.extractall(tmp_path / 'site')
+        os.rename(tmp_path / 'site' / '5393936' / '5393936.html', tmp_path / 'site' / '5393936' / f'{id}.html')
+        os.rename(tmp_path / 'site' / '5393936', tmp_path / 'site' / id)
+        with tarfile.open(tmp_path / f'{id}.raw.tar.gz', 'w:gz') as tar:
+            tar.add(tmp_path / 'site' / id, arcname=id)
+        return str(tmp_path / f'{id}.raw.tar.gz')
+
+    def extract_blob (bucket, blob, dst_dir):
+        with tarfile.open(raw_tar(blob.replace('.tar.gz', ''))) as tar:
+            tar.extractall(dst_dir)
+
+    def upload_file_to_gcs (fpath, bucket, blob):
+        with open(fpath) as f:
+            uploads[blob] = f.read()
+
+    def upload_tar_to_gcs (id, src_dir, bucket, tar_fpath):
+        with open(os.path.join(src_dir, str(id), f'{id}.html')) as f:
+            uploads[f'{id}.tar.gz'] = f.read()
+
+    mocker.patch('source.convert.blob_metadata', side_effect=lambda bucket, blob: MagicMock(
+        download_as_text=MagicMock(return_value=MISSING_PACKAGE_LOG)))
+    mocker.patch('source.convert.extract_blob', side_effect=extract_blob)
+    mocker.patch('source.convert.get_license', return_value='License: CC BY 4.0')
+    mocker.patch('source.convert.upload_file_to_gcs', side_effect=upload_file_to_gcs)
+    mocker.patch('source.convert.upload_tar_to_gcs', side_effect=upload_tar_to_gcs)
+    return uploads
+
+def _converted (app, id, is_submission: bool, postprocess_version: str):
+    app.config['POSTPROCESS_VERSION'] = postprocess_version
+    with app.app_context():
+        write_start(id, 'checksum', 1, is_submission)
+        write_success(id, 1, is_submission)
+
+@pytest.mark.processing_unit_tests
+def test_repostprocess_document (app, mock_repostprocess_io):
+    _converted(app, '2402.00001v1', False, 'old')
+    app.config['POSTPROCESS_VERSION'] = 'new'
+    with app.app_context():
+        assert repostprocess('2402.00001v1', False), 'Re-post-process failed'
+        row = get_conversion_row('2402.00001v1', False)
+
+    assert list(mock_repostprocess_io) == ['2402.00001v1/2402.00001v1.html'], \
+        f'Uploaded more than the html {list(mock_repostprocess_io)}'
+    html = mock_repostprocess_io['2402.00001v1/2402.00001v1.html']
+    assert 'License: CC BY 4.0' in html and 'mypkg' in html, \
+        'License or missing package warning not applied'
+    assert '<base href="/html/2402.00001v1/"/>' in html, 'Base tag not applied'
+    assert row.postprocess_version == 'new', 'Post processing version not written'
+    assert not os.path.exists('extracted/2402.00001v1'), 'Working directory left behind'
+
+@pytest.mark.processing_unit_tests
+def test_repostprocess_submission (app, mock_repostprocess_io):
+    _converted(app, '5393936', True, 'old')
+    app.config['POSTPROCESS_VERSION'] = 'new'
+    with app.app_context():
+        assert repostprocess('5393936', True), 'Re-post-process failed'
+    assert list(mock_repostprocess_io) == ['5393936.tar.gz'], \
+        f'Incorrect uploads {list(mock_repostprocess_io)}'
+    assert 'https://services.arxiv.org/html/submission/5393936/view#' in mock_repostprocess_io['5393936.tar.gz'], \
+        'Submission anchors not applied'
+
+@pytest.mark.processing_unit_tests
+def test_repostprocess_needs_successful_conversion (app, mock_repostprocess_io):
+    with app.app_context():
+        assert not repostprocess('2402.00001v1', False), 'Re-post-processed a paper never converted'
+        write_start('2402.00001v1', 'checksum', 1, False)
+        assert not repostprocess('2402.00001v1', False), 'Re-post-processed a conversion in progress'
+    assert not mock_repostprocess_io, 'Uploaded without a successful conversion'
+
+@pytest.fixture
+def mock_batch_io (app, mocker, tmp_path, mock_repostprocess_io):
+    """ Converts to the same raw LaTeXML output repostprocess serves, recording the html uploaded """
+    def do_latexml (main, out_dpath, id, is_submission):
+        with tarfile.open(os.path.join(TESTS_DIR, 'ancillary_files', '5393936.tar.gz')) as tar:
+            tar.extractall(tmp_path / 'batch')
+        shutil.copytree(tmp_path / 'batch' / '5393936', out_dpath, dirs_exist_ok=True)
+        os.rename(os.path.join(out_dpath, '5393936.html'), os.path.join(out_dpath, f'{id}.html'))
+        return ['mypkg']
+
+    def upload_dir_to_gcs (src_dir, bucket):
+        id = os.listdir(src_dir)[0]
+        with open(os.path.join(src_dir, id, f'{id}.html')) as f:
+            mock_repostprocess_io[f'batch/{id}.html'] = f.read()
+
+    mocker.patch('source.convert.batch_convert.plan_conversion', return_value=Plan(CONVERT, 'new', None))
+    mocker.patch('source.convert.batch_convert.download_blob_with_checksum', return_value=('checksum', 1))
+    mocker.patch('source.convert.batch_convert.untar')
+    mocker.patch('source.convert.batch_convert.find_main_tex_source', return_value='main.tex')
+    mocker.patch('source.convert.batch_convert.do_latexml', side_effect=do_latexml)
+    mocker.patch('source.convert.batch_convert.upload_raw_doc_output')
+    mocker.patch('source.convert.batch_convert.upload_dir_to_gcs', side_effect=upload_dir_to_gcs)
+    mocker.patch('source.convert.batch_convert.get_license', return_value='License: CC BY 4.0')
+    return mock_repostprocess_io
+
+@pytest.mark.processing_unit_tests
+@pytest.mark.parametrize('mode', ['soup', 'stream'])
+def test_batch_matches_repostprocess (app, mock_batch_io, mocker, mode):
+    app.config['HTML_REWRITE_MODE'] = mode
+    stream_rewriter = mocker.spy(source.convert, 'StreamRewriter')
+    id = '2402.00001v1'
+    with app.app_context():
+        batch_process(id, True, 'b', 'b')
+        assert stream_rewriter.called == (mode == 'stream'), \
+            f'Batch conversion ignored HTML_REWRITE_MODE {mode}'
+        assert get_conversion_row(id, False).conversion_status == 1, 'Batch conversion not written'
+        assert repostprocess(id, False), 'Re-post-process failed'
+    batch_html = mock_batch_io[f'batch/{id}.html']
+    assert 'License: CC BY 4.0' in batch_html and 'mypkg' in batch_html, \
+        'Batch conversion missing the license or missing package warning'
+    assert batch_html == mock_batch_io[f'{id}/{id}.html'], \
+        'Batch conversion differs from re-post-processing the same output'
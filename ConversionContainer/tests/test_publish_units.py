@@ -0,0 +1,346 @@
+from typing import Dict
+import pytest
+import os
+import json
+import time
+from base64 import b64encode
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from bs4 import BeautifulSoup
+from sqlalchemy import event, text
+
+from source.publish import publish, _publish
+from source.publish.fastly_purge import fastly_purge_abs
+from source.publish.purge_queue import get_purge_queue
+from source.publish.db_queries import get_watermark_metadata
+from source.models.db import db, DBLaTeXMLDocuments
+from source.models.util import transaction
+
+# Generous compared to the ~2s a single parse takes, but orders of
+# magnitude below re-serializing the document once per reference
+PUBLISH_10K_REFS_TIME_BOUND = 30
+
+def _synthetic_submission_html (n_refs: int) -> str:
+    refs = '\n'.join(
+        f'<p class="ltx_p">See <a class="ltx_ref" href="https://services.arxiv.org/html/submission/1/view#S{i}">'
+        f'<span class="ltx_text ltx_ref_tag">{i}</span></a> and <a class="ltx_ref" href="#bib.bib{i}">[{i}]</a>.</p>'
+        for i in range(n_refs // 2))
+    return f'''<!DOCTYPE html>
+<html lang="en"><head><title>Synthetic</title></head>
+<body><div class="ltx_page_main"><div class="ltx_page_content">
+<div class="section" id="target-section"><div id="license-tr">License: CC BY 4.0</div></div>
+<article class="ltx_document">{refs}</article>
+</div></div></body></html>
+'''
+
+@pytest.fixture
+def mock_publish_io (mocker, tmp_path):
+    """ Stubs out GCS and DB access in _publish, returns the mocks keyed by name """
+    html_file = os.path.join(tmp_path, '2402.00001v1.html')
+    mocks = {
+        'submission_has_html': mocker.patch('source.publish.submission_has_html', return_value=MagicMock()),
+        'download_sub_to_doc_dir': mocker.patch('source.publish.download_sub_to_doc_dir', return_value=html_file),
+        'make_published_watermark': mocker.patch(
+            'source.publish.make_published_watermark',
+            return_value=BeautifulSoup('<div id="watermark-tr">arXiv:2402.00001v1 [cs.DL] 06 Feb 2024</div>', 'html.parser')),
+        'upload_dir_to_doc_bucket': mocker.patch('source.publish.upload_dir_to_doc_bucket'),
+        'write_published_html': mocker.patch('source.publish.write_published_html'),
+        'move_sub_qa_to_doc_qa': mocker.patch('source.publish.move_sub_qa_to_doc_qa'),
+    }
+    mocks['html_file'] = html_file
+    return mocks
+
+"""
+******************************
+*** publish benchmark tests **
+******************************
+"""
+
+@pytest.mark.publish_unit_tests
+@pytest.mark.parametrize('mode', ['soup', 'stream'])
+def test_publish_10k_references_time_bound (app, mock_publish_io, mode):
+    with open(mock_publish_io['html_file'], 'w') as f:
+        f.write(str(BeautifulSoup(_synthetic_submission_html(10000), 'html.parser')))
+
+    app.config['HTML_REWRITE_MODE'] = mode
+    with app.app_context():
+        start = time.perf_counter()
+        _publish(1, '2402.00001', 1)
+        elapsed = time.perf_counter() - start
+
+    assert mock_publish_io['upload_dir_to_doc_bucket'].called, \
+        'Publish failed before uploading'
+    with open(mock_publish_io['html_file']) as f:
+        html = f.read()
+    assert html.count('href="https://arxiv.org/html/2402.00001v1#') == 10000, \
+        'Not every reference was rewritten'
+    assert 'watermark-tr' in html and '<base href="/html/2402.00001v1/"/>' in html, \
+        'Watermark or base tag missing'
+    assert elapsed < PUBLISH_10K_REFS_TIME_BOUND, \
+        f'Publishing 10k references took {elapsed:.1f}s, bound is {PUBLISH_10K_REFS_TIME_BOUND}s'
+
+def _publish_payload (submission_id: int, paper_id: str, version: int) -> Dict:
+    data = json.dumps({ 'submission_id': submission_id, 'paper_id': paper_id, 'version': version })
+    return { 'message': { 'data': b64encode(data.encode('utf-8')).decode('utf-8') } }
+
+"""
+******************************
+**** publish dedup tests *****
+******************************
+"""
+
+@pytest.mark.publish_unit_tests
+def test_publish_drops_redelivery (app_client, mocker):
+    _publish = mocker.patch('source.publish._publish', return_value=True)
+    for _ in range(3):
+        publish(_publish_payload(1, '2402.00001', 1))
+    assert _publish.call_count == 1, f'Published {_publish.call_count} times'
+
+    stats = app_client.get('/health').json['publish_dedup']
+    assert (stats['accepted'], stats['dropped_recent']) == (1, 2), \
+        f'Incorrect dedup stats {stats}'
+
+@pytest.mark.publish_unit_tests
+def test_publish_retries_after_failure (app_client, mocker):
+    sleep = mocker.patch('source.publish.time.sleep')
+    _publish = mocker.patch('source.publish._publish', side_effect=[False, True])
+    assert publish(_publish_payload(1, '2402.00001', 1)), 'Failed publish was not retried'
+    assert _publish.call_count == 2, f'Published {_publish.call_count} times'
+    assert sleep.call_count == 1, 'Retry did not back off'
+
+@pytest.mark.publish_unit_tests
+def test_publish_gives_up_after_attempts (app_client, mocker):
+    mocker.patch('source.publish.time.sleep')
+    # PUBLISH_ATTEMPTS = 2
+    _publish = mocker.patch('source.publish._publish', side_effect=[False, False, True])
+    results = [publish(_publish_payload(1, '2402.00001', 1)) for _ in range(2)]
+    assert results == [False, True], f'Incorrect publish results {results}'
+    assert _publish.call_count == 3, \
+        f'A later delivery after giving up was not published, published {_publish.call_count} times'
+
+@pytest.mark.publish_unit_tests
+def test_publish_skips_published_document (app_client, mocker):
+    _publish = mocker.patch('source.publish._publish', return_value=True)
+    with transaction() as session:
+        session.add(DBLaTeXMLDocuments(
+            paper_id='2402.00001', document_version=1, conversion_status=1,
+            latexml_version='test_commit_version', publish_dt=datetime.utcnow()))
+        session.commit()
+
+    publish(_publish_payload(1, '2402.00001', 1))
+    publish(_publish_payload(2, '2402.00001', 2))
+    assert [c.args for c in _publish.call_args_list] == [(2, '2402.00001', 2)], \
+        f'Incorrect publishes {_publish.call_args_list}'
+    assert app_client.get('/health').json['publish_dedup']['dropped_published'] == 1, \
+        'Published document was not counted as dropped'
+
+"""
+******************************
+**** fastly purge tests *******
+******************************
+"""
+
+@pytest.fixture
+def fastly_session (mocker):
+    """ Session whose requests answer with the statuses queued per url, 200 after those run out """
+    statuses: Dict[str, list] = {}
+    def request (method, url, headers, timeout):
+        return MagicMock(status_code=(statuses.get(url) or [200]).pop(0))
+    session = MagicMock()
+    session.request.side_effect = request
+    mocker.patch('source.publish.fastly_purge._get_session', return_value=session)
+    mocker.patch('source.publish.fastly_purge.PURGE_BACKOFF', 0)
+    return session, statuses
+
+@pytest.mark.publish_unit_tests
+def test_fastly_purge_urls_with_retries (app, fastly_session):
+    session, statuses = fastly_session
+    statuses['https://arxiv.org/abs/2402.00001'] = [503]
+    statuses['https://www.arxiv.org/abs/2402.00001v1'] = [503, 503]
+
+    with app.app_context():
+        result = fastly_purge_abs('2402.00001', 1, 'key')
+
+    assert session.request.call_count == 6 + 1 + 1, \
+        f'Incorrect number of purge requests {session.request.call_count}'
+    by_target = { r['target']: r for r in result['purges'] }
+    assert len(by_target) == 6, f'Incorrect purge targets {list(by_target)}'
+    assert by_target['https://arxiv.org/abs/2402.00001']['ok'], 'Retried purge failed'
+    # FASTLY_PURGE_ATTEMPTS = 2
+    failed = by_target['https://www.arxiv.org/abs/2402.00001v1']
+    assert (failed['ok'], failed['status'], failed['attempts']) == (False, 503, 2), \
+        f'Purge that kept failing was not reported {failed}'
+    assert not result['ok'], 'Failed purge was reported as success'
+
+@pytest.mark.publish_unit_tests
+def test_fastly_purge_surrogate_key (app, fastly_session):
+    session, _ = fastly_session
+    app.config['FASTLY_SERVICE_ID'] = 'service'
+    with app.app_context():
+        result = fastly_purge_abs('2402.00001', 1, 'key')
+
+    assert result['ok'], f'Surrogate key purge failed {result}'
+    session.request.assert_called_once()
+    method, url = session.request.call_args.args
+    assert (method, url) == ('POST', 'https://api.fastly.com/service/service/purge'), \
+        f'Incorrect surrogate key purge {method} {url}'
+    assert session.request.call_args.kwargs['headers']['Surrogate-Key'] == 'abs-2402.00001', \
+        'Incorrect surrogate key'
+
+def _wait_for (condition, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+@pytest.mark.publish_unit_tests
+def test_purge_queue_coalesces_publishes (app, fake_fastly, mocker):
+    with app.app_context():
+        queue = get_purge_queue()
+        for i in range(300):
+            queue.enqueue(f'2402.{i % 100:05d}', 1)
+        assert _wait_for(lambda: queue.stats()['purged'] == 100), \
+            f'Queued purges were not sent {queue.stats()}'
+
+    assert len(fake_fastly.requests) == 1, \
+        f'300 purges of 100 papers took {len(fake_fastly.requests)} requests'
+    assert sorted(fake_fastly.purged_keys()) == [f'abs-2402.{i:05d}' for i in range(100)], \
+        'Incorrect surrogate keys purged'
+    assert fake_fastly.requests[0]['path'] == '/service/test-service/purge', \
+        f'Incorrect purge path {fake_fastly.requests[0]["path"]}'
+    assert queue.stats()['coalesced'] == 200, f'Incorrect coalesced count {queue.stats()}'
+
+@pytest.mark.publish_unit_tests
+def test_purge_queue_retries_failed_batch (app, fake_fastly, mocker):
+    mocker.patch('source.publish.fastly_purge.PURGE_BACKOFF', 0)
+    # FASTLY_PURGE_ATTEMPTS = 2, so the first batch fails and is saved
+    fake_fastly.fail_next(2)
+    with app.app_context():
+        queue = get_purge_queue()
+        queue.enqueue('2402.00001', 1)
+        queue.enqueue('2402.00002', 1)
+        assert _wait_for(lambda: queue.stats()['purged'] == 2), \
+            f'Failed purges were not retried {queue.stats()}'
+
+    assert fake_fastly.purged_keys() == ['abs-2402.00001', 'abs-2402.00002'], \
+        f'Incorrect surrogate keys purged {fake_fastly.requests}'
+    stats = queue.stats()
+    assert (stats['failed'], stats['retried'], stats['saved']) == (2, 2, 0), \
+        f'Incorrect retry stats {stats}'
+
+@pytest.mark.publish_unit_tests
+def test_purge_queue_gives_up_after_retry_max (app, fake_fastly, mocker):
+    mocker.patch('source.publish.fastly_purge.PURGE_BACKOFF', 0)
+    fake_fastly.fail_next(1000)
+    with app.app_context():
+        queue = get_purge_queue()
+        queue.enqueue('2402.00001', 1)
+        # FASTLY_PURGE_RETRY_MAX = 2
+        assert _wait_for(lambda: queue.stats()['dropped'] == 1), \
+            f'Failing purge was not dropped {queue.stats()}'
+    assert (queue.stats()['retried'], queue.stats()['saved']) == (2, 0), \
+        f'Incorrect retry stats {queue.stats()}'
+
+def _save_batch (retry_dir: str, fname: str, papers: list, age: float = 0):
+    fpath = os.path.join(retry_dir, fname)
+    with open(fpath, 'w') as f:
+        json.dump({ 'attempts': 1, 'papers': papers }, f)
+    os.utime(fpath, (time.time() - age, time.time() - age))
+
+@pytest.mark.publish_unit_tests
+def test_purge_queue_keeps_batch_when_flush_raises (app, fake_fastly, mocker):
+    from source.publish import purge_queue
+    purge_abs, raising = purge_queue.purge_abs, [True]
+    def flaky_purge_abs (*args):
+        if raising[0]:
+            raise RuntimeError('Purge failed')
+        return purge_abs(*args)
+    mocker.patch('source.publish.purge_queue.purge_abs', side_effect=flaky_purge_abs)
+    retry_dir = app.config['FASTLY_PURGE_RETRY_DIR']
+    os.makedirs(retry_dir)
+    _save_batch(retry_dir, 'saved.json', [['2402.00001', 1]])
+
+    with app.app_context():
+        queue = get_purge_queue()
+        time.sleep(4 * app.config['FASTLY_PURGE_RETRY_INTERVAL'])
+        assert os.listdir(retry_dir) == ['saved.json'], \
+            f'Batch was not put back after its flush raised {os.listdir(retry_dir)}'
+        raising[0] = False
+        assert _wait_for(lambda: queue.stats()['purged'] == 1), \
+            f'Saved batch was not retried {queue.stats()}'
+    assert os.listdir(retry_dir) == [], f'Retried batch was left behind {os.listdir(retry_dir)}'
+
+@pytest.mark.publish_unit_tests
+def test_purge_queue_reclaims_stale_claims (app, fake_fastly):
+    retry_dir = app.config['FASTLY_PURGE_RETRY_DIR']
+    os.makedirs(retry_dir)
+    # FASTLY_PURGE_CLAIM_TIMEOUT = 60
+    _save_batch(retry_dir, 'stale.json.99999', [['2402.00001', 1]], age=120)
+    _save_batch(retry_dir, 'fresh.json.99998', [['2402.00002', 1]])
+
+    with app.app_context():
+        queue = get_purge_queue()
+        assert _wait_for(lambda: queue.stats()['purged'] == 1), \
+            f'Stale claim was not retried {queue.stats()}'
+        time.sleep(4 * app.config['FASTLY_PURGE_RETRY_INTERVAL'])
+    assert fake_fastly.purged_keys() == ['abs-2402.00001'], \
+        f'Incorrect surrogate keys purged {fake_fastly.requests}'
+    assert os.listdir(retry_dir) == ['fresh.json.99998'], \
+        f'Fresh claim was taken from its worker {os.listdir(retry_dir)}'
+    assert queue.stats()['reclaimed'] == 1, f'Incorrect reclaimed count {queue.stats()}'
+
+@pytest.mark.publish_unit_tests
+def test_purge_queue_flushes_at_exit (app, fake_fastly):
+    app.config['FASTLY_PURGE_WINDOW'] = 60
+    with app.app_context():
+        queue = get_purge_queue()
+        queue.enqueue('2402.00001', 1)
+        queue.enqueue('2402.00002', 1)
+    assert fake_fastly.requests == [], 'Purged before the window closed'
+    queue.close()
+    assert fake_fastly.purged_keys() == ['abs-2402.00001', 'abs-2402.00002'], \
+        f'Pending purges were not sent at exit {fake_fastly.requests}'
+    assert queue.stats()['pending'] == 0, f'Purges left pending {queue.stats()}'
+
+@pytest.mark.publish_unit_tests
+@pytest.mark.parametrize('stored', [True, False])
+def test_publish_copy_mode (app, mock_publish_io, mocker, stored):
+    with open(mock_publish_io['html_file'], 'w') as f:
+        f.write(_synthetic_submission_html(10))
+    copy = mocker.patch('source.publish.copy_sub_to_doc_bucket',
+                        return_value=mock_publish_io['html_file'] if stored else None)
+    upload_html = mocker.patch('source.publish.upload_html_to_doc_bucket')
+
+    app.config['PUBLISH_MODE'] = 'copy'
+    with app.app_context():
+        assert _publish(1, '2402.00001', 1), 'Publish failed'
+
+    assert copy.called, 'Server side copy not attempted'
+    assert upload_html.called == stored and mock_publish_io['upload_dir_to_doc_bucket'].called != stored, \
+        'Wrong upload for the stored objects'
+    assert mock_publish_io['download_sub_to_doc_dir'].called != stored, \
+        'Downloaded the tarball despite the stored objects' if stored else 'No fallback to the tarball'
+
+@pytest.mark.publish_unit_tests
+def test_watermark_metadata_one_round_trip (app):
+    statements = []
+    with app.app_context():
+        with transaction() as session:
+            session.execute(text('CREATE TABLE arXiv_submissions (submission_id INTEGER, submit_time DATETIME)'))
+            session.execute(text('CREATE TABLE arXiv_metadata (paper_id TEXT, version INTEGER, abs_categories TEXT)'))
+            session.execute(text("INSERT INTO arXiv_submissions VALUES (1, '2024-02-06 12:00:00')"))
+            session.execute(text("INSERT INTO arXiv_metadata VALUES ('2402.00001', 1, 'cs.DL cs.AI')"))
+            session.commit()
+        def record (conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            metadata = get_watermark_metadata(1, '2402.00001', 1)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+    assert metadata == ('06 Feb 2024', 'cs.DL'), f'Incorrect watermark metadata {metadata}'
+    assert len(statements) == 1, f'Watermark metadata took {len(statements)} statements'
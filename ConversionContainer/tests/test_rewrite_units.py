@@ -0,0 +1,132 @@
+import pytest
+import os
+
+from bs4 import BeautifulSoup
+
+from source.convert.postprocess import (
+    PostProcessor,
+    base_tag,
+    base_tag_html,
+    absolute_anchors_for_submission,
+    absolute_anchors_for_doc,
+    submission_href,
+    doc_href
+)
+from source.convert.rewrite import StreamRewriter
+from source.convert import postprocess_html
+from source.publish.watermark import watermark_section
+from source.exceptions import HTMLInjectionError
+
+PAPER_IDV = '2402.00001v1'
+VIEW_SUB_BASE = 'https://services.arxiv.org'
+VIEW_DOC_BASE = 'https://arxiv.org'
+
+WATERMARK = f'<div id="watermark-tr">arXiv:{PAPER_IDV} [math.OC] 06 Feb 2024</div>'
+
+# Edge cases for the tokenizer. Passed through BeautifulSoup
+# first since that's the form every file we rewrite is in.
+EDGE_CASE_HTML = """<!DOCTYPE html>
+<html><head><title>a &lt; b</title>
+<script>var s = '<a class="ltx_ref" href="#not-a-tag">'; if (a < b) {}</script>
+<style>a.ltx_ref > span { color: red }</style>
+</head><body>
+<!-- <a class="ltx_ref" href="#commented"> -->
+<div class="ltx_page_content"><div class="section" id="target-section"><div id="license-tr">License</div><div><div></div></div></div>
+<a class="ltx_ref" href="#S1">1</a>
+<a class="ltx_ref ltx_href" href="#S1.E1&amp;x=1">2</a>
+<a class="ltx_url" href="#S2">not a ref</a>
+<a href="#S3" class="ltx_ref">3</a>
+<a class="ltx_ref" href='#q"uote'>4</a>
+<a class="ltx_ref" href="#both&quot;'">5</a>
+<a class="ltx_ref" href="https://services.arxiv.org/html/submission/123/view#bib.bib1">6</a>
+<a class="ltx_ref">no href</a>
+<a class="ltx_ref" href="">empty href</a>
+<p>Text with & ampersand, <b>bold</b> and a stray < sign</p>
+</div></body></html>
+"""
+
+def _read (fpath: str) -> str:
+    with open(fpath) as f:
+        return f.read()
+
+@pytest.fixture
+def edge_case_copies (tmp_path):
+    serialized = str(BeautifulSoup(EDGE_CASE_HTML, 'html.parser'))
+    def copy (name: str) -> str:
+        dst = os.path.join(tmp_path, name)
+        with open(dst, 'w') as f:
+            f.write(serialized)
+        return dst
+    return copy
+
+def _publish_soup (fpath: str) -> None:
+    PostProcessor(fpath) \
+        .register(base_tag, PAPER_IDV) \
+        .register(watermark_section, BeautifulSoup(WATERMARK, 'html.parser')) \
+        .register(absolute_anchors_for_doc, PAPER_IDV, VIEW_DOC_BASE) \
+        .run()
+
+def _publish_stream (fpath: str, chunk_size: int) -> None:
+    StreamRewriter(fpath, chunk_size) \
+        .append_to_head(base_tag_html(PAPER_IDV)) \
+        .append_to_id('target-section', WATERMARK) \
+        .rewrite_ltx_refs(lambda href: doc_href(href, PAPER_IDV, VIEW_DOC_BASE)) \
+        .run()
+
+"""
+******************************
+**** StreamRewriter tests ****
+******************************
+"""
+
+@pytest.mark.postprocess_unit_tests
+@pytest.mark.parametrize('chunk_size', [1 << 16, 4093])
+def test_stream_publish_matches_soup (html_copies, chunk_size):
+    soup, stream = html_copies('soup.html'), html_copies('stream.html')
+    _publish_soup(soup)
+    _publish_stream(stream, chunk_size)
+    assert _read(soup) == _read(stream), \
+        'Stream rewrite output differs from BeautifulSoup output'
+
+@pytest.mark.postprocess_unit_tests
+def test_stream_submission_anchors_matches_soup (html_copies):
+    soup, stream = html_copies('soup.html'), html_copies('stream.html')
+    PostProcessor(soup).register(absolute_anchors_for_submission, 5393936, VIEW_SUB_BASE).run()
+    StreamRewriter(stream) \
+        .rewrite_ltx_refs(lambda href: submission_href(href, 5393936, VIEW_SUB_BASE)) \
+        .run()
+    assert _read(soup) == _read(stream), \
+        'Stream rewrite output differs from BeautifulSoup output'
+
+@pytest.mark.postprocess_unit_tests
+@pytest.mark.parametrize('chunk_size', [1 << 16, 7, 1])
+def test_stream_edge_cases_match_soup (edge_case_copies, chunk_size):
+    soup, stream = edge_case_copies('soup.html'), edge_case_copies('stream.html')
+    _publish_soup(soup)
+    _publish_stream(stream, chunk_size)
+    assert _read(soup) == _read(stream), \
+        'Stream rewrite output differs from BeautifulSoup output'
+    assert 'href="#not-a-tag"' in _read(stream), 'Rewrote an anchor inside a <script>'
+    assert 'href="#commented"' in _read(stream), 'Rewrote an anchor inside a comment'
+
+@pytest.mark.postprocess_unit_tests
+def test_stream_missing_insertion_point (edge_case_copies):
+    fpath = edge_case_copies('stream.html')
+    before = _read(fpath)
+    with pytest.raises(HTMLInjectionError):
+        StreamRewriter(fpath).append_to_id('no-such-id', WATERMARK).run()
+    assert _read(fpath) == before, 'File was replaced despite a failed rewrite'
+    assert not os.path.exists(f'{fpath}.rewrite'), 'Temporary file was left behind'
+
+@pytest.mark.postprocess_unit_tests
+@pytest.mark.parametrize('id, is_submission', [('5393936', True), (PAPER_IDV, False)])
+@pytest.mark.parametrize('missing_packages', [None, ['tikz', 'pgfplots']])
+def test_stream_conversion_postprocess_matches_soup (app, edge_case_copies, id, is_submission, missing_packages):
+    soup, stream = edge_case_copies('soup.html'), edge_case_copies('stream.html')
+    with app.app_context():
+        for fpath, mode in ((soup, 'soup'), (stream, 'stream')):
+            app.config['HTML_REWRITE_MODE'] = mode
+            postprocess_html(fpath, id, is_submission, 'License: CC BY 4.0', missing_packages)
+    assert _read(soup) == _read(stream), \
+        'Stream post processing differs from BeautifulSoup post processing'
+    assert 'License: CC BY 4.0' in _read(stream), 'License missing'
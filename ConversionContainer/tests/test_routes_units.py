@@ -0,0 +1,94 @@
+import pytest
+import threading
+import json
+from base64 import b64encode
+
+PROCESS_PAYLOAD = { 'name': 'arxiv_id/5393936.tar.gz', 'bucket': 'latexml_arxiv_id_source' }
+
+@pytest.fixture
+def blocked_process (mocker):
+    """ Replaces process with one that holds its worker until released """
+    release, started = threading.Event(), threading.Event()
+    def process (*args):
+        started.set()
+        release.wait(timeout=10)
+    mock = mocker.patch('source.routes.process', side_effect=process)
+    mock.__name__ = 'process'
+    yield mock, started
+    release.set()
+
+"""
+******************************
+* Conversion admission tests *
+******************************
+"""
+
+@pytest.mark.routes_unit_tests
+def test_process_rejects_when_queue_full (app_client, blocked_process):
+    process, started = blocked_process
+    # CONVERSION_CONCURRENCY = 1 running, CONVERSION_QUEUE_SIZE = 1 waiting
+    assert app_client.post('/process', json=PROCESS_PAYLOAD).status_code == 200, \
+        'First conversion was not accepted'
+    assert started.wait(timeout=5), 'First conversion never started'
+    assert app_client.post('/process', json=PROCESS_PAYLOAD).status_code == 200, \
+        'Second conversion was not queued'
+    assert app_client.post('/process', json=PROCESS_PAYLOAD).status_code == 429, \
+        'Conversion was accepted past the queue size'
+
+    stats = app_client.get('/health').json['executors']['conversion']
+    assert (stats['in_flight'], stats['queued']) == (1, 1), \
+        f'Incorrect executor stats {stats}'
+
+@pytest.mark.routes_unit_tests
+def test_process_ignores_extraneous_files (app_client, blocked_process):
+    process, _ = blocked_process
+    response = app_client.post('/process', json={ 'name': 'arxiv_id/5393936.pdf', 'bucket': 'b' })
+    assert response.status_code == 202, f'Incorrect status_code {response.status_code}'
+    assert not process.called, 'Conversion started for an extraneous file'
+
+def _message (data: dict) -> dict:
+    return { 'message': { 'data': b64encode(json.dumps(data).encode('utf-8')).decode('utf-8') } }
+
+@pytest.mark.routes_unit_tests
+@pytest.mark.parametrize('route, fn, data, args', [
+    ('/single-convert', 'single_convert', { 'paper_id': '2402.00001', 'version': 1 }, ('2402.00001', 1, True)),
+    ('/single-convert', 'single_convert', { 'paper_id': '2402.00001', 'version': 1, 'force': False }, ('2402.00001', 1, False)),
+    ('/reconvert-submission', 'reconvert_submission', { 'submission_id': 1 }, (1, True)),
+    ('/reconvert-submission', 'reconvert_submission', { 'submission_id': 1, 'force': False }, (1, False)),
+])
+def test_reconversions_force_by_default (app_client, mocker, route, fn, data, args):
+    called = threading.Event()
+    mock = mocker.patch(f'source.routes.{fn}', side_effect=lambda *_: called.set())
+    mock.__name__ = fn
+    assert app_client.post(route, json=_message(data)).status_code == 200, 'Reconversion was not queued'
+    assert called.wait(timeout=5), 'Reconversion never ran'
+    assert mock.call_args.args == args, f'Incorrect reconversion {mock.call_args}'
+
+"""
+******************************
+*** Publish admission tests **
+******************************
+"""
+
+@pytest.mark.routes_unit_tests
+def test_publish_rejects_when_queue_full (app_client, blocked_process, mocker):
+    release, started = threading.Event(), threading.Event()
+    def publish (payload):
+        started.set()
+        release.wait(timeout=10)
+    mock = mocker.patch('source.routes.publish', side_effect=publish)
+    mock.__name__ = 'publish'
+    try:
+        # PUBLISH_CONCURRENCY = 1 running, PUBLISH_QUEUE_SIZE = 1 waiting
+        assert app_client.post('/publish', json={}).status_code == 202, \
+            'First publish was not accepted'
+        assert started.wait(timeout=5), 'First publish never started'
+        assert app_client.post('/publish', json={}).status_code == 202, \
+            'Second publish was not queued'
+        assert app_client.post('/publish', json={}).status_code == 429, \
+            'Publish was accepted past the queue size'
+        # Conversions have their own executor
+        assert app_client.post('/process', json=PROCESS_PAYLOAD).status_code == 200, \
+            'Publishes blocked a conversion'
+    finally:
+        release.set()
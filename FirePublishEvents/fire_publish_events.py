@@ -1,13 +1,18 @@
 import json
 import os
-from time import sleep
+from concurrent import futures
+from time import monotonic, sleep
+from typing import Any, Dict, List, Tuple
 
 from sqlalchemy import create_engine
 from sqlalchemy.engine import Row
 from sqlalchemy.exc import OperationalError
 
 import functions_framework
+from google.api_core.exceptions import AlreadyExists
 from google.cloud.pubsub_v1 import PublisherClient
+from google.cloud.pubsub_v1.types import BatchSettings, LimitExceededBehavior, \
+    PublisherOptions, PublishFlowControl
 
 """
 Gather Environment Variables
@@ -18,16 +23,91 @@ PROJECT_ID = os.environ['PROJECT_ID']
 TOPIC_ID = os.environ['TOPIC_ID']
 DB_URI = os.environ['DB_URI']
 
+""" Publishing knobs, optional """
+# Messages per second handed to the client, 0 for no limit
+PUBLISH_RATE = float(os.environ.get('PUBLISH_RATE', 100))
+# Messages published but not yet acknowledged before publish() blocks
+PUBLISH_MAX_OUTSTANDING = int(os.environ.get('PUBLISH_MAX_OUTSTANDING', 500))
+# Publish to the pub/sub emulator at PUBSUB_EMULATOR_HOST instead of GCP
+DRY_RUN = os.environ.get('DRY_RUN', '').lower() in ('1', 'true', 'yes')
+
+
+def _get_publisher () -> PublisherClient:
+    """ Client that batches messages and blocks instead of queueing without bound """
+    return PublisherClient(
+        batch_settings=BatchSettings(
+            max_messages=100,
+            max_bytes=1024 * 1024,
+            max_latency=0.05),
+        publisher_options=PublisherOptions(
+            flow_control=PublishFlowControl(
+                message_limit=PUBLISH_MAX_OUTSTANDING,
+                limit_exceeded_behavior=LimitExceededBehavior.BLOCK)))
+
+def _format_payload (row: Row) -> bytes:
+    return json.dumps(dict(row._mapping)).encode('utf-8')
+
+def publish_rows (publisher: PublisherClient, topic_path: str, rows: List[Row]) -> Dict[str, Any]:
+    """
+    Publishes one message per row at no more than PUBLISH_RATE per
+    second, then waits on all of them together. One failed row
+    doesn't stop the rest.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Summary of the run: rows read, messages published, the
+        rows that failed with their errors, and the time taken
+    """
+    start = monotonic()
+    pending: List[Tuple[bytes, futures.Future]] = []
+    failed: List[Dict[str, str]] = []
+
+    for i, row in enumerate(rows):
+        if PUBLISH_RATE > 0:
+            ahead = start + i / PUBLISH_RATE - monotonic()
+            if ahead > 0:
+                sleep(ahead)
+        try: # We don't want to crash on one failed _format_payload or pub fire
+            payload = _format_payload(row)
+            pending.append((payload, publisher.publish(topic_path, payload)))
+        except Exception as e:
+            failed.append({'row': str(tuple(row)), 'error': str(e)})
+
+    futures.wait([future for _, future in pending])
+    published = 0
+    for payload, future in pending:
+        e = future.exception()
+        if e is None:
+            published += 1
+            print (f'{payload}: {future.result()}')
+        else:
+            failed.append({'row': payload.decode('utf-8'), 'error': str(e)})
+
+    return {
+        'dry_run': DRY_RUN,
+        'rows': len(rows),
+        'published': published,
+        'failed': failed,
+        'seconds': round(monotonic() - start, 3)
+    }
 
 @functions_framework.cloud_event
 def main(cloud_event):
 
     """ GCP API's and DB connector """
-    publisher = PublisherClient()
+    if DRY_RUN and not os.environ.get('PUBSUB_EMULATOR_HOST'):
+        raise RuntimeError('DRY_RUN publishes to the pub/sub emulator, set PUBSUB_EMULATOR_HOST')
+    publisher = _get_publisher()
     topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
+    if DRY_RUN:
+        try:
+            publisher.create_topic(name=topic_path)
+        except AlreadyExists:
+            pass
     engine = create_engine(DB_URI)
 
-    """ 
+    """
     Fetch Rows
 
     This section should crash the program on fail. Cloud function retry will attempt it again
@@ -40,15 +120,12 @@ def main(cloud_event):
         rows = conn.execute(query).fetchall()
 
     """ Send Events """
-    def _format_payload (row: Row) -> str: 
-        return json.dumps({k: row[k] for k in row._mapping.keys()}).encode('utf-8')
+    summary = publish_rows(publisher, topic_path, rows)
+    print (json.dumps(summary))
+    if summary['failed']:
+        print (f'WARNING: {len(summary["failed"])} of {summary["rows"]} rows failed to publish')
+    return summary
 
-    for i, row in enumerate(rows):
-        if i % 50 == 0:
-            sleep(3)
-        try: # We don't want to crash on one failed _format_payload or pub fire
-            future = publisher.publish(topic_path, _format_payload(row))
-            res = future.result()
-            print (f'{_format_payload(row)}: {res}')
-        except Exception as e:
-            print (f'WARNING: {str(e)}')
+if __name__ == '__main__':
+    # Local runs, e.g. DRY_RUN=1 PUBSUB_EMULATOR_HOST=localhost:8085
+    main(None)
@@ -0,0 +1,62 @@
+import pytest
+import os
+
+from sqlalchemy import create_engine, text
+
+MARKERS = [
+    "publish_unit_tests: Unit tests for publishing rows as pub/sub events",
+]
+
+# fire_publish_events reads these at import
+TESTING_ENV = {
+    'PROJECT_ID': 'arxiv-test',
+    'TOPIC_ID': 'latexml-test',
+    'DB_URI': 'sqlite://',
+}
+
+for key, value in TESTING_ENV.items():
+    os.environ.setdefault(key, value)
+
+def pytest_configure(config):
+    for marker in MARKERS:
+        config.addinivalue_line("markers", marker)
+
+@pytest.fixture
+def rows():
+    """ Three arXiv_next_mail shaped rows: two papers and a submission """
+    engine = create_engine('sqlite://')
+    with engine.connect() as conn:
+        return conn.execute(text(
+            "select null as submission_id, 1 as document_id, '2401.00001' as paper_id, 1 as version, 'new' as type "
+            "union all select null, 2, '2401.00002', 3, 'rep' "
+            "union all select 5393936, null, null, null, 'sub'")).fetchall()
+
+@pytest.fixture
+def publisher(mocker):
+    """ A PublisherClient whose publish() returns an already resolved future per message """
+    from concurrent.futures import Future
+    def publish(topic_path, payload):
+        future = Future()
+        future.set_result(str(publisher.publish.call_count))
+        return future
+    publisher = mocker.Mock()
+    publisher.publish.side_effect = publish
+    publisher.topic_path.side_effect = lambda project, topic: f'projects/{project}/topics/{topic}'
+    return publisher
+
+@pytest.fixture
+def clock(mocker):
+    """ Stands in for monotonic and sleep so pacing runs instantly, recording each sleep """
+    class Clock:
+        def __init__ (self):
+            self.now = 0.0
+            self.sleeps = []
+        def monotonic (self):
+            return self.now
+        def sleep (self, seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+    clock = Clock()
+    mocker.patch('fire_publish_events.monotonic', side_effect=clock.monotonic)
+    mocker.patch('fire_publish_events.sleep', side_effect=clock.sleep)
+    return clock
@@ -0,0 +1,135 @@
+import pytest
+import json
+from concurrent.futures import Future
+
+pytest.importorskip('functions_framework')
+pytest.importorskip('google.cloud.pubsub_v1')
+
+import fire_publish_events
+from fire_publish_events import publish_rows, main
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.pubsub_v1.types import LimitExceededBehavior
+
+TOPIC = 'projects/arxiv-test/topics/latexml-test'
+
+def _failed_future (error):
+    future = Future()
+    future.set_exception(error)
+    return future
+
+"""
+******************************
+******* batching tests *******
+******************************
+"""
+
+@pytest.mark.publish_unit_tests
+def test_publish_rows_publishes_each_row (publisher, rows, clock):
+    summary = publish_rows(publisher, TOPIC, rows)
+    payloads = [json.loads(call.args[1]) for call in publisher.publish.call_args_list]
+    assert all(call.args[0] == TOPIC for call in publisher.publish.call_args_list), 'Published to the wrong topic'
+    assert payloads == [dict(row._mapping) for row in rows], 'Payloads do not match the rows'
+    assert (summary['rows'], summary['published'], summary['failed']) == (3, 3, []), \
+        f'Incorrect summary {summary}'
+
+@pytest.mark.publish_unit_tests
+def test_publish_rows_survives_failed_rows (publisher, rows, clock):
+    resolve = publisher.publish.side_effect
+    publisher.publish.side_effect = [
+        RuntimeError('publish refused'),
+        _failed_future(RuntimeError('publish timed out')),
+        resolve(TOPIC, b'')]
+    summary = publish_rows(publisher, TOPIC, rows)
+    errors = sorted(failure['error'] for failure in summary['failed'])
+    assert publisher.publish.call_count == 3, 'Stopped publishing after a failed row'
+    assert summary['published'] == 1, 'Incorrect published count'
+    assert errors == ['publish refused', 'publish timed out'], f'Incorrect failures {summary["failed"]}'
+
+@pytest.mark.publish_unit_tests
+def test_publisher_batches_and_blocks (mocker):
+    client = mocker.patch('fire_publish_events.PublisherClient')
+    mocker.patch('fire_publish_events.PUBLISH_MAX_OUTSTANDING', 7)
+    fire_publish_events._get_publisher()
+    kwargs = client.call_args.kwargs
+    flow_control = kwargs['publisher_options'].flow_control
+    assert kwargs['batch_settings'].max_messages > 1, 'Publisher sends one message per request'
+    assert flow_control.message_limit == 7, 'Outstanding messages not bounded by PUBLISH_MAX_OUTSTANDING'
+    assert flow_control.limit_exceeded_behavior == LimitExceededBehavior.BLOCK, \
+        'Publisher does not block at the outstanding limit'
+
+"""
+******************************
+******** pacing tests ********
+******************************
+"""
+
+@pytest.mark.publish_unit_tests
+def test_publish_rows_paces_to_rate (mocker, publisher, rows, clock):
+    mocker.patch('fire_publish_events.PUBLISH_RATE', 4)
+    sent_at = []
+    resolve = publisher.publish.side_effect
+    def publish(topic_path, payload):
+        sent_at.append(clock.now)
+        return resolve(topic_path, payload)
+    publisher.publish.side_effect = publish
+    publish_rows(publisher, TOPIC, rows)
+    assert sent_at == [0, 0.25, 0.5], f'Rows not spaced 1 / PUBLISH_RATE apart: {sent_at}'
+
+@pytest.mark.publish_unit_tests
+def test_publish_rows_does_not_sleep_when_behind (mocker, publisher, rows, clock):
+    mocker.patch('fire_publish_events.PUBLISH_RATE', 4)
+    resolve = publisher.publish.side_effect
+    def slow_publish(topic_path, payload):
+        clock.now += 1
+        return resolve(topic_path, payload)
+    publisher.publish.side_effect = slow_publish
+    publish_rows(publisher, TOPIC, rows)
+    assert clock.sleeps == [], 'Slept while already behind PUBLISH_RATE'
+
+@pytest.mark.publish_unit_tests
+def test_publish_rows_unpaced_at_rate_zero (mocker, publisher, rows, clock):
+    mocker.patch('fire_publish_events.PUBLISH_RATE', 0)
+    publish_rows(publisher, TOPIC, rows)
+    assert clock.sleeps == [], 'Slept with PUBLISH_RATE 0'
+
+"""
+******************************
+******* dry run tests ********
+******************************
+"""
+
+@pytest.fixture
+def mail_db (mocker, rows):
+    """ Points main's engine at rows instead of arXiv_next_mail """
+    engine = mocker.patch('fire_publish_events.create_engine').return_value
+    engine.connect.return_value.__enter__.return_value.execute.return_value.fetchall.return_value = rows
+    return engine
+
+@pytest.mark.publish_unit_tests
+def test_dry_run_requires_emulator (mocker, publisher, mail_db, monkeypatch):
+    mocker.patch('fire_publish_events.DRY_RUN', True)
+    monkeypatch.delenv('PUBSUB_EMULATOR_HOST', raising=False)
+    get_publisher = mocker.patch('fire_publish_events._get_publisher', return_value=publisher)
+    with pytest.raises(RuntimeError):
+        main(None)
+    assert not get_publisher.called and not publisher.publish.called, 'Dry run reached pub/sub without an emulator'
+
+@pytest.mark.publish_unit_tests
+@pytest.mark.parametrize('topic_exists', [False, True])
+def test_dry_run_publishes_to_emulator_topic (mocker, publisher, mail_db, clock, monkeypatch, topic_exists):
+    mocker.patch('fire_publish_events.DRY_RUN', True)
+    monkeypatch.setenv('PUBSUB_EMULATOR_HOST', 'localhost:8085')
+    mocker.patch('fire_publish_events._get_publisher', return_value=publisher)
+    if topic_exists:
+        publisher.create_topic.side_effect = AlreadyExists('topic exists')
+    summary = main(None)
+    publisher.create_topic.assert_called_once_with(name=TOPIC)
+    assert summary['dry_run'] and summary['published'] == 3, f'Incorrect dry run summary {summary}'
+
+@pytest.mark.publish_unit_tests
+def test_live_run_leaves_topic_alone (mocker, publisher, mail_db, clock):
+    mocker.patch('fire_publish_events.DRY_RUN', False)
+    mocker.patch('fire_publish_events._get_publisher', return_value=publisher)
+    summary = main(None)
+    assert not publisher.create_topic.called, 'Live run tried to create the topic'
+    assert not summary['dry_run'] and summary['published'] == 3, f'Incorrect summary {summary}'
@@ -1,7 +1,11 @@
 import logging
-from typing import List
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Type
 
+from flask import current_app
 from sqlalchemy.sql import text
+from sqlalchemy.exc import OperationalError
 
 from arxiv_auth.legacy.util import is_configured, current_session
 
@@ -22,11 +26,73 @@ def is_moderator (user_id: int) -> bool:
         .bindparams(user_id=user_id)
     return conn.execute(query).scalar() is not None
 
+AUTH_CACHE_MAX_ENTRIES = 10000
+
+class _DecisionCache:
+    """
+    (user_id, submission_id) -> authorization decision for ttl seconds,
+    where a decision is None for allowed or the exception to raise
+    """
+
+    def __init__ (self):
+        self.decisions: Dict[Tuple[int, int], Tuple[float, Optional[Type[Exception]]]] = {}
+        self.lock = threading.Lock()
+
+    def get (self, key: Tuple[int, int]) -> Tuple[bool, Optional[Type[Exception]]]:
+        """ Returns (found, decision) """
+        with self.lock:
+            entry = self.decisions.get(key)
+            if entry is None:
+                return False, None
+            expires, decision = entry
+            if expires < time.monotonic():
+                del self.decisions[key]
+                return False, None
+            return True, decision
+
+    def put (self, key: Tuple[int, int], decision: Optional[Type[Exception]], ttl: float):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.decisions) >= AUTH_CACHE_MAX_ENTRIES:
+                self.decisions = { k: v for k, v in self.decisions.items() if v[0] >= now }
+                if len(self.decisions) >= AUTH_CACHE_MAX_ENTRIES:
+                    self.decisions.clear()
+            self.decisions[key] = (now + ttl, decision)
+
+_decisions = _DecisionCache()
+
 @database_retry(5)
+def _get_authorization_row (user_id: int, submission_id: int):
+    query = text(
+        "SELECT s.submitter_id, s.is_withdrawn, s.status, "
+        "EXISTS (SELECT 1 FROM tapir_users WHERE flag_edit_users = 1 AND user_id=:user_id) AS is_editor, "
+        "EXISTS (SELECT 1 FROM arXiv_moderators WHERE user_id=:user_id) AS is_moderator "
+        "FROM arXiv_submissions s WHERE s.submission_id=:submission_id") \
+        .bindparams(user_id=user_id, submission_id=submission_id)
+    try:
+        return current_session().connection().execute(query).first()
+    except OperationalError as e:
+        raise DBConnectionError from e
+
+def _decide (submitter_id, is_withdrawn, status, is_editor, is_moderator,
+             user_id: int) -> Optional[Type[Exception]]:
+    # Check for editor / moderator first so they can still see deleted papers
+    if is_editor or is_moderator:
+        return None
+
+    if submitter_id and int(submitter_id) == int(user_id) \
+        and not is_withdrawn and status < 9:
+        return None
+    elif status > 9:
+        return DeletedError
+    return UnauthorizedError
+
 def authorize_user_for_submission(user_id: str, submission_id: str):
     """
     Checks if the user is authorized to submit. Returns None if successful,
-    raise exception otherwise
+    raise exception otherwise. Decisions are cached for AUTH_CACHE_TTL
+    seconds, so a change of ownership, withdrawal or editor/moderator
+    flags is only seen once the user's cached decision expires.
 
     Parameters
     ----------
@@ -39,29 +105,21 @@ def authorize_user_for_submission(user_id: str, submission_id: str):
     DBConfigError
     UnauthorizedError
     """
-    if is_configured():
-        query = text("SELECT submitter_id, is_withdrawn, status FROM arXiv_submissions WHERE submission_id=:submission_id") \
-            .bindparams(submission_id=submission_id)
-        row = current_session().connection().execute(query).first()
-
-        if row:
-            submitter_id, is_withdrawn, status = row.tuple()
-        else:
+    key = (int(user_id), int(submission_id))
+    found, decision = _decisions.get(key)
+    if not found:
+        if not is_configured():
+            logging.warning('DB Not Configured')
+            raise DBConfigError("db not configured")
+
+        # submission row and editor/moderator flags in one round trip
+        row = _get_authorization_row(*key)
+        if not row:
             logging.warning(f'Cannot find row for submission_id: {submission_id}')
             raise DBConfigError
-        
-        # Check for editor / moderator first so they can still see deleted papers
-        if is_editor(user_id) or is_moderator(user_id):
-            return
-
-        if submitter_id and int(submitter_id) == int(user_id) \
-            and not is_withdrawn and status < 9:
-            return
-        elif status > 9:
-            raise DeletedError
-        raise UnauthorizedError
-    
-    logging.warning('DB Not Configured')
-    raise DBConfigError("db not configured")
 
-    
\ No newline at end of file
+        decision = _decide(*tuple(row), user_id)
+        _decisions.put(key, decision, current_app.config['AUTH_CACHE_TTL'])
+
+    if decision:
+        raise decision
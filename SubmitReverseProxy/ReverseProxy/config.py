@@ -33,4 +33,18 @@ BUILD_HTML_TOPIC = os.environ.get('BUILD_HTML_TOPIC', 'html-direct-convert')
 REPROCESS_SUBMISSION_TOPIC = os.environ.get('REPROCESS_SUBMISSION_TOPIC', 'html-reprocess-submission')
 
 SITES_DIR = '/source/ReverseProxy/sites/'
-TARS_DIR = '/source/ReverseProxy/downloads/'
\ No newline at end of file
+TARS_DIR = '/source/ReverseProxy/downloads/'
+
+# Seconds an authorization decision for (user, submission) is reused, and so
+# how long an ownership or permission change can go unnoticed
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 30))
+
+# Submission site tars kept in TARS_DIR before the least recently viewed are removed
+SITE_CACHE_MAX_BYTES = int(os.environ.get('SITE_CACHE_MAX_MB', 2048)) * 1024 * 1024
+
+# Seconds between status queries shared by a submission's long-polls, and the longest hold
+POLL_INTERVAL = float(os.environ.get('POLL_INTERVAL', 2))
+POLL_MAX_WAIT = float(os.environ.get('POLL_MAX_WAIT', 25))
+
+# Most ids a /status/submissions or /status/documents request may ask about
+STATUS_BATCH_MAX = int(os.environ.get('STATUS_BATCH_MAX', 1000))
@@ -19,3 +19,16 @@ class DBLaTeXMLSubmissions(db.Model):
     tex_checksum = Column(String)
     conversion_start_time = Column(Integer)
     conversion_end_time = Column(Integer)
+
+class DBLaTeXMLDocuments(db.Model):
+    __bind_key__ = 'latexml'
+    __tablename__ = 'arXiv_latexml_doc'
+
+    paper_id = Column(String(20), primary_key=True)
+    document_version = Column(Integer, primary_key=True)
+    # conversion_status codes as in DBLaTeXMLSubmissions
+    conversion_status = Column(Integer, nullable=False)
+    latexml_version = Column(String(40), nullable=False)
+    tex_checksum = Column(String)
+    conversion_start_time = Column(Integer)
+    conversion_end_time = Column(Integer)
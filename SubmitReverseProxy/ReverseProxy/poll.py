@@ -1,7 +1,9 @@
-from typing import Optional
+from typing import Callable, Dict, Optional
 import logging
+import threading
+import time
 
-from flask import Response
+from flask import Response, current_app
 
 from arxiv_auth.legacy.models import db
 
@@ -19,12 +21,89 @@ def _get_latexml_status_for_document (submission_id: int) -> Optional[int]:
             .scalar()
     except Exception as e:
         raise DBConnectionError from e
+    finally:
+        # Ends the read so a held poll doesn't pin a pooled connection,
+        # and the next fetch sees conversions committed since
+        db.session.rollback()
     
-def poll_submission (submission_id) -> Response:
+class _Watch:
+    """ Latest conversion_status of one submission, shared by its pollers """
+
+    def __init__ (self):
+        self.status: Optional[int] = None
+        self.checked_at = float('-inf')
+        self.querying = False
+        self.pollers = 0
+
+class StatusBoard:
+    """
+    Shares conversion_status lookups between everyone polling a
+    submission: at most one query per submission per interval,
+    made by whichever poller finds the status stale first while
+    the rest wait on it.
+    """
+
+    def __init__ (self):
+        self.watches: Dict[int, _Watch] = {}
+        self.cond = threading.Condition()
+
+    def _current (self, watch: _Watch, submission_id: int, interval: float,
+                  fetch: Callable[[int], Optional[int]]) -> Optional[int]:
+        """ Returns a status no older than interval. Called with self.cond held """
+        while watch.querying:
+            self.cond.wait()
+        if time.monotonic() - watch.checked_at < interval:
+            return watch.status
+        watch.querying = True
+        self.cond.release()
+        try:
+            status = fetch(submission_id)
+        finally:
+            self.cond.acquire()
+            watch.querying = False
+            self.cond.notify_all()
+        watch.status, watch.checked_at = status, time.monotonic()
+        return status
+
+    def wait (self, submission_id: int, timeout: float, interval: float,
+              fetch: Callable[[int], Optional[int]]) -> Optional[int]:
+        """
+        Returns the conversion_status once it differs from the one
+        seen on arrival, or after timeout seconds. Returns at once
+        if the conversion already succeeded.
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            watch = self.watches.setdefault(submission_id, _Watch())
+            watch.pollers += 1
+            try:
+                status = baseline = self._current(watch, submission_id, interval, fetch)
+                while status == baseline and baseline != 1:
+                    now = time.monotonic()
+                    if now >= deadline:
+                        break
+                    self.cond.wait(min(deadline, watch.checked_at + interval) - now)
+                    status = self._current(watch, submission_id, interval, fetch)
+                return status
+            finally:
+                watch.pollers -= 1
+                if not watch.pollers:
+                    del self.watches[submission_id]
+
+_board = StatusBoard()
+
+def poll_submission (submission_id, wait: float = 0) -> Response:
+    """
+    {'exists': bool} for the submission's html. With wait > 0 the
+    request is held for up to that many seconds (capped at
+    POLL_MAX_WAIT) until the conversion_status changes.
+    """
     try:
-        conversion_status = _get_latexml_status_for_document(submission_id)
-        logging.info(f'TYPE: {type(conversion_status)}')
-        logging.info(f'VALUE: {conversion_status}')
+        conversion_status = _board.wait(
+            int(submission_id),
+            min(max(wait, 0), current_app.config['POLL_MAX_WAIT']),
+            current_app.config['POLL_INTERVAL'],
+            _get_latexml_status_for_document)
         if conversion_status == 1:
             return {'exists': True}, 200
         return {'exists': False}, 200
@@ -2,16 +2,19 @@ from typing import Tuple, Optional, Callable, Any
 from functools import wraps
 import logging
 import os
+import io
 import json
+from datetime import datetime, timezone
 
-from flask import Blueprint, Request, \
+from flask import Blueprint, Request, Response, \
     request, current_app, \
-    send_from_directory, g, \
-    redirect
+    send_file, g, \
+    redirect, abort
 from flask_cors import cross_origin
 from werkzeug.exceptions import BadRequest
+from werkzeug.http import is_resource_modified
 
-from google.cloud.storage import Client
+from google.cloud.storage import Bucket, Client
 import google.auth
 from google.auth.credentials import Credentials
 from google.auth.transport import requests
@@ -20,7 +23,8 @@ from google.cloud.pubsub_v1 import PublisherClient
 from .authorize import authorize_user_for_submission, is_editor, is_moderator
 from .db_queries import get_source_format
 from .poll import poll_submission
-from .util import untar, clean_up
+from .site_cache import TarSite, get_site_cache
+from .status import batch_status
 from .exceptions import AuthError, DeletedError, UnauthorizedError
 
 blueprint = Blueprint('routes', __name__, '')
@@ -29,12 +33,35 @@ def _get_google_auth () -> Tuple[Credentials, str, Client]:
     credentials, project_id = google.auth.default()
     return (credentials, project_id, Client(credentials=credentials))
 
+def _converted_bucket () -> Bucket:
+    _, _, storage_client = _get_google_auth()
+    return storage_client.bucket(current_app.config['CONVERTED_BUCKET_SUB_ID'])
+
 def _get_arxiv_user_id () -> int:
     try:
         return request.auth.user.user_id
     except Exception as e:
         raise AuthError from e
 
+def _send_from_site (site: TarSite, path: str) -> Response:
+    member = site.member(path)
+    if member is None:
+        abort(404)
+    _, _, mtime = member
+    etag, last_modified = site.etag(path), datetime.fromtimestamp(mtime, timezone.utc)
+    # Revalidations are answered without reading the member
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+    return send_file(
+        io.BytesIO(site.read(path)),
+        download_name=os.path.basename(path), # for the mimetype
+        etag=etag,
+        last_modified=last_modified,
+        conditional=True)
+
 def authorize (submission_id: int):
     user_id = _get_arxiv_user_id()
     authorize_user_for_submission(user_id, submission_id)
@@ -44,7 +71,8 @@ def authorize (submission_id: int):
 # @authorize
 def poll (submission_id: int):
     authorize(submission_id)
-    return poll_submission(submission_id)
+    # ?wait=<seconds> holds the request until the status changes
+    return poll_submission(submission_id, request.args.get('wait', 0, type=float))
 
 @blueprint.route('/<int:submission_id>/view', methods=['GET'])
 @cross_origin(supports_credentials=True)
@@ -53,36 +81,33 @@ def get (submission_id: int):
     authorize(submission_id)
 
     logging.info('SUCCESSFULLY AUTHORIZED')
-     
-    BUCKET = current_app.config['CONVERTED_BUCKET_SUB_ID']
-    TARS_DIR = current_app.config['TARS_DIR']
-
-    _, _, storage_client = _get_google_auth()
-    bucket = storage_client.get_bucket(BUCKET)
-    blob = bucket.blob(f'{submission_id}.tar.gz')
-
-    blob.download_to_filename(f'{TARS_DIR}{submission_id}')
-
-    logging.info(f'Successfully downloaded to {TARS_DIR}{submission_id}')
 
-    abs_path = untar(submission_id)
-    dir = os.path.relpath(abs_path, current_app.root_path)
+    # Only downloads if the conversion changed since this site was last viewed
+    site = get_site_cache().get(_converted_bucket(), submission_id)
 
-    logging.info(f'Successfully untarred to {abs_path}')
+    logging.info(f'Serving {submission_id} generation {site.generation}: {get_site_cache().stats()}')
     
-    return send_from_directory (dir, f'{submission_id}.html')
+    return _send_from_site(site, f'{submission_id}.html')
 
 @blueprint.route('/<int:submission_id>/<path:path>', methods=['GET'])
 @cross_origin(supports_credentials=True)
 def get_static (submission_id: int, path: str):
-    SITES_DIR = current_app.config['SITES_DIR']
-
-    dir = os.path.join(
-        os.path.relpath(SITES_DIR, current_app.root_path),
-        str(submission_id)
-    )
+    authorize(submission_id)
+    # Assets of the site the last /view fetched, or fetched here if this
+    # process never had it or has evicted it since
+    site = get_site_cache().cached(submission_id) \
+        or get_site_cache().get(_converted_bucket(), submission_id)
+    return _send_from_site(site, path)
 
-    return send_from_directory (dir, path)
+@blueprint.route('/status/<kind>', methods=['POST'])
+@cross_origin(supports_credentials=True)
+def get_batch_status (kind: str):
+    # One auth check and one query for the whole batch, for dashboards and moderation tools
+    user_id = _get_arxiv_user_id()
+    if not (is_editor(user_id) or is_moderator(user_id)):
+        raise UnauthorizedError
+    return batch_status(kind, request.get_json(silent=True),
+                        current_app.config['STATUS_BATCH_MAX'])
 
 @blueprint.route('/build-html/<paper_id>/<int:version>', methods=['GET'])
 @cross_origin(supports_credentials=True)
@@ -0,0 +1,238 @@
+"""Local cache of submission sites, served straight out of their tarballs"""
+from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+import gzip
+import logging
+import os
+import re
+import shutil
+import tarfile
+import threading
+import time
+
+from flask import current_app
+from google.cloud.storage import Bucket
+
+from .exceptions import DeletedError
+
+# Site tars are kept as {tars_dir}{submission_id}.{generation}.tar
+TAR_NAME = re.compile(r'(\d+)\.(\d+)\.tar')
+# Downloads not renamed into place after this long were abandoned by their process
+STALE_DOWNLOAD_SECONDS = 3600
+
+def _remove (path: str):
+    """ Removes path unless another process sharing tars_dir already has """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class _Flight:
+    """ One download of a submission that concurrent viewers wait on """
+
+    def __init__ (self):
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+class TarSite:
+    """
+    A submission's converted site kept as an uncompressed tar,
+    with an index of member name -> (offset, size, mtime) so a
+    file is read with one pread instead of extracting the site.
+
+    The tar stays open for as long as the site is referenced, so
+    requests holding a site the cache has since evicted or replaced
+    keep reading it after its file is removed. It's closed once the
+    last of them drops it.
+    """
+
+    def __init__ (self, submission_id: int, generation: int, tar_path: str):
+        self.submission_id = submission_id
+        self.generation = generation
+        self.tar_path = tar_path
+        self.index: Dict[str, Tuple[int, int, int]] = {}
+        with tarfile.open(tar_path) as tar:
+            for member in tar:
+                if member.isfile():
+                    self.index[os.path.normpath(member.name)] = \
+                        (member.offset_data, member.size, int(member.mtime))
+        self.fd = os.open(tar_path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+
+    def member (self, path: str) -> Optional[Tuple[int, int, int]]:
+        """ (offset, size, mtime) of path inside the site's directory, None if it isn't there """
+        return self.index.get(os.path.normpath(os.path.join(str(self.submission_id), path)))
+
+    def read (self, path: str) -> bytes:
+        offset, size, _ = self.member(path)
+        # Positional, so concurrent reads can share the descriptor
+        return os.pread(self.fd, size, offset)
+
+    def __del__ (self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+
+    def etag (self, path: str) -> str:
+        # Tar members don't change within a generation
+        return f'{self.submission_id}-{self.generation}-{self.member(path)[0]}'
+
+class SiteCache:
+    """
+    Keeps submission sites in tars_dir across views. Each view
+    revalidates with a metadata only request and only downloads
+    when the converted tarball's generation changed. Concurrent
+    views of one submission share a single download, and the
+    least recently viewed sites are removed once they take more
+    than max_bytes. Sites already in tars_dir when the cache is
+    created, left by earlier processes, are reused and count
+    towards max_bytes.
+    """
+
+    def __init__ (self, tars_dir: str, max_bytes: int):
+        self.tars_dir = tars_dir
+        self.max_bytes = max_bytes
+        # submission_id -> site, least recently viewed first
+        self.sites: OrderedDict[int, TarSite] = OrderedDict()
+        # submission_id -> the download in progress
+        self.flights: Dict[int, _Flight] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._adopt()
+
+    def _adopt (self):
+        """
+        Indexes the site tars in tars_dir, oldest first, keeping the newest
+        generation of each submission, then evicts what doesn't fit. Removes
+        the other generations, and downloads abandoned by their process.
+        """
+        dirname, prefix = os.path.split(self.tars_dir)
+        os.makedirs(dirname or '.', exist_ok=True)
+        entries = [entry for entry in os.scandir(dirname or '.')
+                   if entry.is_file() and entry.name.startswith(prefix)]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            match = TAR_NAME.fullmatch(entry.name[len(prefix):])
+            try:
+                if match is None:
+                    if time.time() - entry.stat().st_mtime > STALE_DOWNLOAD_SECONDS:
+                        _remove(entry.path)
+                    continue
+                submission_id, generation = int(match[1]), int(match[2])
+                old = self.sites.get(submission_id)
+                if old and old.generation >= generation:
+                    _remove(entry.path)
+                    continue
+                self.sites[submission_id] = TarSite(submission_id, generation, entry.path)
+                self.sites.move_to_end(submission_id)
+                if old:
+                    _remove(old.tar_path)
+            except (OSError, tarfile.TarError):
+                # Removed by another process meanwhile, or unreadable
+                logging.warning(f'Skipped {entry.path} in the site cache', exc_info=1)
+        with self.lock:
+            self._evict(keep=None)
+        logging.info(f'Site cache started with {self.stats()}')
+
+    def cached (self, submission_id: int) -> Optional[TarSite]:
+        """ The site last fetched by a view, without revalidating it """
+        with self.lock:
+            return self.sites.get(submission_id)
+
+    def get (self, bucket: Bucket, submission_id: int) -> TarSite:
+        """ Returns the submission's site, downloading it if stale """
+        blob = bucket.get_blob(f'{submission_id}.tar.gz')
+        if blob is None:
+            raise DeletedError(f'{submission_id}.tar.gz not found')
+
+        while True:
+            with self.lock:
+                site = self.sites.get(submission_id)
+                # Generations only grow, a newer site fetched by another view is as good
+                if site and site.generation >= blob.generation:
+                    self.sites.move_to_end(submission_id)
+                    self.hits += 1
+                    return site
+                flight = self.flights.get(submission_id)
+                if flight is None:
+                    flight = self.flights[submission_id] = _Flight()
+                    self.misses += 1
+                    break
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+
+        try:
+            site = self._download(bucket, submission_id, blob.generation)
+            with self.lock:
+                old = self.sites.pop(submission_id, None)
+                self.sites[submission_id] = site
+                self._evict(keep=submission_id)
+            if old:
+                _remove(old.tar_path)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[submission_id]
+            flight.done.set()
+        return site
+
+    def _download (self, bucket: Bucket, submission_id: int, generation: int) -> TarSite:
+        tar_path = f'{self.tars_dir}{submission_id}.{generation}.tar'
+        # Other processes share tars_dir, and may be reading tar_path
+        gz_path, tmp_path = f'{tar_path}.gz.{os.getpid()}', f'{tar_path}.{os.getpid()}'
+        try:
+            # Pinned so the bytes match the generation we revalidated against
+            bucket.blob(f'{submission_id}.tar.gz', generation=generation) \
+                .download_to_filename(gz_path)
+            # Gunzipped once here so members can be read by offset
+            with gzip.open(gz_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.rename(tmp_path, tar_path)
+            site = TarSite(submission_id, generation, tar_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if os.path.exists(gz_path):
+                os.remove(gz_path)
+        logging.info(f'Cached {submission_id} generation {generation}: '
+                     f'{len(site.index)} files, {site.size} bytes')
+        return site
+
+    def _evict (self, keep: Optional[int]):
+        """ Removes least recently viewed sites until the rest fit in max_bytes. Needs self.lock """
+        total = sum(site.size for site in self.sites.values())
+        for submission_id in list(self.sites):
+            if total <= self.max_bytes:
+                break
+            if submission_id == keep:
+                continue
+            site = self.sites.pop(submission_id)
+            # Requests still holding the site read from its open descriptor
+            _remove(site.tar_path)
+            total -= site.size
+            logging.info(f'Evicted site {submission_id} ({site.size} bytes)')
+
+    def stats (self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'sites': len(self.sites),
+                'bytes': sum(site.size for site in self.sites.values()),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+_site_cache_lock = threading.Lock()
+
+def get_site_cache () -> SiteCache:
+    """ Returns the app's site cache, creating it on first use """
+    app = current_app._get_current_object()
+    with _site_cache_lock:
+        if 'site_cache' not in app.extensions:
+            app.extensions['site_cache'] = SiteCache(
+                app.config['TARS_DIR'],
+                app.config['SITE_CACHE_MAX_BYTES'])
+        return app.extensions['site_cache']
@@ -0,0 +1,98 @@
+"""Conversion status of many submissions or documents in one query"""
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+from sqlalchemy import tuple_
+
+from arxiv_auth.legacy.models import db
+
+from .db.models import DBLaTeXMLDocuments, DBLaTeXMLSubmissions
+from .db.util import database_retry
+from .exceptions import DBConnectionError
+
+def _status (row) -> Dict[str, Any]:
+    return {
+        'status': row.conversion_status,
+        'latexml_version': row.latexml_version,
+        'conversion_start_time': row.conversion_start_time,
+        'conversion_end_time': row.conversion_end_time
+    }
+
+@database_retry(5)
+def get_submission_statuses (submission_ids: List[int]) -> Dict[str, Optional[Dict[str, Any]]]:
+    """
+    Status of each submission keyed by its id, None for
+    submissions without a conversion row
+    """
+    try:
+        rows = db.session.query(DBLaTeXMLSubmissions) \
+            .filter(DBLaTeXMLSubmissions.submission_id.in_(submission_ids)) \
+            .all()
+    except Exception as e:
+        raise DBConnectionError from e
+    found = { row.submission_id: _status(row) for row in rows }
+    return { str(id): found.get(id) for id in submission_ids }
+
+@database_retry(5)
+def get_document_statuses (documents: List[Tuple[str, int]]) -> Dict[str, Optional[Dict[str, Any]]]:
+    """
+    Status of each (paper_id, version) keyed by paper_id + 'v' +
+    version, None for documents without a conversion row
+    """
+    try:
+        rows = db.session.query(DBLaTeXMLDocuments) \
+            .filter(tuple_(DBLaTeXMLDocuments.paper_id, DBLaTeXMLDocuments.document_version)
+                    .in_(documents)) \
+            .all()
+    except Exception as e:
+        raise DBConnectionError from e
+    found = { (row.paper_id, row.document_version): _status(row) for row in rows }
+    return { f'{paper_id}v{version}': found.get((paper_id, version))
+             for paper_id, version in documents }
+
+def _parse_submission_ids (body: Any) -> List[int]:
+    ids = body.get('submission_ids') if isinstance(body, dict) else None
+    if not isinstance(ids, list) or \
+            not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        raise ValueError('expected {"submission_ids": [<int>, ...]}')
+    return list(dict.fromkeys(ids))
+
+def _parse_documents (body: Any) -> List[Tuple[str, int]]:
+    docs = body.get('documents') if isinstance(body, dict) else None
+    if not isinstance(docs, list):
+        raise ValueError('expected {"documents": [{"paper_id": <str>, "version": <int>}, ...]}')
+    parsed = []
+    for doc in docs:
+        if not isinstance(doc, dict) or not isinstance(doc.get('paper_id'), str) \
+                or not isinstance(doc.get('version'), int) or isinstance(doc.get('version'), bool):
+            raise ValueError('expected {"documents": [{"paper_id": <str>, "version": <int>}, ...]}')
+        parsed.append((doc['paper_id'], doc['version']))
+    return list(dict.fromkeys(parsed))
+
+def batch_status (kind: str, body: Any, max_batch: int):
+    """
+    Answers a batch status request for kind 'submissions' or
+    'documents' with one IN (...) query
+    """
+    if kind not in ('submissions', 'documents'):
+        return {'error': f'unknown kind {kind}, expected submissions or documents'}, 404
+    try:
+        if kind == 'submissions':
+            keys = _parse_submission_ids(body)
+        else:
+            keys = _parse_documents(body)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    if len(keys) > max_batch:
+        return {'error': f'at most {max_batch} {kind} per request'}, 400
+    if not keys:
+        return {kind: {}}, 200
+    try:
+        if kind == 'submissions':
+            statuses = get_submission_statuses(keys)
+        else:
+            statuses = get_document_statuses(keys)
+    except DBConnectionError:
+        logging.warning(f'Batch status of {len(keys)} {kind} failed', exc_info=1)
+        return {'error': 'database unavailable'}, 500
+    return {kind: statuses}, 200
@@ -0,0 +1,105 @@
+import pytest
+import os
+
+from sqlalchemy import text
+
+MARKERS = [
+    "site_cache_unit_tests: Unit tests for the submission site cache",
+    "authorize_unit_tests: Unit tests for submission authorization",
+    "routes_unit_tests: Unit tests for routes",
+    "poll_unit_tests: Unit tests for submission status long-polling",
+]
+
+TESTING_CONFIG = {
+    'TESTING': True,
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+    'SQLALCHEMY_BINDS': { 'latexml': 'sqlite:///:memory:?cache=latexml' },
+    'CONVERTED_BUCKET_SUB_ID': 'latexml_submission_converted',
+    'AUTH_CACHE_TTL': 30,
+    'POLL_INTERVAL': 0.05,
+    'POLL_MAX_WAIT': 1,
+    'STATUS_BATCH_MAX': 10,
+}
+
+# The classic tables authorization reads, with only the columns it uses
+CLASSIC_TABLES = [
+    'CREATE TABLE arXiv_submissions (submission_id INTEGER PRIMARY KEY, submitter_id INTEGER, '
+    'is_withdrawn INTEGER, status INTEGER)',
+    'CREATE TABLE tapir_users (user_id INTEGER PRIMARY KEY, flag_edit_users INTEGER)',
+    'CREATE TABLE arXiv_moderators (user_id INTEGER, archive TEXT)',
+]
+
+# Users of the classic rows the submissions fixture inserts
+OWNER, OTHER, EDITOR, MODERATOR = 10, 11, 12, 13
+
+def pytest_configure(config):
+    for marker in MARKERS:
+        config.addinivalue_line("markers", marker)
+
+@pytest.fixture
+def app(mocker):
+    """ The proxy's routes on sqlite, without arxiv_auth's middleware """
+    pytest.importorskip('arxiv_auth')
+    from flask import Flask
+    from arxiv_auth.legacy.models import db
+    from ReverseProxy.routes import blueprint
+    from ReverseProxy.db.models import DBLaTeXMLDocuments, DBLaTeXMLSubmissions
+    from ReverseProxy.authorize import _DecisionCache
+
+    app = Flask('ReverseProxy', static_folder=None)
+    app.config.from_pyfile(os.path.join(os.path.dirname(__file__), '..', 'ReverseProxy', 'config.py'))
+    app.config.update(TESTING_CONFIG)
+    app.register_blueprint(blueprint)
+    db.init_app(app)
+    with app.app_context():
+        with db.engine.begin() as conn:
+            for table in CLASSIC_TABLES:
+                conn.execute(text(table))
+        for model in (DBLaTeXMLDocuments, DBLaTeXMLSubmissions):
+            model.__table__.create(db.engines['latexml'])
+    mocker.patch('ReverseProxy.authorize.is_configured', return_value=True)
+    mocker.patch('ReverseProxy.authorize.current_session', side_effect=lambda: db.session)
+    mocker.patch('ReverseProxy.authorize._decisions', _DecisionCache())
+    return app
+
+@pytest.fixture
+def classic_rows(app):
+    """ Inserts rows into the classic tables, as {table: [row dict]} """
+    from arxiv_auth.legacy.models import db
+    def insert(rows):
+        with app.app_context(), db.engine.begin() as conn:
+            for table, table_rows in rows.items():
+                for row in table_rows:
+                    conn.execute(
+                        text(f'INSERT INTO {table} ({", ".join(row)}) VALUES ({", ".join(":" + k for k in row)})'),
+                        row)
+    return insert
+
+@pytest.fixture
+def user(mocker):
+    """ Sets the arXiv user the routes see, None for no session """
+    from ReverseProxy.exceptions import AuthError
+    current = {}
+    def get_user_id():
+        if current.get('user_id') is None:
+            raise AuthError
+        return current['user_id']
+    mocker.patch('ReverseProxy.routes._get_arxiv_user_id', side_effect=get_user_id)
+    def set_user(user_id):
+        current['user_id'] = user_id
+    return set_user
+
+@pytest.fixture
+def submissions(classic_rows):
+    classic_rows({
+        'arXiv_submissions': [
+            { 'submission_id': 1, 'submitter_id': OWNER, 'is_withdrawn': 0, 'status': 1 },
+            { 'submission_id': 2, 'submitter_id': OWNER, 'is_withdrawn': 1, 'status': 1 },
+            { 'submission_id': 3, 'submitter_id': OWNER, 'is_withdrawn': 0, 'status': 10 },
+        ],
+        'tapir_users': [
+            { 'user_id': OWNER, 'flag_edit_users': 0 },
+            { 'user_id': EDITOR, 'flag_edit_users': 1 },
+        ],
+        'arXiv_moderators': [{ 'user_id': MODERATOR, 'archive': 'cs' }],
+    })
@@ -0,0 +1,60 @@
+"""An in-memory stand-in for the converted submissions bucket"""
+from typing import Dict, Optional
+import io
+import tarfile
+import threading
+import time
+
+def site_tar_gz (submission_id: int, files: Dict[str, bytes]) -> bytes:
+    """ A converted submission tarball holding files under {submission_id}/ """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(f'{submission_id}/{name}')
+            info.size = len(data)
+            info.mtime = 1700000000
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+class FakeBlob:
+    def __init__ (self, bucket: 'FakeBucket', name: str, generation: Optional[int]):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+
+    def download_to_filename (self, fpath: str):
+        with self.bucket.lock:
+            self.bucket.downloads += 1
+            data = self.bucket.objects[self.name][self.generation]
+        time.sleep(self.bucket.download_delay)
+        with open(fpath, 'wb') as f:
+            f.write(data)
+
+class FakeBucket:
+    """
+    Keeps every generation of each object, like a versioned bucket,
+    and counts downloads. download_delay holds each download so
+    concurrent views overlap.
+    """
+
+    def __init__ (self, download_delay: float = 0):
+        self.objects: Dict[str, Dict[int, bytes]] = {}
+        self.download_delay = download_delay
+        self.downloads = 0
+        self.lock = threading.Lock()
+
+    def upload (self, name: str, data: bytes) -> int:
+        with self.lock:
+            generations = self.objects.setdefault(name, {})
+            generation = max(generations, default=0) + 1
+            generations[generation] = data
+            return generation
+
+    def get_blob (self, name: str) -> Optional[FakeBlob]:
+        with self.lock:
+            if name not in self.objects:
+                return None
+            return FakeBlob(self, name, max(self.objects[name]))
+
+    def blob (self, name: str, generation: Optional[int] = None) -> FakeBlob:
+        return FakeBlob(self, name, generation)
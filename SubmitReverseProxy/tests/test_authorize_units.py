@@ -0,0 +1,60 @@
+import pytest
+import time
+
+pytest.importorskip('arxiv_auth')
+
+from ReverseProxy.authorize import authorize_user_for_submission, _get_authorization_row
+from ReverseProxy.exceptions import DBConfigError, DeletedError, UnauthorizedError
+from tests.conftest import OWNER, OTHER, EDITOR, MODERATOR
+
+"""
+******************************
+***** authorization tests ****
+******************************
+"""
+
+@pytest.mark.authorize_unit_tests
+@pytest.mark.parametrize('user_id, expected', [
+    (OWNER, (OWNER, 0, 1, 0, 0)),
+    (EDITOR, (OWNER, 0, 1, 1, 0)),
+    (MODERATOR, (OWNER, 0, 1, 0, 1)),
+    (OTHER, (OWNER, 0, 1, 0, 0)),
+])
+def test_authorization_row_one_query (app, submissions, user_id, expected):
+    with app.app_context():
+        row = _get_authorization_row(user_id, 1)
+        assert tuple(row) == expected, f'Incorrect authorization row {tuple(row)}'
+        assert _get_authorization_row(user_id, 99) is None, 'Found a row for a missing submission'
+
+@pytest.mark.authorize_unit_tests
+@pytest.mark.parametrize('user_id, submission_id, expected', [
+    (OWNER, 1, None),
+    (OTHER, 1, UnauthorizedError),
+    (OWNER, 2, UnauthorizedError),
+    (OWNER, 3, DeletedError),
+    (EDITOR, 3, None),
+    (MODERATOR, 2, None),
+    (OWNER, 99, DBConfigError),
+])
+def test_authorize_decisions (app, submissions, user_id, submission_id, expected):
+    with app.app_context():
+        if expected is None:
+            authorize_user_for_submission(user_id, submission_id)
+        else:
+            with pytest.raises(expected):
+                authorize_user_for_submission(user_id, submission_id)
+
+@pytest.mark.authorize_unit_tests
+def test_authorize_caches_decisions (app, submissions, mocker):
+    row = mocker.patch('ReverseProxy.authorize._get_authorization_row', wraps=_get_authorization_row)
+    with app.app_context():
+        for _ in range(3):
+            authorize_user_for_submission(OWNER, 1)
+            with pytest.raises(UnauthorizedError):
+                authorize_user_for_submission(OTHER, 1)
+        assert row.call_count == 2, f'{row.call_count} queries for two users'
+
+        # Past AUTH_CACHE_TTL
+        mocker.patch('ReverseProxy.authorize.time.monotonic', return_value=time.monotonic() + 31)
+        authorize_user_for_submission(OWNER, 1)
+        assert row.call_count == 3, 'Expired decision was reused'
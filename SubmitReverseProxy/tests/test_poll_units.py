@@ -0,0 +1,95 @@
+import pytest
+import threading
+import time
+
+pytest.importorskip('arxiv_auth')
+
+from arxiv_auth.legacy.models import db
+from ReverseProxy.poll import StatusBoard, _get_latexml_status_for_document
+from ReverseProxy.db.models import DBLaTeXMLSubmissions
+from tests.conftest import OWNER
+
+INTERVAL = 0.05
+
+class Statuses:
+    """ A conversion_status lookup that counts its calls """
+
+    def __init__ (self, status):
+        self.status = status
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__ (self, submission_id):
+        with self.lock:
+            self.calls += 1
+            return self.status
+
+"""
+******************************
+******** poll tests **********
+******************************
+"""
+
+@pytest.mark.poll_unit_tests
+def test_poll_returns_at_once_when_converted ():
+    fetch = Statuses(1)
+    start = time.monotonic()
+    assert StatusBoard().wait(1, 5, INTERVAL, fetch) == 1, 'Incorrect status'
+    assert time.monotonic() - start < 1 and fetch.calls == 1, 'Held a finished conversion'
+
+@pytest.mark.poll_unit_tests
+def test_poll_times_out_unchanged ():
+    fetch = Statuses(0)
+    start = time.monotonic()
+    assert StatusBoard().wait(1, 0.5, INTERVAL, fetch) == 0, 'Incorrect status'
+    elapsed = time.monotonic() - start
+    assert 0.5 <= elapsed < 1.5, f'Held for {elapsed:.2f}s instead of the 0.5s wait'
+    assert fetch.calls <= 0.5 / INTERVAL + 2, f'{fetch.calls} lookups in 0.5s'
+
+@pytest.mark.poll_unit_tests
+def test_poll_wakes_on_change ():
+    fetch = Statuses(0)
+    threading.Timer(0.2, lambda: setattr(fetch, 'status', 1)).start()
+    start = time.monotonic()
+    assert StatusBoard().wait(1, 5, INTERVAL, fetch) == 1, 'Change was not seen'
+    elapsed = time.monotonic() - start
+    assert elapsed < 0.2 + 5 * INTERVAL, f'Woke {elapsed:.2f}s after the change at 0.2s'
+
+@pytest.mark.poll_unit_tests
+def test_pollers_share_lookups ():
+    board, fetch = StatusBoard(), Statuses(0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(board.wait(1, 0.5, INTERVAL, fetch)))
+               for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    threading.Timer(0.25, lambda: setattr(fetch, 'status', 2)).start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [2] * 20, f'Not every poller saw the failure {results}'
+    assert fetch.calls <= 0.5 / INTERVAL + 2, f'{fetch.calls} lookups for 20 pollers'
+    assert not board.watches, 'Watch left behind after its pollers returned'
+
+@pytest.mark.poll_unit_tests
+def test_poll_lookup_ends_transaction (app):
+    with app.app_context():
+        db.session.add(DBLaTeXMLSubmissions(submission_id=1, conversion_status=0, latexml_version='v'))
+        db.session.commit()
+        assert _get_latexml_status_for_document(1) == 0, 'Incorrect status'
+        assert not db.session().in_transaction(), 'Lookup left its transaction open'
+
+@pytest.mark.poll_unit_tests
+@pytest.mark.parametrize('status, exists', [(1, True), (0, False)])
+def test_poll_route_wait (app, submissions, user, status, exists):
+    with app.app_context():
+        db.session.add(DBLaTeXMLSubmissions(submission_id=1, conversion_status=status, latexml_version='v'))
+        db.session.commit()
+    user(OWNER)
+    start = time.monotonic()
+    response = app.test_client().get('/1/poll?wait=0.3')
+    elapsed = time.monotonic() - start
+
+    assert (response.status_code, response.json) == (200, { 'exists': exists }), \
+        f'Incorrect response {response.status_code} {response.json}'
+    assert (elapsed >= 0.3) != exists, f'Held {elapsed:.2f}s for status {status}'
@@ -0,0 +1,113 @@
+import pytest
+
+pytest.importorskip('arxiv_auth')
+
+from ReverseProxy.site_cache import SiteCache
+from tests.fake_bucket import FakeBucket, site_tar_gz
+from tests.conftest import OWNER, OTHER, EDITOR, MODERATOR
+
+"""
+******************************
+******** routes tests ********
+******************************
+"""
+
+@pytest.mark.routes_unit_tests
+@pytest.mark.parametrize('user_id, expected', [(OWNER, 200), (OTHER, 403), (None, 403)])
+def test_static_route_authorized (app, submissions, user, tmp_path, mocker, user_id, expected):
+    bucket = FakeBucket()
+    bucket.upload('1.tar.gz', site_tar_gz(1, { '1.html': b'<html></html>', 'x1.png': b'\x89PNG' }))
+    cache = SiteCache(f'{tmp_path}/', 1 << 30)
+    cache.get(bucket, 1)
+    mocker.patch('ReverseProxy.routes.get_site_cache', return_value=cache)
+    user(user_id)
+
+    response = app.test_client().get('/1/x1.png')
+
+    assert response.status_code == expected, f'Incorrect status {response.status_code}'
+    if expected == 200:
+        assert response.data == b'\x89PNG', 'Incorrect asset served'
+
+@pytest.mark.routes_unit_tests
+def test_static_route_loads_uncached_site (app, submissions, user, tmp_path, mocker):
+    # Evicted, or viewed through another worker
+    bucket = FakeBucket()
+    bucket.upload('1.tar.gz', site_tar_gz(1, { '1.html': b'<html></html>', 'x1.png': b'\x89PNG' }))
+    cache = SiteCache(f'{tmp_path}/', 1 << 30)
+    mocker.patch('ReverseProxy.routes.get_site_cache', return_value=cache)
+    mocker.patch('ReverseProxy.routes._converted_bucket', return_value=bucket)
+    user(OWNER)
+
+    client = app.test_client()
+    responses = [client.get('/1/x1.png'), client.get('/1/x1.png')]
+
+    assert [r.status_code for r in responses] == [200, 200], \
+        f'Incorrect statuses {[r.status_code for r in responses]}'
+    assert responses[0].data == b'\x89PNG', 'Incorrect asset served'
+    assert bucket.downloads == 1, f'Downloaded {bucket.downloads} times'
+
+@pytest.mark.routes_unit_tests
+def test_static_route_revalidates_without_reading (app, submissions, user, tmp_path, mocker):
+    bucket = FakeBucket()
+    bucket.upload('1.tar.gz', site_tar_gz(1, { '1.html': b'<html></html>', 'x1.png': b'\x89PNG' }))
+    cache = SiteCache(f'{tmp_path}/', 1 << 30)
+    site = cache.get(bucket, 1)
+    mocker.patch('ReverseProxy.routes.get_site_cache', return_value=cache)
+    user(OWNER)
+    client = app.test_client()
+    first = client.get('/1/x1.png')
+    read = mocker.spy(site, 'read')
+
+    for headers in ({ 'If-None-Match': first.headers['ETag'] },
+                    { 'If-Modified-Since': first.headers['Last-Modified'] }):
+        response = client.get('/1/x1.png', headers=headers)
+        assert response.status_code == 304, f'Incorrect status {response.status_code} for {headers}'
+        assert response.headers['ETag'] == first.headers['ETag'], 'Revalidation lost the ETag'
+    assert not read.called, 'Read the member to answer a revalidation'
+    assert client.get('/1/x1.png', headers={ 'If-None-Match': '"stale"' }).data == b'\x89PNG', \
+        'Changed asset not served'
+
+@pytest.fixture
+def conversions(app):
+    from arxiv_auth.legacy.models import db
+    from ReverseProxy.db.models import DBLaTeXMLDocuments, DBLaTeXMLSubmissions
+    with app.app_context():
+        db.session.add(DBLaTeXMLSubmissions(
+            submission_id=1, conversion_status=1, latexml_version='v',
+            conversion_start_time=100, conversion_end_time=160))
+        db.session.add(DBLaTeXMLDocuments(
+            paper_id='2402.00001', document_version=1, conversion_status=2, latexml_version='v',
+            conversion_start_time=200, conversion_end_time=230))
+        db.session.commit()
+
+@pytest.mark.routes_unit_tests
+@pytest.mark.parametrize('kind, body, expected', [
+    ('submissions', { 'submission_ids': [1, 2] }, {
+        '1': { 'status': 1, 'latexml_version': 'v', 'conversion_start_time': 100, 'conversion_end_time': 160 },
+        '2': None
+    }),
+    ('documents', { 'documents': [{ 'paper_id': '2402.00001', 'version': 1 },
+                                  { 'paper_id': '2402.00001', 'version': 2 }] }, {
+        '2402.00001v1': { 'status': 2, 'latexml_version': 'v', 'conversion_start_time': 200, 'conversion_end_time': 230 },
+        '2402.00001v2': None
+    }),
+])
+def test_batch_status (app, submissions, conversions, user, kind, body, expected):
+    user(EDITOR)
+    response = app.test_client().post(f'/status/{kind}', json=body)
+    assert response.status_code == 200, f'Incorrect status {response.status_code}'
+    assert response.json == { kind: expected }, f'Incorrect statuses {response.json}'
+
+@pytest.mark.routes_unit_tests
+@pytest.mark.parametrize('kind, body, user_id, expected', [
+    ('papers', { 'submission_ids': [1] }, EDITOR, 404),
+    ('submissions', { 'submission_ids': [1] }, OWNER, 403),
+    ('submissions', { 'submission_ids': [1] }, None, 403),
+    ('submissions', { 'submission_ids': ['1'] }, MODERATOR, 400),
+    ('documents', { 'documents': [{ 'paper_id': '2402.00001' }] }, MODERATOR, 400),
+    ('submissions', { 'submission_ids': list(range(11)) }, EDITOR, 400),
+])
+def test_batch_status_rejected (app, submissions, conversions, user, kind, body, user_id, expected):
+    user(user_id)
+    response = app.test_client().post(f'/status/{kind}', json=body)
+    assert response.status_code == expected, f'Incorrect status {response.status_code} for {kind} {body}'
@@ -0,0 +1,148 @@
+import pytest
+import os
+import threading
+import time
+
+from ReverseProxy.site_cache import SiteCache
+from ReverseProxy.exceptions import DeletedError
+from tests.fake_bucket import FakeBucket, site_tar_gz
+
+SITE = {
+    '1.html': b'<html>v1</html>',
+    'x1.png': b'\x89PNG' + b'\x00' * 1000,
+}
+
+@pytest.fixture
+def tars_dir (tmp_path):
+    # TARS_DIR is used as a prefix
+    return f'{tmp_path}/'
+
+@pytest.fixture
+def bucket ():
+    return FakeBucket()
+
+"""
+******************************
+***** site cache tests *******
+******************************
+"""
+
+@pytest.mark.site_cache_unit_tests
+def test_site_cache_hit (tars_dir, bucket):
+    bucket.upload('1.tar.gz', site_tar_gz(1, SITE))
+    cache = SiteCache(tars_dir, 1 << 30)
+
+    first = cache.get(bucket, 1)
+    second = cache.get(bucket, 1)
+
+    assert second is first, 'Unchanged site was not reused'
+    assert bucket.downloads == 1, f'Unchanged site downloaded {bucket.downloads} times'
+    assert second.read('x1.png') == SITE['x1.png'], 'Incorrect member contents'
+    assert second.member('missing.png') is None, 'Missing member was found'
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 1), f'Incorrect stats {cache.stats()}'
+
+@pytest.mark.site_cache_unit_tests
+def test_site_cache_generation_bump (tars_dir, bucket):
+    bucket.upload('1.tar.gz', site_tar_gz(1, SITE))
+    cache = SiteCache(tars_dir, 1 << 30)
+    old = cache.get(bucket, 1)
+
+    # Reconverted
+    generation = bucket.upload('1.tar.gz', site_tar_gz(1, { **SITE, '1.html': b'<html>v2</html>' }))
+    new = cache.get(bucket, 1)
+
+    assert new.generation == generation and bucket.downloads == 2, 'New generation was not downloaded'
+    assert new.read('1.html') == b'<html>v2</html>', 'Served the previous generation'
+    assert cache.cached(1) is new, 'Static route would serve the previous generation'
+    assert os.listdir(tars_dir) == [os.path.basename(new.tar_path)], \
+        f'Previous generation left on disk {os.listdir(tars_dir)}'
+    assert old.etag('1.html') != new.etag('1.html'), 'ETag did not change with the generation'
+
+@pytest.mark.site_cache_unit_tests
+def test_site_cache_single_flight (tars_dir):
+    bucket = FakeBucket(download_delay=0.2)
+    bucket.upload('1.tar.gz', site_tar_gz(1, SITE))
+    cache = SiteCache(tars_dir, 1 << 30)
+
+    sites, barrier = [], threading.Barrier(8)
+    def view ():
+        barrier.wait()
+        sites.append(cache.get(bucket, 1))
+    threads = [threading.Thread(target=view) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert bucket.downloads == 1, f'{bucket.downloads} downloads for concurrent views'
+    assert all(site is sites[0] for site in sites), 'Concurrent views got different sites'
+
+@pytest.mark.site_cache_unit_tests
+def test_site_cache_evicts_least_recently_viewed (tars_dir, bucket):
+    for submission_id in (1, 2, 3):
+        bucket.upload(f'{submission_id}.tar.gz', site_tar_gz(submission_id, SITE))
+    cache = SiteCache(tars_dir, 1 << 30)
+    one = cache.get(bucket, 1)
+    # Room for two of the equally sized sites
+    size = one.size
+    cache.max_bytes = 2 * size
+
+    cache.get(bucket, 2)
+    cache.get(bucket, 1)
+    cache.get(bucket, 3)
+
+    assert list(cache.sites) == [1, 3], f'Incorrect sites kept {list(cache.sites)}'
+    assert cache.stats()['bytes'] <= 2 * size, f'Cache over its limit {cache.stats()}'
+    assert not os.path.exists(f'{tars_dir}2.1.tar'), 'Evicted site left on disk'
+    assert one.read('1.html') == SITE['1.html'], 'Kept site unreadable'
+
+@pytest.mark.site_cache_unit_tests
+def test_site_cache_deleted (tars_dir, bucket):
+    with pytest.raises(DeletedError):
+        SiteCache(tars_dir, 1 << 30).get(bucket, 1)
+
+@pytest.mark.site_cache_unit_tests
+def test_site_readable_after_evicted_or_replaced (tars_dir, bucket):
+    bucket.upload('1.tar.gz', site_tar_gz(1, SITE))
+    bucket.upload('2.tar.gz', site_tar_gz(2, SITE))
+    cache = SiteCache(tars_dir, 1 << 30)
+    # Held by requests still sending them
+    replaced = cache.get(bucket, 1)
+    evicted = cache.get(bucket, 2)
+
+    # Downloading the reconversion replaces one and leaves no room for the other
+    bucket.upload('1.tar.gz', site_tar_gz(1, { **SITE, '1.html': b'<html>v2</html>' }))
+    cache.max_bytes = 0
+    cache.get(bucket, 1)
+
+    assert 2 not in cache.sites, 'Site was not evicted'
+    assert not os.path.exists(replaced.tar_path) and not os.path.exists(evicted.tar_path), \
+        'Replaced or evicted tar left on disk'
+    assert replaced.read('1.html') == SITE['1.html'], 'Replaced site unreadable while held'
+    assert evicted.read('x1.png') == SITE['x1.png'], 'Evicted site unreadable while held'
+
+@pytest.mark.site_cache_unit_tests
+def test_site_cache_adopts_tars_dir (tars_dir, bucket):
+    bucket.upload('1.tar.gz', site_tar_gz(1, SITE))
+    bucket.upload('2.tar.gz', site_tar_gz(2, SITE))
+    earlier = SiteCache(tars_dir, 1 << 30)
+    one, two = earlier.get(bucket, 1), earlier.get(bucket, 2)
+    # An older generation, and downloads abandoned long ago and in progress
+    os.link(one.tar_path, f'{tars_dir}1.0.tar')
+    for name, age in (('3.1.tar.gz.99999', 2 * 3600), ('4.1.tar.99998', 0)):
+        with open(f'{tars_dir}{name}', 'wb') as f:
+            f.write(b'partial')
+        os.utime(f'{tars_dir}{name}', (time.time() - age, time.time() - age))
+    downloads = bucket.downloads
+
+    cache = SiteCache(tars_dir, 1 << 30)
+
+    assert sorted(cache.sites) == [1, 2], f'Sites not adopted {list(cache.sites)}'
+    assert cache.get(bucket, 1).read('x1.png') == SITE['x1.png'], 'Adopted site unreadable'
+    assert bucket.downloads == downloads, 'Adopted site was downloaded again'
+    assert sorted(os.listdir(tars_dir)) == ['1.1.tar', '2.1.tar', '4.1.tar.99998'], \
+        f'Incorrect files kept {sorted(os.listdir(tars_dir))}'
+
+    # Counted towards the bound like downloaded sites
+    assert sorted(SiteCache(tars_dir, two.size).sites) == [2], 'Adopted sites were not evicted'
+    assert not os.path.exists(one.tar_path), 'Evicted adopted site left on disk'